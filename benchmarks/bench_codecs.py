@@ -0,0 +1,223 @@
+"""
+Benchmark suite comparing the CLI (WavPackCodec) and Cython (WavPack) codecs.
+
+For each codec configuration, dtype, chunk shape and signal, it reports the encode and decode throughput
+(MB/s of raw data), the compression ratio, the maximum absolute error (lossy modes) and the peak resident
+memory. Each case runs in a fresh worker process, so that the peak RSS is the one of the case alone. The
+results are saved as JSON, and can be compared with the results of a previous run to track regressions:
+
+    python benchmarks/bench_codecs.py --output results.json
+    python benchmarks/bench_codecs.py --quick --codecs cython --output new.json --compare results.json
+    python benchmarks/bench_codecs.py --signals sin npy:/data/chunk.npy --channels 384
+
+See `signals.py` for the signal specs and how to plug in loaders of real data.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from signals import load_signal
+
+
+CLI_CONFIGS = [dict(compression_mode=mode, hybrid_factor=hybrid_factor)
+               for mode in ["default", "f", "h", "hh"] for hybrid_factor in [None, 3, 6]]
+CYTHON_CONFIGS = [dict(level=level, bps=bps) for level in [1, 2, 3, 4] for bps in [None, 3, 6]]
+DTYPES = ["int8", "int16", "int32", "float32"]
+CHANNELS = [1, 32, 384, 4096]
+
+
+def make_codec(codec, config, dtype):
+    if codec == "cli":
+        from wavpack_numcodecs import WavPackCodec
+        return WavPackCodec(dtype=dtype, **config)
+    else:
+        from wavpack_cython import WavPack
+        return WavPack(**config)
+
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 2 ** 10
+
+
+def best_time(func, repeats):
+    times = []
+    result = None
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t_start)
+    return min(times), result
+
+
+def run_case(case, repeats):
+    """Runs a benchmark case and returns its results (a dict extending the case)"""
+    result = dict(case)
+    try:
+        data = load_signal(case["signal"], case["num_samples"], case["num_channels"], case["dtype"])
+        result["dtype"] = str(data.dtype)
+        result["num_samples"], result["num_channels"] = data.shape
+        codec = make_codec(case["codec"], case["config"], data.dtype)
+
+        t_encode, enc = best_time(lambda: codec.encode(data), repeats)
+        t_decode, dec = best_time(lambda: codec.decode(enc), repeats)
+        dec = np.frombuffer(dec, dtype=data.dtype).reshape(data.shape)
+
+        result.update(
+            data_mb=data.nbytes / 1e6,
+            encode_mbps=data.nbytes / t_encode / 1e6,
+            decode_mbps=data.nbytes / t_decode / 1e6,
+            ratio=data.nbytes / len(enc),
+            max_abs_error=float(np.max(np.abs(dec.astype("float64") - data))) if data.size else 0.0,
+            peak_rss_mb=peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            peak_rss_children_mb=peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        )
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def make_cases(args, cli_configs, cython_configs):
+    codec_configs = []
+    if "cli" in args.codecs:
+        codec_configs += [("cli", config) for config in cli_configs]
+    if "cython" in args.codecs:
+        codec_configs += [("cython", config) for config in cython_configs]
+
+    cases = []
+    for signal in args.signals:
+        # real data is benchmarked with its own dtype (or the one given for raw files)
+        dtypes = args.dtypes if signal.partition(":")[0] == "sin" else [args.data_dtype]
+        for dtype in dtypes:
+            for num_channels in args.channels:
+                for codec, config in codec_configs:
+                    cases.append(dict(codec=codec, config=config, signal=signal, dtype=dtype,
+                                      num_samples=args.num_samples, num_channels=num_channels))
+    return cases
+
+
+def case_key(result):
+    return json.dumps({k: result[k] for k in ["codec", "config", "signal", "dtype", "num_channels"]},
+                      sort_keys=True)
+
+
+def compare(results, baseline, threshold):
+    """Prints the cases whose throughput or ratio changed by more than `threshold` (relative)"""
+    baseline = {case_key(res): res for res in baseline["results"] if "error" not in res}
+    num_changes = 0
+    for res in results:
+        old = baseline.get(case_key(res))
+        if old is None or "error" in res:
+            continue
+        for metric in ["encode_mbps", "decode_mbps", "ratio"]:
+            change = res[metric] / old[metric] - 1
+            if abs(change) > threshold:
+                num_changes += 1
+                print(f"{format_case(res)}: {metric} {old[metric]:.2f} -> {res[metric]:.2f} ({change:+.0%})")
+    if num_changes == 0:
+        print(f"No change larger than {threshold:.0%}")
+
+
+def format_case(res):
+    config = ",".join(f"{k}={v}" for k, v in res["config"].items())
+    return f"{res['codec']:>6} {config:<40} {res['signal']:<8} {str(res['dtype']):>7} {res['num_channels']:>5}ch"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--codecs", nargs="+", choices=["cli", "cython"], default=["cli", "cython"])
+    parser.add_argument("--dtypes", nargs="+", default=DTYPES)
+    parser.add_argument("--channels", nargs="+", type=int, default=CHANNELS)
+    parser.add_argument("--num-samples", type=int, default=30000,
+                        help="Number of samples (frames) of each chunk")
+    parser.add_argument("--signals", nargs="+", default=["sin"],
+                        help="Signal specs: 'sin', 'npy:<path>', 'raw:<path>' or '<module>:<function>[:<arg>]'")
+    parser.add_argument("--data-dtype", default=None, help="The dtype of raw real-data files")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--quick", action="store_true",
+                        help="Only int16, 32 and 384 channels and the default configurations")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="Run all cases in this process (faster, but the peak RSS is cumulative)")
+    parser.add_argument("--output", default=None, help="JSON file to save the results to")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run to compare to")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative change reported by --compare")
+    args = parser.parse_args()
+
+    cli_configs, cython_configs = CLI_CONFIGS, CYTHON_CONFIGS
+    if args.quick:
+        args.dtypes = ["int16"]
+        args.channels = [32, 384]
+        cli_configs = [dict(compression_mode="default", hybrid_factor=None)]
+        cython_configs = [dict(level=1, bps=None), dict(level=2, bps=None)]
+
+    cases = make_cases(args, cli_configs, cython_configs)
+    results = []
+    for i, case in enumerate(cases):
+        if args.no_isolate:
+            res = run_case(case, args.repeats)
+        else:
+            # a fresh process per case, so that peak RSS measures the case alone
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                res = executor.submit(run_case, case, args.repeats).result()
+        results.append(res)
+        if "error" in res:
+            print(f"[{i + 1}/{len(cases)}] {format_case(res)}: {res['error']}")
+        else:
+            print(f"[{i + 1}/{len(cases)}] {format_case(res)}: encode {res['encode_mbps']:8.1f} MB/s  "
+                  f"decode {res['decode_mbps']:8.1f} MB/s  ratio {res['ratio']:5.2f}  "
+                  f"peak RSS {res['peak_rss_mb'] or float('nan'):7.1f} MB", flush=True)
+
+    if args.output is not None:
+        metadata = dict(
+            date=datetime.datetime.now().isoformat(timespec="seconds"),
+            python=sys.version.split()[0],
+            numpy=np.__version__,
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            versions=get_versions(args.codecs),
+            args=vars(args),
+        )
+        with open(args.output, "w") as f:
+            json.dump(dict(metadata=metadata, results=results), f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f), args.threshold)
+
+
+def get_versions(codecs):
+    versions = {}
+    if "cli" in codecs:
+        try:
+            from wavpack_numcodecs import get_wavpack_version
+            versions["wavpack_cli"] = str(get_wavpack_version())
+        except Exception as e:
+            versions["wavpack_cli"] = f"unavailable ({e})"
+    if "cython" in codecs:
+        try:
+            import wavpack_cython
+            versions["wavpack_cython"] = wavpack_cython.wavpack.__version__
+        except Exception as e:
+            versions["wavpack_cython"] = f"unavailable ({e})"
+    return versions
+
+
+if __name__ == "__main__":
+    main()
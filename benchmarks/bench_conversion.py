@@ -0,0 +1,152 @@
+"""
+Microbenchmark of the sample conversion (widening/narrowing) of the Cython WavPack codec, per dtype.
+
+The encoder widens the samples to the 32-bit buffers of the library, and the decoder narrows them back. They
+used to be converted 256 frames at a time, into a scratch buffer allocated for each call, and are now converted
+in block-sized batches into a scratch buffer reused across calls. For each dtype, the benchmark reports:
+
+    reference   the old conversion (256-frame batches, scratch allocated per call), as a reference function
+    batched     the new conversion (block-sized batches, reused scratch), with the same implementation
+    speedup     batched / reference
+    codec       the conversion throughput measured inside the codec at level=1 (the "convert" phase of the
+                codec statistics), for encode and decode
+
+The reference and batched functions are written with numpy, so they measure the effect of the batch size and of
+the scratch reuse, not the vectorization of the compiled loops, which is included in the codec columns:
+
+    python benchmarks/bench_conversion.py --num-samples 30000 --num-channels 384
+"""
+import argparse
+import time
+
+import numpy as np
+
+from signals import make_noisy_sin_signals
+from wavpack_cython import WavPack, CodecStats
+
+
+# frames of the batches of the old conversion loop
+REFERENCE_FRAMES = 256
+# samples (frames * channels) of the scratch buffer of the new conversion
+SCRATCH_SAMPLES = 1 << 18
+DTYPES = ("int8", "uint8", "int16", "uint16", "uint32")
+
+
+def _to_int32(src, dst):
+    # widens samples, offsetting unsigned samples to the signed range as the library expects
+    if src.dtype == "uint32":
+        np.bitwise_xor(src, np.uint32(0x80000000), out=dst.view("uint32"))
+    elif src.dtype.kind == "u":
+        np.subtract(src, 1 << (src.dtype.itemsize * 8 - 1), out=dst, dtype="int32")
+    else:
+        dst[:] = src
+
+
+def _from_int32(src, dst):
+    # narrows samples, inverse of _to_int32
+    if dst.dtype == "uint32":
+        np.bitwise_xor(src.view("uint32"), np.uint32(0x80000000), out=dst)
+    elif dst.dtype.kind == "u":
+        dst[:] = src + (1 << (dst.dtype.itemsize * 8 - 1))
+    else:
+        dst[:] = src
+
+
+def widen_reference(data):
+    """The old widening loop: REFERENCE_FRAMES frames at a time, into a scratch buffer allocated per call"""
+    num_frames, num_channels = data.shape
+    flat = data.reshape(-1)
+    scratch = np.empty(REFERENCE_FRAMES * num_channels, dtype="int32")
+    for start in range(0, num_frames, REFERENCE_FRAMES):
+        batch = flat[start * num_channels:min(start + REFERENCE_FRAMES, num_frames) * num_channels]
+        _to_int32(batch, scratch[:batch.size])
+
+
+def narrow_reference(samples, out):
+    """The old narrowing loop: REFERENCE_FRAMES frames at a time, from a scratch buffer allocated per call"""
+    num_frames, num_channels = out.shape
+    flat = out.reshape(-1)
+    scratch = np.empty(REFERENCE_FRAMES * num_channels, dtype="int32")
+    for start in range(0, num_frames, REFERENCE_FRAMES):
+        stop = min(start + REFERENCE_FRAMES, num_frames)
+        scratch[:(stop - start) * num_channels] = samples[start * num_channels:stop * num_channels]
+        _from_int32(scratch[:(stop - start) * num_channels], flat[start * num_channels:stop * num_channels])
+
+
+def widen_batched(data, scratch):
+    """The new widening loop: batches of as many whole frames as fit in the reused scratch buffer"""
+    num_frames, num_channels = data.shape
+    flat = data.reshape(-1)
+    batch_frames = max(len(scratch) // num_channels, 1)
+    for start in range(0, num_frames, batch_frames):
+        batch = flat[start * num_channels:min(start + batch_frames, num_frames) * num_channels]
+        _to_int32(batch, scratch[:batch.size])
+
+
+def narrow_batched(samples, out, scratch):
+    """The new narrowing loop: batches of as many whole frames as fit in the reused scratch buffer"""
+    num_frames, num_channels = out.shape
+    flat = out.reshape(-1)
+    batch_frames = max(len(scratch) // num_channels, 1)
+    for start in range(0, num_frames, batch_frames):
+        stop = min(start + batch_frames, num_frames)
+        scratch[:(stop - start) * num_channels] = samples[start * num_channels:stop * num_channels]
+        _from_int32(scratch[:(stop - start) * num_channels], flat[start * num_channels:stop * num_channels])
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t_start)
+    return min(times)
+
+
+def run(num_samples, num_channels, dtypes, repeats):
+    results = []
+    scratch = np.empty(SCRATCH_SAMPLES, dtype="int32")
+    for dtype in dtypes:
+        data = make_noisy_sin_signals((num_samples, num_channels), dtype=dtype, seed=0)
+        samples = np.empty(data.size, dtype="int32")
+        _to_int32(data.reshape(-1), samples)
+        out = np.empty_like(data)
+        t_reference = (best_time(lambda: widen_reference(data), repeats) +
+                       best_time(lambda: narrow_reference(samples, out), repeats))
+        assert np.array_equal(out, data)
+        t_batched = (best_time(lambda: widen_batched(data, scratch), repeats) +
+                     best_time(lambda: narrow_batched(samples, out, scratch), repeats))
+        assert np.array_equal(out, data)
+
+        # the conversion time measured inside the codec
+        stats = CodecStats()
+        codec = WavPack(level=1, stats=stats)
+        for _ in range(repeats):
+            codec.decode(codec.encode(data), out=out)
+        assert np.array_equal(out, data)
+        snapshot = stats.snapshot()
+        codec_mbps = [data.nbytes * repeats / snapshot[operation]["phases"]["convert"] / 1e6
+                      for operation in ("encode", "decode")]
+        results.append(dict(dtype=dtype, reference_mbps=2 * data.nbytes / t_reference / 1e6,
+                            batched_mbps=2 * data.nbytes / t_batched / 1e6, speedup=t_reference / t_batched,
+                            codec_encode_mbps=codec_mbps[0], codec_decode_mbps=codec_mbps[1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--num-samples", type=int, default=30000)
+    parser.add_argument("--num-channels", type=int, default=384)
+    parser.add_argument("--dtypes", nargs="+", default=list(DTYPES))
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.num_samples} samples x {args.num_channels} channels, conversion throughput (MB/s of raw data)")
+    print(f"{'dtype':>8} {'reference':>10} {'batched':>10} {'speedup':>8} {'codec enc':>10} {'codec dec':>10}")
+    for res in run(args.num_samples, args.num_channels, args.dtypes, args.repeats):
+        print(f"{res['dtype']:>8} {res['reference_mbps']:>10.1f} {res['batched_mbps']:>10.1f} "
+              f"{res['speedup']:>8.2f} {res['codec_encode_mbps']:>10.1f} {res['codec_decode_mbps']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
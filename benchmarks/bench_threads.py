@@ -0,0 +1,60 @@
+"""
+Benchmark of the scaling of the Cython WavPack codec with threads.
+
+Encodes and decodes a list of chunks serially and from a pool of Python threads (the WavPack functions
+release the GIL, so that e.g. Zarr/Dask thread pools run several chunks at once), and reports the
+throughput (MB/s of raw data) for each number of threads, with the speedup relative to the first one:
+
+    python benchmarks/bench_threads.py --threads 1 2 4 8 --num-channels 32
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from signals import make_noisy_sin_signals
+from wavpack_cython import WavPack
+
+
+def run(chunks, codec, num_threads):
+    """Returns the encode and decode seconds of the chunks with a pool of num_threads threads"""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        t_start = time.perf_counter()
+        encoded = list(executor.map(codec.encode, chunks))
+        t_encode = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        list(executor.map(codec.decode, encoded))
+        t_decode = time.perf_counter() - t_start
+    return t_encode, t_decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--num-chunks", type=int, default=16)
+    parser.add_argument("--num-samples", type=int, default=30000)
+    parser.add_argument("--num-channels", type=int, default=32)
+    parser.add_argument("--dtype", default="int16")
+    parser.add_argument("--level", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    chunks = [make_noisy_sin_signals((args.num_samples, args.num_channels), dtype=args.dtype, seed=seed)
+              for seed in range(args.num_chunks)]
+    nbytes = sum(chunk.nbytes for chunk in chunks)
+    codec = WavPack(level=args.level)
+    # warm up
+    codec.decode(codec.encode(chunks[0]))
+
+    print(f"{args.num_chunks} chunks of {args.num_samples} samples x {args.num_channels} channels, "
+          f"{args.dtype}, level={args.level}")
+    print(f"{'threads':>7} {'encode MB/s':>12} {'decode MB/s':>12} {'speedup':>8}")
+    t_serial = None
+    for num_threads in args.threads:
+        t_encode, t_decode = map(min, zip(*[run(chunks, codec, num_threads) for _ in range(args.repeats)]))
+        t_serial = t_serial or t_encode + t_decode
+        print(f"{num_threads:>7} {nbytes / t_encode / 1e6:>12.1f} {nbytes / t_decode / 1e6:>12.1f} "
+              f"{t_serial / (t_encode + t_decode):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
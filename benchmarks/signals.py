@@ -0,0 +1,110 @@
+"""
+Signals for the benchmarks: synthetic noisy sines and pluggable loaders of real data.
+
+A signal is described by a spec string, so that it can be (re)created in the worker process that
+runs a benchmark case:
+
+    "sin"                         noisy sines, with the shape and dtype of the case
+    "npy:/path/to/data.npy"       a (num_samples, num_channels) array saved with np.save
+    "raw:/path/to/data.bin"       a flat binary file (e.g. SpikeGLX/Open Ephys), read with the dtype and
+                                  number of channels of the case
+    "my_module:my_loader[:arg]"   any loader importable as module:function, with an optional argument
+
+Loaders receive the part of the spec after the first ":" and the num_samples, num_channels and dtype
+of the case (any of which can be None), and return a 2D array (num_samples, num_channels).
+"""
+import importlib
+
+import numpy as np
+
+
+def make_noisy_sin_signals(shape=(30000,), sin_f=100, sin_amp=50, noise_amp=5,
+                           sample_rate=30000, dtype="int16", seed=None):
+    """Noisy sines with random phases, as in the test suites (unsigned dtypes are centered in their range)"""
+    rng = np.random.default_rng(seed)
+    num_samples = shape[0]
+    num_traces = int(np.prod(shape[1:], dtype="int64"))
+    t = np.arange(num_samples, dtype="float32")[:, None] / sample_rate
+    phases = rng.uniform(0, 2 * np.pi, num_traces).astype("float32")
+    y = np.empty((num_samples, num_traces), dtype=dtype)
+    # generate by blocks of traces to bound the float32 temporaries
+    for start in range(0, num_traces, 64):
+        stop = min(start + 64, num_traces)
+        block = np.sin(2 * np.pi * sin_f * t + phases[start:stop]) * sin_amp
+        block += rng.standard_normal(block.shape, dtype="float32") * noise_amp
+        if y.dtype.kind == "u":
+            block += np.iinfo(y.dtype).max // 2 + 1
+        y[:, start:stop] = block
+    return y.reshape(shape)
+
+
+_loaders = {}
+
+
+def register_loader(name):
+    """Decorator registering a loader under `name`, to be used in specs as "name:argument" """
+    def decorator(func):
+        _loaders[name] = func
+        return func
+    return decorator
+
+
+@register_loader("sin")
+def load_sin(argument, num_samples, num_channels, dtype):
+    seed = int(argument) if argument else 0
+    return make_noisy_sin_signals((num_samples, num_channels), dtype=dtype, seed=seed)
+
+
+@register_loader("npy")
+def load_npy(path, num_samples, num_channels, dtype):
+    data = np.load(path, mmap_mode="r")
+    if data.ndim == 1:
+        data = data[:, None]
+    return _crop(data, num_samples, num_channels, dtype)
+
+
+@register_loader("raw")
+def load_raw(path, num_samples, num_channels, dtype):
+    assert dtype is not None and num_channels is not None, "raw files need a dtype and a number of channels"
+    data = np.memmap(path, dtype=dtype, mode="r")
+    data = data[:data.size - data.size % num_channels].reshape(-1, num_channels)
+    return _crop(data, num_samples, num_channels, dtype)
+
+
+def _crop(data, num_samples, num_channels, dtype):
+    if num_samples is not None:
+        data = data[:num_samples]
+    if num_channels is not None:
+        if data.shape[1] < num_channels:
+            raise ValueError(f"The data has only {data.shape[1]} channels, {num_channels} were requested")
+        data = data[:, :num_channels]
+    if dtype is not None and data.dtype != np.dtype(dtype):
+        raise ValueError(f"The data has dtype {data.dtype}, {dtype} was requested")
+    return np.ascontiguousarray(data)
+
+
+def load_signal(spec, num_samples=None, num_channels=None, dtype=None):
+    """
+    Creates or loads the signal described by `spec`.
+
+    Parameters
+    ----------
+    spec : str
+        The signal spec ("sin", "npy:<path>", "raw:<path>" or "<module>:<function>[:<argument>]")
+    num_samples, num_channels : int or None
+        The number of samples and channels to generate or to crop the data to
+    dtype : str or None
+        The dtype to generate or to read (for raw files)
+
+    Returns
+    -------
+    np.array
+        The 2D signal (num_samples, num_channels)
+    """
+    name, _, argument = spec.partition(":")
+    if name in _loaders:
+        loader = _loaders[name]
+    else:
+        func_name, _, argument = argument.partition(":")
+        loader = getattr(importlib.import_module(name), func_name)
+    return loader(argument, num_samples, num_channels, dtype)
@@ -1,7 +1,11 @@
-from wavpack_numcodecs import WavPackCodec
+from wavpack_numcodecs import (WavPackCodec, WavPackAutoCodec, CodecStats, get_process_pool, get_wavpack_capabilities,
+                               get_max_channels, has_cython_backend)
+import wavpack_numcodecs.wavpack as wavpack_module
 import numpy as np
 import zarr
 import pytest
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 DEBUG = False
 
@@ -132,7 +136,204 @@ def test_wavpack_zarr():
                 if np.dtype(dtype).kind != "f":
                     assert z.nbytes_stored < z.nbytes
 
+@pytest.mark.numcodecs
+def test_wavpack_process_pool():
+    pool = get_process_pool()
+    codec = WavPackCodec(dtype="int16", process_pool_size=2, debug=DEBUG)
+    chunks = [make_noisy_sin_signals(shape=(3000, 10), dtype="int16") for _ in range(8)]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        encoded = list(executor.map(codec.encode, chunks))
+        decoded = list(executor.map(codec.decode, encoded))
+    for chunk, enc, dec in zip(chunks, encoded, decoded):
+        assert np.all(dec.reshape(chunk.shape) == chunk)
+        assert enc == WavPackCodec(dtype="int16").encode(chunk)
+
+    # idle processes are replenished in the background
+    dec_cmd = codec.base_dec_cmd + ["--raw", "-", "-o", "-"]
+    for _ in range(100):
+        if pool.num_idle(dec_cmd) == 2:
+            break
+        time.sleep(0.05)
+    assert pool.num_idle(dec_cmd) == 2
+
+    # crashed idle processes are discarded and replaced
+    procs = [pool.acquire(dec_cmd, 2) for _ in range(2)]
+    assert all(proc.poll() is None for proc in procs)
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+        pool.release(dec_cmd, proc)
+    procs = [pool.acquire(dec_cmd, 2) for _ in range(2)]
+    assert all(proc.poll() is None for proc in procs)
+    for proc in procs:
+        pool.release(dec_cmd, proc)
+    dec = codec.decode(encoded[0])
+    assert np.all(dec.reshape(chunks[0].shape) == chunks[0])
+    pool.clear()
+    assert pool.num_idle() == 0
+
+    # command lines used once (e.g. of edge chunk shapes) are spawned on demand, without idle processes
+    edge_codec = WavPackCodec(dtype="int16", process_pool_size=2, debug=DEBUG)
+    edge_chunk = make_noisy_sin_signals(shape=(1234, 10), dtype="int16")
+    assert np.all(edge_codec.decode(edge_codec.encode(edge_chunk)).reshape(edge_chunk.shape) == edge_chunk)
+    time.sleep(0.2)
+    assert pool.num_idle() == 0
+    pool.clear()
+
+@pytest.mark.numcodecs
+def test_wavpack_channel_blocks():
+    codec = WavPackCodec(dtype="int16", debug=DEBUG)
+
+    # non-contiguous views are encoded as their contiguous copies
+    data = make_noisy_sin_signals(shape=(3000, 20), dtype="int16")
+    enc = codec.encode(data[:, ::2])
+    assert enc == codec.encode(np.ascontiguousarray(data[:, ::2]))
+    assert np.all(codec.decode(enc).reshape(3000, 10) == data[:, ::2])
+
+    # more channels than supported by the CLI are encoded in channel blocks
+    nchans = codec.max_channels + 10
+    data = make_noisy_sin_signals(shape=(1000, nchans), dtype="int16")
+    enc = codec.encode(data)
+    assert enc[:4] == b"wvpx"
+    dec = codec.decode(enc)
+    assert np.all(dec.reshape(data.shape) == data)
+    out = np.empty_like(data)
+    codec.decode(enc, out=out)
+    assert np.all(out == data)
+
+
+@pytest.mark.numcodecs
+def test_wavpack_cython_containers():
+    from wavpack_common.container import pack_container, unpack_container
+
+    codec = WavPackCodec(dtype="int16", debug=DEBUG)
+    data = make_noisy_sin_signals(shape=(1000, codec.max_channels + 10), dtype="int16")
+    header, streams = unpack_container(codec.encode(data))
+    # containers of the cython backend that the CLI cannot invert are rejected instead of misdecoded
+    for key, value in [("prefilter", "delta"), ("quantize", {"dtype": "int16", "scale": [1.0], "offset": [0.0]}),
+                       ("correction", True)]:
+        with pytest.raises(ValueError, match=key):
+            codec.decode(pack_container(dict(header, **{key: value}), streams))
+    if has_cython_backend():
+        from wavpack_cython import WavPack
+        data = make_noisy_sin_signals(shape=(3000, 8), dtype="int16")
+        for kwargs in [dict(prefilter="delta"), dict(max_error=1e-3), dict(bps=3, correction=True)]:
+            chunk = data.astype("float32") / 1000 if "max_error" in kwargs else data
+            enc = WavPack(level=2, channel_group_size=4, **kwargs).encode(chunk)
+            with pytest.raises(ValueError, match="cython backend"):
+                codec.decode(enc)
+
+
+@pytest.mark.numcodecs
+def test_wavpack_capabilities_cache(monkeypatch):
+    capabilities = get_wavpack_capabilities()
+    assert get_wavpack_capabilities() is capabilities
+    assert get_max_channels() == capabilities.max_channels
+
+    # once probed, building codecs does not spawn any process
+    def no_subprocess(*args, **kwargs):
+        raise AssertionError("unexpected subprocess call")
+    monkeypatch.setattr(wavpack_module.subprocess, "run", no_subprocess)
+    for _ in range(10):
+        codec = WavPackCodec(dtype="int16")
+        assert codec.max_channels == capabilities.max_channels
+        assert WavPackCodec.get_max_cli_channels() == capabilities.max_channels
+
+
+@pytest.mark.numcodecs
+def test_wavpack_stats():
+    data = make_noisy_sin_signals(shape=(30000, 8), dtype="int16")
+    events = []
+    stats = CodecStats(callbacks=[events.append])
+    codec = WavPackCodec(dtype="int16", stats=stats)
+    enc = codec.encode(data)
+    codec.decode(enc)
+    codec.decode(enc)
+
+    snapshot = stats.snapshot()
+    assert snapshot["encode"]["calls"] == 1 and snapshot["decode"]["calls"] == 2
+    assert snapshot["encode"]["bytes_in"] == data.nbytes and snapshot["encode"]["bytes_out"] == len(enc)
+    assert snapshot["decode"]["bytes_out"] == 2 * data.nbytes
+    assert snapshot["encode"]["ratio"] == pytest.approx(data.nbytes / len(enc))
+    assert 0 < snapshot["encode"]["phases"]["subprocess"] <= snapshot["encode"]["seconds"]
+    assert sum(snapshot["decode"]["latency_counts"]) == 2
+    assert [event["operation"] for event in events] == ["encode", "decode", "decode"]
+
+    stats.reset()
+    assert stats.snapshot() == {}
+    assert WavPackCodec(dtype="int16").stats is None
+
+
+@pytest.mark.numcodecs
+def test_wavpack_streaming():
+    codec = WavPackCodec(dtype="int16", debug=DEBUG)
+    data = make_noisy_sin_signals(shape=(100000, 6), dtype="int16")
+    enc = codec.encode(data)
+    # the decoded size is read from the blocks of the stream
+    assert wavpack_module._stream_info(enc)[:3] == data.shape + (2,)
+    assert wavpack_module._stream_info(b"not a wavpack stream") is None
+
+    # contiguous outputs are decoded in place, others are copied
+    out = np.empty_like(data)
+    assert codec.decode(enc, out=out) is out
+    assert np.all(out == data)
+    big = np.zeros((100000, 12), dtype="int16")
+    codec.decode(enc, out=big[:, ::2])
+    assert np.all(big[:, ::2] == data) and np.all(big[:, 1::2] == 0)
+    with pytest.raises(ValueError):
+        codec.decode(enc, out=np.empty((10, 6), dtype="int16"))
+
+
+@pytest.mark.numcodecs
+def test_wavpack_auto_codec():
+    import numcodecs
+
+    # the front-end has its own codec id: the "wavpack" configs keep resolving to the codecs of the packages
+    assert numcodecs.registry.codec_registry["wavpack_auto"] is WavPackAutoCodec
+    assert numcodecs.registry.codec_registry["wavpack"] is not WavPackAutoCodec
+    backends = ["cython", "cli"] if has_cython_backend() else ["cli"]
+    assert WavPackAutoCodec().backend == backends[0]
+    data = make_noisy_sin_signals(shape=(20000, 6), dtype="int16")
+
+    # configs of the CLI codec are read by the front-end, which decodes and encodes chunks as the CLI
+    for dtype in ["int16", "uint16", "float32"]:
+        cli_data = data.astype(dtype) + (30000 if dtype == "uint16" else 0)
+        cli_codec = WavPackCodec(dtype=dtype, compression_mode="h")
+        codec = WavPackAutoCodec.from_config(cli_codec.get_config())
+        config = codec.get_config()
+        assert config == dict(cli_codec.get_config(), id="wavpack_auto")
+        assert numcodecs.get_codec(config).get_config() == config
+        for backend in backends:
+            codec = WavPackAutoCodec(backend=backend, cli_config=cli_codec.get_config())
+            assert np.all(codec.decode(cli_codec.encode(cli_data)).reshape(cli_data.shape) == cli_data)
+            assert np.all(cli_codec.decode(codec.encode(cli_data)).reshape(cli_data.shape) == cli_data)
+
+    # the config of the in-process codec, with chunks decodable by both backends
+    config = WavPackAutoCodec(level=2, block_samples=4096).get_config()
+    assert numcodecs.get_codec(config).get_config() == config
+    if has_cython_backend():
+        from wavpack_cython import WavPack
+        assert config == dict(WavPack(level=2, block_samples=4096).get_config(), id="wavpack_auto")
+    for backend in backends:
+        enc = WavPackAutoCodec(level=2, backend=backend).encode(data)
+        for other in backends:
+            dec = WavPackAutoCodec(level=2, backend=other).decode(enc)
+            assert np.all(np.asarray(dec).reshape(data.shape) == data)
+
+    # options changing the chunk format and dtypes stored differently by the CLI need the in-process backend
+    with pytest.raises(ValueError):
+        WavPackAutoCodec(prefilter="median", backend="cli")
+    with pytest.raises(ValueError):
+        WavPackAutoCodec(backend="cli").encode(data.astype("uint16"))
+
 
 if __name__ == '__main__':
     test_wavpack_numcodecs()
     test_wavpack_zarr()
+    test_wavpack_process_pool()
+    test_wavpack_channel_blocks()
+    test_wavpack_cython_containers()
+    test_wavpack_stats()
+    test_wavpack_streaming()
+    test_wavpack_auto_codec()
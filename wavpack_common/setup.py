@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from setuptools import setup, find_packages
+
+def open_requirements(fname):
+    with open(fname, mode='r') as f:
+        requires = f.read().split('\n')
+    requires = [e for e in requires if len(e) > 0 and not e.startswith('#')]
+    return requires
+
+version = "0.1.0"
+long_description = open("README.md").read()
+
+install_requires = open_requirements('requirements.txt')
+
+setup(
+    name="wavpack_common",
+    version=version,
+    author="Alessio Buccino",
+    author_email="alessiop.buccino@gmail.com",
+    description="Chunk container format and statistics shared by the WavPack numcodecs codecs.",
+    long_description=long_description,
+    long_description_content_type="text/markdown",
+    url="https://github.com/AllenNeuralDynamics/wavpack_numcodecs",
+    install_requires=install_requires,
+    classifiers=[
+        "Programming Language :: Python :: 3",
+        "License :: OSI Approved :: MIT License",
+        "Operating System :: OS Independent",
+    ],
+    packages=find_packages(),
+)
@@ -0,0 +1,6 @@
+"""
+Helpers shared by the `wavpack_numcodecs` (CLI) and `wavpack_cython` (in-process) codecs, so that chunks and
+statistics are the same for both.
+
+This package has no dependency on either codec, and importing it has no side effect (e.g. no codec registration).
+"""
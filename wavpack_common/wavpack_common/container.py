@@ -0,0 +1,111 @@
+"""
+Container format for chunks made of several WavPack streams.
+
+Plain chunks are a single WavPack stream (starting with b"wvpk"). When a chunk needs more than one
+stream or extra metadata (e.g. channel groups), the streams are wrapped in a container:
+
+    magic       4 bytes     b"wvpx"
+    header_size 4 bytes     uint32, little-endian
+    header      header_size bytes of UTF-8 JSON
+    payload     concatenation of the segments
+
+The JSON header holds a "segments" list with the [offset, size] of each segment in the payload,
+so that segments can be addressed without reading the others.
+
+This is the single definition of the format, used by both the `wavpack_numcodecs` and the `wavpack_cython`
+codecs, so that chunks are interchangeable between them.
+"""
+import json
+import struct
+
+import numpy as np
+
+
+CONTAINER_MAGIC = b"wvpx"
+CONTAINER_VERSION = 1
+_prefix = struct.Struct("<4sI")
+
+
+def is_container(buf):
+    """Returns True if the encoded buffer is a container, False if it is a plain WavPack stream"""
+    return np.frombuffer(buf, dtype="uint8")[:4].tobytes() == CONTAINER_MAGIC
+
+
+def header_size(buf):
+    """
+    Returns the number of leading bytes of a container that hold its header, i.e. the offset of the payload.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        The container, or its first bytes (at least 8)
+
+    Returns
+    -------
+    int
+        The size of the magic, the header size and the JSON header
+    """
+    view = np.frombuffer(buf, dtype="uint8")
+    if view.size < _prefix.size:
+        raise ValueError(f"The first {_prefix.size} bytes of a container are needed to read its header size, "
+                         f"got {view.size}")
+    magic, json_size = _prefix.unpack_from(view)
+    if magic != CONTAINER_MAGIC:
+        raise ValueError("The buffer is not a WavPack container")
+    return _prefix.size + json_size
+
+
+def pack_container(header, segments):
+    """
+    Packs segments and a JSON-serializable header into a container.
+
+    Parameters
+    ----------
+    header : dict
+        The container metadata
+    segments : list of bytes-like
+        The segments (e.g. WavPack streams) to store
+
+    Returns
+    -------
+    bytes
+        The container
+    """
+    header = dict(header, version=CONTAINER_VERSION)
+    offsets = []
+    offset = 0
+    for segment in segments:
+        size = memoryview(segment).nbytes
+        offsets.append([offset, size])
+        offset += size
+    header["segments"] = offsets
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return b"".join([_prefix.pack(CONTAINER_MAGIC, len(header_bytes)), header_bytes] + list(segments))
+
+
+def unpack_container(buf):
+    """
+    Parses a container without copying its segments.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        The container
+
+    Returns
+    -------
+    header : dict
+        The container metadata
+    segments : list of memoryview
+        Zero-copy views of the segments
+    """
+    view = memoryview(np.frombuffer(buf, dtype="uint8"))
+    payload_start = header_size(view)
+    if view.nbytes < payload_start:
+        raise ValueError(f"The first {payload_start} bytes of the container are needed to read its header, "
+                         f"got {view.nbytes}")
+    header = json.loads(bytes(view[_prefix.size:payload_start]).decode("utf-8"))
+    if header["version"] > CONTAINER_VERSION:
+        raise ValueError(f"Unsupported WavPack container version {header['version']}")
+    segments = [view[payload_start + offset:payload_start + offset + size] for offset, size in header["segments"]]
+    return header, segments
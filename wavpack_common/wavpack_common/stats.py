@@ -0,0 +1,140 @@
+"""
+Opt-in instrumentation of the codecs: cumulative counters, latency histograms and callbacks.
+
+A `CodecStats` collector is passed to a codec with `stats=`. Each encode/decode call is then recorded with its
+duration, the bytes in and out, and the time spent in its phases (e.g. "convert" and "codec" for the time
+converting samples and in the WavPack library, or "subprocess" for the time running the CLI). Collectors are
+thread-safe, and can be shared by codecs, including codecs of the two packages:
+
+    stats = CodecStats(callbacks=[export_to_metrics])
+    codec = WavPack(level=2, stats=stats)
+    cli_codec = WavPackCodec(dtype="int16", stats=stats)
+    ...
+    print(stats.snapshot()["encode"]["mbps"])
+
+Without a collector (the default), codecs only test `stats is None` on each call.
+"""
+import bisect
+import copy
+import threading
+
+
+# operations that only decode a part of the encoded data, for which no compression ratio is computed
+PARTIAL_OPERATIONS = ("decode_partial", "decode_channels")
+
+# upper bounds (in seconds) of the latency histogram buckets, the last bucket holding the slower calls
+LATENCY_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CodecStats:
+    """
+    Thread-safe collector of codec call statistics.
+
+    Parameters
+    ----------
+    callbacks : list of callable or None, optional
+        Functions called with a dict describing each recorded call (operation, seconds, bytes_in, bytes_out
+        and phases), e.g. to export to a metrics system. They are called outside of the lock, from the thread
+        that made the call, by default None
+    """
+    def __init__(self, callbacks=None):
+        self._lock = threading.Lock()
+        self._callbacks = list(callbacks or [])
+        self._operations = {}
+
+    def add_callback(self, callback):
+        """Adds a function called with each recorded call"""
+        with self._lock:
+            self._callbacks = self._callbacks + [callback]
+
+    def remove_callback(self, callback):
+        """Removes a callback added with `add_callback`"""
+        with self._lock:
+            self._callbacks = [cb for cb in self._callbacks if cb is not callback]
+
+    def record(self, operation, seconds, bytes_in, bytes_out, phases=None):
+        """
+        Records a call.
+
+        Parameters
+        ----------
+        operation : str
+            The operation (e.g. "encode", "decode_partial")
+        seconds : float
+            The duration of the call
+        bytes_in : int
+            The number of bytes passed to the call (raw data for encoding, encoded data for decoding)
+        bytes_out : int
+            The number of bytes returned by the call
+        phases : dict or None, optional
+            The seconds spent in the phases of the call, by default None
+        """
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            counters = self._operations.get(operation)
+            if counters is None:
+                counters = self._operations[operation] = dict(
+                    calls=0, seconds=0.0, bytes_in=0, bytes_out=0, phases={},
+                    latency_counts=[0] * (len(LATENCY_BUCKETS) + 1)
+                )
+            counters["calls"] += 1
+            counters["seconds"] += seconds
+            counters["bytes_in"] += bytes_in
+            counters["bytes_out"] += bytes_out
+            counters["latency_counts"][bucket] += 1
+            if phases:
+                for phase, phase_seconds in phases.items():
+                    counters["phases"][phase] = counters["phases"].get(phase, 0.0) + phase_seconds
+            callbacks = self._callbacks
+
+        if callbacks:
+            event = dict(operation=operation, seconds=seconds, bytes_in=bytes_in, bytes_out=bytes_out,
+                         phases=dict(phases or {}))
+            for callback in callbacks:
+                callback(event)
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters.
+
+        Returns
+        -------
+        dict
+            For each operation, a dict with the number of calls, the total seconds, bytes_in and bytes_out,
+            the seconds of each phase, the latency_counts of each bucket of `latency_buckets` (the last count
+            is for slower calls), the throughput "mbps" (MB/s of raw data) and the compression "ratio" (None
+            for partial decoding)
+        """
+        with self._lock:
+            operations = copy.deepcopy(self._operations)
+        for operation, counters in operations.items():
+            encoding = operation.startswith("encode")
+            raw_bytes, encoded_bytes = ((counters["bytes_in"], counters["bytes_out"]) if encoding else
+                                        (counters["bytes_out"], counters["bytes_in"]))
+            counters["latency_buckets"] = list(LATENCY_BUCKETS)
+            counters["mbps"] = raw_bytes / counters["seconds"] / 1e6 if counters["seconds"] > 0 else None
+            partial = operation in PARTIAL_OPERATIONS
+            counters["ratio"] = raw_bytes / encoded_bytes if encoded_bytes > 0 and not partial else None
+        return operations
+
+    def reset(self):
+        """Clears all the counters"""
+        with self._lock:
+            self._operations = {}
+
+    def __getstate__(self):
+        # the lock is not picklable: it is recreated when unpickling
+        state = self.__dict__.copy()
+        with self._lock:
+            state["_operations"] = copy.deepcopy(self._operations)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        with self._lock:
+            calls = {operation: counters["calls"] for operation, counters in self._operations.items()}
+        return f"CodecStats({calls})"
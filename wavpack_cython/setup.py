@@ -25,7 +25,8 @@ long_description = open("README.md").read()
 
 pkg_folder = Path(__file__).parent
 
-entry_points = None
+# the Zarr v3 codec is found by zarr>=3 without importing wavpack_cython.zarr3
+entry_points = {"zarr.codecs": ["wavpack = wavpack_cython.zarr3:WavPackZarr3"]}
 
 install_requires = open_requirements('requirements.txt')
 wavpack_headers_folder = pkg_folder / "include"
@@ -35,9 +36,12 @@ include_dirs = [str(wavpack_headers_folder)]
 
 runtime_library_dirs = []
 extra_link_args = []
+# OpenMP is used by the batch (encode_many / decode_many) functions
+extra_compile_args = []
 
 if platform.system() == "Linux":
     libraries=["wavpack"]
+    extra_compile_args = ["-fopenmp"]
     if shutil.which("wavpack") is not None:
         print("wavpack is installed!")
         extra_link_args=["-L/usr/local/lib/", "-L/usr/bin/"]
@@ -49,6 +53,7 @@ if platform.system() == "Linux":
         # hack
         shutil.copy(str(pkg_folder / 'libraries' / 'linux-x86_64' / 'libwavpack.so'),
                     str(pkg_folder / 'libraries' / 'linux-x86_64' / 'libwavpack.so.1'))
+    extra_link_args += ["-fopenmp"]
 elif platform.system() == "Darwin":
     libraries=["wavpack"]
     assert shutil.which("wavpack") is not None, ("wavpack need to be installed externally. "
@@ -64,6 +69,7 @@ else: # windows
     else:
         lib_path = Path("libraries") / "windows-x86_32"
     extra_link_args=[f"/LIBPATH:{str(lib_path)}"]
+    extra_compile_args = ["/openmp"]
     for libfile in lib_path.iterdir():
         shutil.copy(libfile, "wavpack_cython")
 
@@ -75,6 +81,7 @@ extensions = [
                   sources=sources,
                   include_dirs=include_dirs,
                   libraries=libraries,
+                  extra_compile_args=extra_compile_args,
                   extra_link_args=extra_link_args,
                   runtime_library_dirs=runtime_library_dirs
                   ),
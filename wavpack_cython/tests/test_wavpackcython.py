@@ -1,7 +1,12 @@
-from wavpack_cython import WavPack
+from wavpack_cython import WavPack, WavPackStreamEncoder, CodecStats, iter_decode, tune
 import numpy as np
 import zarr
 import pytest
+import os
+import struct
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 DEBUG = False
 
@@ -17,8 +22,8 @@ def run_all_options(data):
             enc = cod.encode(data)
             dec = cod.decode(enc)
 
-            assert len(enc) < len(dec)
-            print("CR", len(dec) / len(enc))
+            assert len(enc) < dec.nbytes
+            print("CR", dec.nbytes / len(enc))
             dec_dtype = np.frombuffer(dec, dtype=dtype)
 
             data_dec = np.frombuffer(dec, dtype=dtype).reshape(data.shape)
@@ -61,6 +66,34 @@ def generate_test_signals(dtype):
 
     return [test1d, test1d_long, test2d, test2d_long, test2d_extra, test3d]
 
+
+def rebase_blocks(stream, first_frame, total_frames):
+    # shifts the blocks of a stream to first_frame of a stream of total_frames frames, recomputing their checksums
+    # (which cover the header), so that streams of different block sizes can be joined
+    stream = bytearray(stream)
+    offset = 0
+    while offset < len(stream):
+        end = offset + struct.unpack_from("<I", stream, offset + 4)[0] + 8
+        struct.pack_into("<I", stream, offset + 12, total_frames)
+        struct.pack_into("<I", stream, offset + 16, struct.unpack_from("<I", stream, offset + 16)[0] + first_frame)
+        position = offset + 32
+        while position + 2 <= end:
+            meta_start, meta_id, size = position, stream[position], stream[position + 1] * 2
+            position += 2
+            if meta_id & 0x80:
+                size += (stream[position] << 9) + (stream[position + 1] << 17)
+                position += 2
+            if meta_id & 0x3f == 0x2f and size in (2, 4):
+                checksum = 0xFFFFFFFF
+                for word in struct.unpack_from(f"<{(meta_start - offset) // 2}H", stream, offset):
+                    checksum = (checksum * 3 + word) & 0xFFFFFFFF
+                if size == 2:
+                    checksum ^= checksum >> 16
+                stream[position:position + size] = checksum.to_bytes(4, "little")[:size]
+            position += size
+        offset = end
+    return bytes(stream)
+
 @pytest.mark.numcodecs
 def test_wavpack_cython():
     for dtype in dtypes:
@@ -121,7 +154,613 @@ def test_wavpack_zarr():
                 assert z[:100, :2, :2].shape == test_sig[:100, :2, :2].shape
 
 
+@pytest.mark.numcodecs
+def test_wavpack_multithreading():
+    num_threads = 4
+    chunks = [make_noisy_sin_signals(shape=(30000, 32), dtype="int16") for _ in range(4 * num_threads)]
+    codec = WavPack(level=2)
+
+    encoded = [codec.encode(chunk) for chunk in chunks]
+    # chunks encoded and decoded concurrently (with the GIL released) are the same as serially
+    # (the speedup is measured by benchmarks/bench_threads.py)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        encoded_mt = list(executor.map(codec.encode, chunks))
+        decoded_mt = list(executor.map(codec.decode, encoded_mt))
+
+    for chunk, enc, enc_mt, dec_mt in zip(chunks, encoded, encoded_mt, decoded_mt):
+        assert enc == enc_mt
+        assert np.all(np.frombuffer(dec_mt, dtype=chunk.dtype).reshape(chunk.shape) == chunk)
+
+
+@pytest.mark.numcodecs
+def test_wavpack_decode_partial():
+    for dtype in dtypes:
+        data = make_noisy_sin_signals(shape=(300000, 4), dtype=dtype)
+        codec = WavPack(level=2)
+        enc = codec.encode(data)
+        # ranges within a block, across blocks, and past the end of the chunk
+        for start, stop in [(0, 10), (74990, 75010), (120000, 120300), (299990, 400000), (300000, 300010)]:
+            dec = codec.decode_partial(enc, start, stop)
+            data_dec = np.frombuffer(dec, dtype=dtype).reshape(-1, data.shape[1])
+            assert np.all(data_dec == data[start:stop])
+
+        out = np.zeros((300, 4), dtype=dtype)
+        codec.decode_partial(enc, 1000, 1300, out=out)
+        assert np.all(out == data[1000:1300])
+
+        with pytest.raises(ValueError):
+            codec.decode_partial(enc, 100, 10)
+
+@pytest.mark.numcodecs
+def test_wavpack_channel_groups():
+    for dtype in dtypes:
+        data = make_noisy_sin_signals(shape=(3000, 70), dtype=dtype)
+        codec = WavPack(channel_group_size=16)
+        enc = codec.encode(data)
+        dec = codec.decode(enc)
+        assert np.all(np.frombuffer(dec, dtype=dtype).reshape(data.shape) == data)
+
+        for channels in [[3], [0, 17, 69], slice(10, 40), 20]:
+            dec_channels = codec.decode_channels(enc, channels)
+            assert np.all(dec_channels == data[:, np.atleast_1d(np.arange(70)[channels])])
+        dec_range = codec.decode_partial(enc, 100, 200)
+        assert np.all(dec_range == data[100:200])
+
+        # plain streams also support channel selection
+        enc_plain = WavPack().encode(data)
+        assert np.all(WavPack().decode_channels(enc_plain, [3, 40]) == data[:, [3, 40]])
+
+    data = make_noisy_sin_signals(shape=(3000, 100), dtype="int16")
+    z = zarr.array(data, chunks=(1000, None), compressor=WavPack(channel_group_size=32))
+    assert np.all(z[:] == data)
+    assert z.nbytes > z.nbytes_stored
+
+@pytest.mark.numcodecs
+def test_wavpack_decoded_size():
+    codec = WavPack()
+    for dtype in dtypes:
+        # constant signals compress by far more than 10x
+        data = np.zeros((100000, 4), dtype=dtype)
+        data[::1000] = 1
+        enc = codec.encode(data)
+        assert len(enc) * 10 < data.nbytes
+        dec = codec.decode(enc)
+        assert isinstance(dec, np.ndarray)
+        assert dec.dtype == data.dtype
+        assert dec.shape == data.shape
+        assert np.all(dec == data)
+
+    # streams truncated at a block boundary, and destinations smaller than the stream, are errors
+    data = make_noisy_sin_signals(shape=(30000, 2), dtype="int16")
+    enc = WavPack(block_samples=10000).encode(data)
+    truncated = enc[:enc.index(b"wvpk", 4)]
+    for decode in [codec.decode, lambda buf: codec.decode(buf, out=np.zeros_like(data)),
+                   lambda buf: codec.decode_many([buf])]:
+        with pytest.raises(RuntimeError):
+            decode(truncated)
+    with pytest.raises(ValueError):
+        codec.decode(enc, out=np.zeros((20000, 2), dtype="int16"))
+
+@pytest.mark.numcodecs
+def test_wavpack_incompressible():
+    rng = np.random.default_rng(0)
+    for dtype in dtypes:
+        for shape in [(50000, 2), (1000, 64), (3, 300)]:
+            if dtype == "float32":
+                # random bit patterns, excluding nan/inf
+                data = rng.integers(0, 2 ** 32, size=shape, dtype=np.uint64).astype(np.uint32).view(np.float32)
+                data[~np.isfinite(data)] = 0
+            else:
+                info = np.iinfo(dtype)
+                data = rng.integers(info.min, info.max, size=shape, endpoint=True).astype(dtype)
+            for level in [1, 4]:
+                codec = WavPack(level=level)
+                enc = codec.encode(data)
+                dec = codec.decode(enc)
+                assert np.all(dec.view(data.dtype).reshape(data.shape).view(np.uint8) == data.view(np.uint8))
+
+@pytest.mark.numcodecs
+def test_wavpack_encode_decode_many():
+    for dtype in dtypes:
+        chunks = [make_noisy_sin_signals(shape=(3000, 10), dtype=dtype) for _ in range(6)]
+        chunks.append(make_noisy_sin_signals(shape=(500, 3), dtype=dtype))
+        for codec in [WavPack(level=2), WavPack(channel_group_size=4)]:
+            encoded = codec.encode_many(chunks, num_threads=2)
+            assert encoded == [codec.encode(chunk) for chunk in chunks]
+
+            decoded = codec.decode_many(encoded)
+            for chunk, dec in zip(chunks, decoded):
+                assert np.all(dec == chunk)
+
+            outs = [np.zeros_like(chunk) for chunk in chunks]
+            decoded = codec.decode_many(encoded, outs=outs)
+            for chunk, out, dec in zip(chunks, outs, decoded):
+                assert dec is out
+                assert np.all(out == chunk)
+    assert WavPack().encode_many([]) == []
+
+@pytest.mark.numcodecs
+def test_wavpack_unsigned():
+    for dtype in ["uint8", "uint16", "uint32"]:
+        info = np.iinfo(dtype)
+        signed_dtype = dtype[1:]
+        # noisy sines around the middle of the unsigned range, plus the extreme values
+        data = make_noisy_sin_signals(shape=(20000, 8), dtype=signed_dtype).astype(dtype)
+        data += np.array(info.max // 2 + 1, dtype=dtype)
+        data[:10] = info.min
+        data[10:20] = info.max
+        codec = WavPack(level=2)
+        enc = codec.encode(data)
+        assert len(enc) < data.nbytes
+
+        dec = codec.decode(enc)
+        assert dec.dtype == data.dtype
+        assert np.all(dec.reshape(data.shape) == data)
+
+        out = np.zeros_like(data)
+        assert codec.decode(enc, out=out) is out
+        assert np.all(out == data)
+        assert np.all(codec.decode_partial(enc, 5, 15000) == data[5:15000])
+
+        # the same values encoded as signed data compress to the same size
+        signed = (data.astype("int64") - (info.max // 2 + 1)).astype(signed_dtype)
+        assert abs(len(codec.encode(signed)) - len(enc)) < 0.01 * len(enc)
+
+@pytest.mark.numcodecs
+def test_wavpack_stream_encoder():
+    for dtype in dtypes + ["uint16"]:
+        data = make_noisy_sin_signals(shape=(50000, 8), dtype=dtype)
+        blocks = []
+        with WavPackStreamEncoder(8, dtype, block_samples=2048, callback=blocks.append) as encoder:
+            start = 0
+            for num_frames in [1, 15, 2048, 10000, 30000]:
+                encoder.write(data[start:start + num_frames])
+                start += num_frames
+                # finished blocks are emitted as frames are written, the last partial block is kept
+                assert encoder.num_frames == start
+            encoder.write(data[start:])
+            num_blocks_before_close = len(blocks)
+        assert encoder.closed
+        assert len(blocks) > num_blocks_before_close > 1
+        assert encoder.bytes_written == sum(len(block) for block in blocks)
+
+        stream = b"".join(blocks)
+        codec = WavPack()
+        assert np.all(codec.decode(stream) == data)
+        assert np.all(codec.decode_partial(stream, 20000, 25000) == data[20000:25000])
+
+    # without callback, blocks are queued and retrieved by iterating
+    data = make_noisy_sin_signals(shape=(10000,), dtype="int16")
+    encoder = WavPackStreamEncoder(1, "int16", level=2)
+    encoder.write(data)
+    blocks = list(encoder)
+    encoder.close()
+    blocks += list(encoder)
+    assert list(encoder) == []
+    assert np.all(WavPack().decode(b"".join(blocks))[:, 0] == data)
+
+    with pytest.raises(ValueError):
+        encoder.write(data)
+    with pytest.raises(ValueError):
+        WavPackStreamEncoder(1, "int16").write(data.astype("int32"))
+
+    # the last block is not flushed when the write loop fails
+    blocks = []
+    with pytest.raises(KeyboardInterrupt):
+        with WavPackStreamEncoder(1, "int16", block_samples=2048, callback=blocks.append) as encoder:
+            encoder.write(data)
+            num_blocks = len(blocks)
+            raise KeyboardInterrupt
+    assert encoder.closed
+    assert len(blocks) == num_blocks
+
+@pytest.mark.numcodecs
+def test_wavpack_iter_decode():
+    for dtype in dtypes:
+        data = make_noisy_sin_signals(shape=(30000, 20), dtype=dtype)
+        for codec in [WavPack(), WavPack(channel_group_size=8)]:
+            enc = codec.encode(data)
+            steps = []
+            for step in codec.iter_decode(enc, 4000):
+                assert step.shape[0] <= 4000
+                steps.append(step.copy())
+            assert len(steps) == 8
+            assert np.all(np.concatenate(steps) == data)
+
+            # steps are decoded into consecutive regions of the ring buffer
+            ring_buffer = np.zeros((3 * 4000, 20), dtype=dtype)
+            for i, step in enumerate(codec.iter_decode(enc, 4000, ring_buffer=ring_buffer)):
+                assert np.shares_memory(step, ring_buffer)
+                assert np.all(step == data[i * 4000:(i + 1) * 4000])
+                if i >= 2 and len(step) == 4000:
+                    assert np.all(ring_buffer == np.roll(data[(i - 2) * 4000:(i + 1) * 4000], 
+                                                         (i + 1) * 4000, axis=0))
+
+        # a single step, past the end of the stream
+        enc = WavPack().encode(data)
+        assert np.all(np.concatenate(list(iter_decode(enc, 30000))) == data)
+
+    with pytest.raises(ValueError):
+        iter_decode(enc, 4000, ring_buffer=np.zeros((5000, 20), dtype=dtype))
+    with pytest.raises(ValueError):
+        iter_decode(enc, 0)
+
+
+@pytest.mark.numcodecs
+def test_wavpack_advanced_config():
+    import numcodecs
+
+    data = make_noisy_sin_signals(shape=(30000, 8), dtype="int16")
+    default_enc = WavPack().encode(data)
+
+    for kwargs in [dict(block_samples=1000), dict(extra=2), dict(level=3, extra=6),
+                   dict(joint_stereo=True), dict(joint_stereo=False), dict(verify_checksum=False)]:
+        cod = WavPack(**kwargs)
+        config = cod.get_config()
+        assert numcodecs.get_codec(config).get_config() == config
+        enc = cod.encode(data)
+        assert np.all(cod.decode(enc) == data)
+        assert np.all(cod.decode_partial(enc, 2500, 2600) == data[2500:2600])
+
+    # the checksum verification is chosen by each reader, and not stored in the config
+    assert "verify_checksum" not in WavPack(verify_checksum=False).get_config()
+
+    # smaller blocks cost some compression, the extra modes improve it
+    assert len(WavPack(block_samples=1000).encode(data)) > len(default_enc)
+    assert len(WavPack(extra=2).encode(data)) < len(default_enc)
+    assert WavPack(joint_stereo=True).encode(data) != WavPack(joint_stereo=False).encode(data)
+
+    with pytest.raises(AssertionError):
+        WavPack(block_samples=8)
+    with pytest.raises(AssertionError):
+        WavPack(extra=7)
+
+
+@pytest.mark.numcodecs
+def test_wavpack_tune():
+    import numcodecs
+
+    data = make_noisy_sin_signals(shape=(20000, 8), dtype="int16")
+    config, results = tune(data, levels=(1, 2), bps=(None, 4), block_samples=(None,), num_chunks=3,
+                           chunk_frames=5000, return_results=True)
+    assert len(results) == 4
+    cod = numcodecs.get_codec(config)
+    assert isinstance(cod, WavPack)
+    best = max([res for res in results if res["pareto"]], key=lambda res: res["ratio"])
+    assert cod.level == best["params"]["level"]
+
+    # lossless only
+    config = tune(data, objective="decode_speed", levels=(1, 2), bps=(None, 4), max_error=0, num_chunks=2,
+                  chunk_frames=5000)
+    assert config["bps"] == 0
+
+    with pytest.raises(ValueError):
+        tune(data, levels=(1,), min_decode_mbps=1e9, num_chunks=1, chunk_frames=5000)
+
+    # only the sampled chunks of lazy arrays are read, and the block sizes are searched by default
+    class LazyArray:
+        shape, dtype = data.shape, data.dtype
+
+        def __getitem__(self, index):
+            assert index.stop - index.start == 5000
+            return data[index]
+
+    config, results = tune(LazyArray(), levels=(1,), num_chunks=2, chunk_frames=5000, return_results=True)
+    assert sorted({res["params"]["block_samples"] or 0 for res in results}) == [0, 4096, 16384]
+
+
+@pytest.mark.numcodecs
+def test_wavpack_stats():
+    import pickle
+
+    data = make_noisy_sin_signals(shape=(30000, 8), dtype="int16")
+    events = []
+    stats = CodecStats(callbacks=[events.append])
+    cod = WavPack(stats=stats)
+    enc = cod.encode(data)
+    cod.decode(enc)
+    cod.decode_partial(enc, 1000, 2000)
+    cod.decode_many(cod.encode_many([data, data], num_threads=2), num_threads=2)
+
+    snapshot = stats.snapshot()
+    assert snapshot["encode"]["calls"] == 1 and snapshot["decode"]["calls"] == 1
+    assert snapshot["encode"]["bytes_in"] == data.nbytes and snapshot["encode"]["bytes_out"] == len(enc)
+    assert snapshot["encode"]["ratio"] == pytest.approx(data.nbytes / len(enc))
+    assert snapshot["decode_partial"]["ratio"] is None
+    assert snapshot["encode_many"]["bytes_in"] == 2 * data.nbytes
+    for phase in ["convert", "codec"]:
+        assert snapshot["encode"]["phases"][phase] > 0
+    assert sum(snapshot["encode"]["phases"].values()) <= snapshot["encode"]["seconds"]
+    assert len(events) == 5
+
+    # the codec with its collector can be pickled (e.g. to be sent to a process pool)
+    cod_copy = pickle.loads(pickle.dumps(cod))
+    assert cod_copy.stats.snapshot()["encode"]["calls"] == 1
+    stats.reset()
+    assert stats.snapshot() == {}
+    assert WavPack().stats is None
+    assert "stats" not in WavPack(stats=True).get_config()
+
+
+@pytest.mark.numcodecs
+def test_wavpack_prefilter():
+    import numcodecs
+
+    rng = np.random.default_rng(0)
+    common_mode = (np.cumsum(rng.standard_normal(30000)) * 5)[:, None]
+    for dtype in ["int8", "int16", "uint16", "int32"]:
+        data = make_noisy_sin_signals(shape=(30000, 20), dtype="int32") + common_mode.astype("int32")
+        info = np.iinfo(dtype)
+        data = np.clip(data + (info.max // 2 + 1 if info.min == 0 else 0), info.min, info.max).astype(dtype)
+        for prefilter in ["median", "delta"]:
+            for channel_group_size in [None, 8]:
+                cod = WavPack(prefilter=prefilter, channel_group_size=channel_group_size)
+                config = cod.get_config()
+                assert numcodecs.get_codec(config).get_config() == config
+                enc = cod.encode(data)
+                assert np.all(cod.decode(enc) == data)
+                assert np.all(cod.decode_partial(enc, 1000, 1300) == data[1000:1300])
+                assert np.all(cod.decode_channels(enc, [3, 17]) == data[:, [3, 17]])
+                assert np.all(np.concatenate([frames.copy() for frames in cod.iter_decode(enc, 7000)]) == data)
+                assert all(np.all(dec == data) for dec in cod.decode_many(cod.encode_many([data, data])))
+
+        # the common median reference removes the common-mode component
+        assert len(WavPack(prefilter="median").encode(data)) < len(WavPack().encode(data))
+
+    # in hybrid mode, the lossy errors of the "delta" residuals add up along the channels of a group, so the
+    # "delta" prefilter needs the correction tier, while the error of the "median" prefilter stays bounded
+    data = make_noisy_sin_signals(shape=(30000, 64), dtype="int16") + common_mode.astype("int16")
+    max_error = np.max(np.abs(WavPack(bps=3).decode(WavPack(bps=3).encode(data)).astype("int32") - data))
+    dec = WavPack(bps=3, prefilter="median").decode(WavPack(bps=3, prefilter="median").encode(data))
+    assert np.max(np.abs(dec.astype("int32") - data)) <= 3 * max_error
+    with pytest.raises(AssertionError, match="correction"):
+        WavPack(bps=3, prefilter="delta")
+    cod = WavPack(bps=3, prefilter="delta", correction=True)
+    enc = cod.encode(data)
+    assert np.all(cod.decode(enc) == data)
+    assert WavPack(bps=3, prefilter="delta", correction=True, lossy_only=True).decode(enc).shape == data.shape
+
+    with pytest.raises(ValueError):
+        WavPack(prefilter="median").encode(np.zeros((100, 4), dtype="float32"))
+    with pytest.raises(AssertionError):
+        WavPack(prefilter="mean")
+
+
+@pytest.mark.numcodecs
+def test_wavpack_correction():
+    import numcodecs
+    from wavpack_common.container import header_size
+
+    for dtype in dtypes:
+        data = make_noisy_sin_signals(shape=(30000, 20), dtype=dtype)
+        for kwargs in [dict(), dict(channel_group_size=8), dict(prefilter="median")]:
+            if dtype == "float32" and "prefilter" in kwargs:
+                continue
+            cod = WavPack(bps=3, correction=True, **kwargs)
+            lossy_cod = WavPack(bps=3, correction=True, lossy_only=True, **kwargs)
+            config = cod.get_config()
+            assert numcodecs.get_codec(config).get_config() == config
+            # readers of the config decode losslessly
+            assert lossy_cod.get_config() == config
+            enc = cod.encode(data)
+
+            # the correction tier restores the lossless data
+            assert np.all(cod.decode(enc) == data)
+            assert np.all(cod.decode_partial(enc, 1000, 1300) == data[1000:1300])
+            assert np.all(cod.decode_channels(enc, [3, 17]) == data[:, [3, 17]])
+            assert np.all(np.concatenate([frames.copy() for frames in cod.iter_decode(enc, 7000)]) == data)
+            assert all(np.all(dec == data) for dec in cod.decode_many(cod.encode_many([data, data])))
+
+            # the lossy tier is decoded alone, from the first bytes of the chunk
+            lossy_size = WavPack.lossy_tier_size(enc[:1000])
+            assert lossy_size < len(enc)
+            dec = lossy_cod.decode(enc[:lossy_size])
+            assert np.all(lossy_cod.decode(enc) == dec)
+            assert not np.all(dec == data)
+            if dtype != "float32":
+                assert np.max(np.abs(dec.astype("float64") - data)) < 50
+            with pytest.raises(ValueError):
+                cod.decode(enc[:lossy_size])
+
+            # buffers shorter than the header raise an error with the number of bytes needed
+            with pytest.raises(ValueError, match="first 8 bytes"):
+                WavPack.lossy_tier_size(enc[:6])
+            with pytest.raises(ValueError, match=f"first {header_size(enc)} bytes"):
+                WavPack.lossy_tier_size(enc[:header_size(enc) - 1])
+
+    with pytest.raises(AssertionError):
+        WavPack(correction=True)
+
+
+@pytest.mark.numcodecs
+def test_wavpack_intra_chunk_threads():
+    from wavpack_cython.wavpack import compress, compress_parallel, decompress, decompress_parallel, dtype_enum
+
+    for dtype in dtypes:
+        data = make_noisy_sin_signals(shape=(100000, 8), dtype=dtype)
+        for kwargs in [dict(), dict(block_samples=3000), dict(bps=3, correction=True, channel_group_size=4)]:
+            cod = WavPack(intra_chunk_threads=4, **kwargs)
+            assert cod.get_config() == WavPack(**kwargs).get_config()
+            enc = cod.encode(data)
+            dec = WavPack(**kwargs).decode(enc)
+            if "bps" not in kwargs:
+                assert np.all(dec == data)
+            assert np.all(cod.decode(enc) == dec)
+            assert np.all(cod.decode_partial(enc, 20000, 70000) == dec[20000:70000])
+            assert np.all(np.concatenate([frames.copy() for frames in cod.iter_decode(enc, 30000)]) == dec)
+
+        # the joined stream is a single valid stream, decodable with or without threads
+        dtype_id = dtype_enum[dtype]
+        enc = compress_parallel(data, 2, 100000, 8, 0, dtype_id, num_threads=3, block_samples=1000)
+        assert abs(len(enc) - len(compress(data, 2, 100000, 8, 0, dtype_id, block_samples=1000))) < 1000
+        assert np.all(decompress(enc) == data)
+        assert np.all(decompress_parallel(enc, num_threads=5) == data)
+        out = np.zeros_like(data)
+        decompress_parallel(enc, out, num_threads=2, verify_checksum=False)
+        assert np.all(out == data)
+
+        # the ranges follow the blocks of streams with blocks of different sizes
+        first = compress(data[:7000], 2, 7000, 8, 0, dtype_id, block_samples=7000)
+        rest = compress(data[7000:], 2, 93000, 8, 0, dtype_id, block_samples=1000)
+        enc = rebase_blocks(first, 0, 100000) + rebase_blocks(rest, 7000, 100000)
+        assert np.all(decompress(enc) == data)
+        for num_threads in [2, 3, 7]:
+            assert np.all(decompress_parallel(enc, num_threads=num_threads) == data)
+
+
+@pytest.mark.zarr
+def test_wavpack_zarr3():
+    import asyncio
+    zarr3 = pytest.importorskip("zarr", minversion="3")
+    from wavpack_cython import zarr3 as wavpack_zarr3
+    from wavpack_cython.zarr3 import WavPackZarr3
+
+    data = make_noisy_sin_signals(shape=(50000, 6, 2), dtype="int16")
+    for executor in [None, "thread", "process"]:
+        codec = WavPackZarr3(level=2, channel_group_size=4, executor=executor, batch_size=2, lossy_only=True)
+        assert codec.to_dict()["configuration"]["channel_group_size"] == 4
+        assert "lossy_only" not in codec.to_dict()["configuration"]
+        store = zarr3.storage.MemoryStore()
+        z = zarr3.create_array(store, shape=data.shape, chunks=(20000, 6, 2), dtype=data.dtype,
+                               serializer=codec, compressors=None)
+        z[:] = data
+        # arrays opened from their metadata use the process-wide executor
+        wavpack_zarr3.set_executor(executor, batch_size=2)
+        try:
+            z = zarr3.open_array(store)
+            assert isinstance(z.metadata.codecs[0], WavPackZarr3)
+            assert np.all(z[:] == data)
+            assert np.all(z[1000:3000, 2:4] == data[1000:3000, 2:4])
+        finally:
+            wavpack_zarr3.set_executor()
+    # the pools are shared by the codecs, and created again after a shutdown
+    codec = WavPackZarr3(executor="thread")
+    assert codec._get_executor() is WavPackZarr3(executor="thread")._get_executor()
+    wavpack_zarr3.shutdown_executors()
+    assert np.all(asyncio.run(codec._run_batches(lambda codec, arrays, num_threads: arrays, [data])) == data)
+    wavpack_zarr3.shutdown_executors()
+
+    # missing chunks are skipped
+    assert asyncio.run(WavPackZarr3().decode([(None, None)])) == [None]
+    with pytest.raises(AssertionError):
+        WavPackZarr3(executor="gpu")
+    with pytest.raises(AssertionError):
+        wavpack_zarr3.set_executor("gpu")
+
+
+@pytest.mark.zarr
+def test_wavpack_convert(tmp_path):
+    from wavpack_cython.convert import convert, main
+
+    data = make_noisy_sin_signals(shape=(70000, 8), dtype="int16")
+    source = tmp_path / "recording.dat"
+    data.tofile(source)
+
+    progress = []
+    summary = convert(source, tmp_path / "recording.zarr", 8, chunk_frames=20000, num_workers=2, max_in_flight=2,
+                      verify=True, progress=lambda done, total, *args: progress.append((done, total)), level=2)
+    assert summary["written"] == summary["verified"] == 4 and summary["ratio"] > 1
+    assert progress[-1] == (4, 4)
+    z = zarr.open(str(tmp_path / "recording.zarr"))
+    assert z.compressor == WavPack(level=2) and np.all(z[:] == data)
+
+    # resume after interruption: only the missing chunks are written
+    os.remove(tmp_path / "recording.zarr" / "2.0")
+    summary = convert(source, tmp_path / "recording.zarr", 8, chunk_frames=20000, progress=False, level=2)
+    assert summary["written"] == 1 and summary["skipped"] == 3
+    assert np.all(zarr.open(str(tmp_path / "recording.zarr"))[:] == data)
+    with pytest.raises(ValueError):
+        convert(source, tmp_path / "recording.zarr", 8, chunk_frames=20000, progress=False, level=3)
+
+    # plain .wv files
+    main([str(source), str(tmp_path / "wv"), "--num-channels", "8", "--chunk-frames", "20000", "--format", "wv",
+          "--verify", "--quiet"])
+    wv_files = sorted((tmp_path / "wv").glob("*.wv"))
+    assert len(wv_files) == 4
+    assert np.all(WavPack().decode(wv_files[-1].read_bytes()) == data[60000:])
+
+    # lossy chunks are verified to decode with the shape of the source, or losslessly with the correction tier
+    for output_format, kwargs in [("wv", dict(bps=3)), ("zarr", dict(bps=3, correction=True))]:
+        summary = convert(source, tmp_path / f"lossy.{output_format}", 8, chunk_frames=20000, format=output_format,
+                          verify=True, progress=False, **kwargs)
+        assert summary["verified"] == 4
+    float_source = tmp_path / "recording_float.dat"
+    (data.astype("float32") / 1000).tofile(float_source)
+    summary = convert(float_source, tmp_path / "quantized.zarr", 8, dtype="float32", chunk_frames=20000,
+                      verify=True, progress=False, max_error=1e-3)
+    assert summary["verified"] == 4
+
+
+@pytest.mark.numcodecs
+def test_wavpack_quantize():
+    import numcodecs
+
+    data = make_noisy_sin_signals(shape=(30000, 20), dtype="float32") / 7
+    data[:, 5] = 3.5
+    float_size = len(WavPack().encode(data))
+    for max_error in [None, 1e-3]:
+        for prefilter in [None, "median"]:
+            for channel_group_size in [None, 8]:
+                cod = WavPack(quantize="int16", max_error=max_error, prefilter=prefilter,
+                              channel_group_size=channel_group_size)
+                config = cod.get_config()
+                assert numcodecs.get_codec(config).get_config() == config
+                enc = cod.encode(data)
+                dec = cod.decode(enc)
+                assert dec.dtype == data.dtype
+                if max_error is not None:
+                    # the bound holds up to the float32 rounding of the decoded samples
+                    error = np.abs(dec.astype("float64") - data)
+                    assert np.all(error <= max_error + np.spacing(np.abs(data)))
+                assert np.all(dec[:, 5] == 3.5)
+                assert len(enc) < float_size
+                assert np.all(cod.decode_partial(enc, 1000, 1300) == dec[1000:1300])
+                assert np.all(cod.decode_channels(enc, [3, 17]) == dec[:, [3, 17]])
+                assert np.all(np.concatenate([frames.copy() for frames in cod.iter_decode(enc, 7000)]) == dec)
+                assert all(np.all(d == dec) for d in cod.decode_many(cod.encode_many([data, data])))
+
+    # the quantization parameters are stored in the chunks
+    enc = WavPack(quantize="int32").encode(data)
+    assert np.all(WavPack().decode(enc) == WavPack(quantize="int32").decode(enc))
+    # channels whose range does not fit in int16 with max_error are quantized to int32
+    wide = np.stack([np.linspace(-1e3, 1e3, 1000), np.zeros(1000)], axis=1).astype("float32")
+    enc = WavPack(max_error=1e-3).encode(wide)
+    error = np.abs(WavPack().decode(enc).astype("float64") - wide)
+    assert np.all(error <= 1e-3 + np.spacing(np.abs(wide)))
+    # integer chunks are not quantized
+    int_data = make_noisy_sin_signals(shape=(3000, 4), dtype="int16")
+    assert np.all(WavPack(quantize="int16").decode(WavPack(quantize="int16").encode(int_data)) == int_data)
+
+    with pytest.raises(ValueError):
+        WavPack(max_error=1e-9).encode(wide)
+    # the hybrid errors would add up to the quantization error
+    with pytest.raises(AssertionError, match="max_error"):
+        WavPack(max_error=1e-3, bps=3)
+    assert WavPack(quantize="int16", bps=3).get_config()["bps"] == 3
+    with pytest.raises(ValueError):
+        WavPack(quantize="int16").encode(np.full((100, 2), np.nan, dtype="float32"))
+    with pytest.raises(AssertionError):
+        WavPack(quantize="int8")
+
 
 if __name__ == '__main__':
     test_wavpack_cython()
     test_wavpack_zarr()
+    test_wavpack_multithreading()
+    test_wavpack_decode_partial()
+    test_wavpack_channel_groups()
+    test_wavpack_decoded_size()
+    test_wavpack_incompressible()
+    test_wavpack_encode_decode_many()
+    test_wavpack_unsigned()
+    test_wavpack_stream_encoder()
+    test_wavpack_iter_decode()
+    test_wavpack_advanced_config()
+    test_wavpack_tune()
+    test_wavpack_stats()
+    test_wavpack_prefilter()
+    test_wavpack_correction()
+    test_wavpack_intra_chunk_threads()
+    test_wavpack_zarr3()
+    test_wavpack_convert(Path(tempfile.mkdtemp()))
+    test_wavpack_quantize()
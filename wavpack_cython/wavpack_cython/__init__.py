@@ -1,4 +1,6 @@
-from wavpack_cython.wavpack import WavPack
+from wavpack_cython.wavpack import WavPack, WavPackStreamEncoder, iter_decode
+from wavpack_common.stats import CodecStats
+from wavpack_cython.tune import tune
 import numcodecs
 
 numcodecs.register_codec(WavPack)
@@ -0,0 +1,278 @@
+"""
+Out-of-core conversion of raw binary recordings (e.g. SpikeGLX/Open Ephys .dat/.bin files) to WavPack.
+
+The source is memory-mapped and cut in windows of `chunk_frames` frames, which are read and compressed in
+parallel by a pool of worker threads (the WavPack functions release the GIL), with at most `max_in_flight`
+windows in memory. The compressed chunks are written, in order, to:
+
+    "zarr"  a Zarr array (zarr<3 format) with the `WavPack` compressor, whose chunks are the windows
+    "wv"    a directory of plain WavPack files, one per window ("000000.wv", "000001.wv", ...), with a
+            "convert.json" file describing the conversion
+
+Chunks already written are skipped when the conversion is restarted (resume), and an optional verification
+pass decodes the written chunks and compares them to the source:
+
+    python -m wavpack_cython.convert recording.dat recording.zarr --num-channels 384 --dtype int16 --level 2
+
+    convert("recording.dat", "recording.zarr", num_channels=384, dtype="int16", verify=True)
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from wavpack_common.container import is_container
+
+from .wavpack import WavPack
+
+
+FORMATS = ("zarr", "wv")
+MANIFEST = "convert.json"
+
+
+def _print_progress(done, total, bytes_in, bytes_out, seconds):
+    ratio = bytes_in / bytes_out if bytes_out else float("nan")
+    mbps = bytes_in / seconds / 1e6 if seconds > 0 else float("nan")
+    end = "\n" if done == total else ""
+    print(f"\r{done}/{total} chunks - {mbps:.1f} MB/s - ratio {ratio:.2f}", end=end, file=sys.stderr, flush=True)
+
+
+class _ZarrWriter:
+    # writes encoded chunks directly to the store of a zarr array with the WavPack compressor
+    padded = True
+
+    def __init__(self, output, shape, chunk_frames, dtype, codec, resume):
+        import zarr
+
+        if int(zarr.__version__.split(".")[0]) >= 3:
+            raise ValueError("The zarr format needs zarr<3 (see wavpack_cython.zarr3 for zarr>=3): "
+                             "use the wv format")
+        chunks = (chunk_frames, shape[1])
+        if resume and os.path.exists(output):
+            self.array = zarr.open_array(output, mode="r+")
+            existing = (self.array.shape, self.array.chunks, self.array.dtype, self.array.compressor.get_config())
+            if existing != (shape, chunks, dtype, codec.get_config()):
+                raise ValueError(f"{output} was created with other parameters {existing}: use resume=False "
+                                 "to overwrite it")
+        else:
+            self.array = zarr.open_array(output, mode="w", shape=shape, chunks=chunks, dtype=dtype,
+                                         compressor=codec, fill_value=0)
+
+    def _key(self, index):
+        return self.array._chunk_key((index, 0))
+
+    def exists(self, index):
+        return self._key(index) in self.array.store
+
+    def write(self, index, enc):
+        self.array.store[self._key(index)] = enc
+
+    def read(self, index):
+        return self.array.store[self._key(index)]
+
+
+class _WvWriter:
+    # writes each encoded chunk as a plain WavPack file
+    padded = False
+
+    def __init__(self, output, shape, chunk_frames, dtype, codec, resume):
+        self.folder = Path(output)
+        manifest = dict(shape=list(shape), chunk_frames=chunk_frames, dtype=str(dtype), codec=codec.get_config())
+        manifest_file = self.folder / MANIFEST
+        if resume and manifest_file.is_file():
+            existing = json.loads(manifest_file.read_text())
+            if existing != manifest:
+                raise ValueError(f"{output} was created with other parameters {existing}: use resume=False "
+                                 "to overwrite it")
+        else:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            for wv_file in self.folder.glob("*.wv"):
+                wv_file.unlink()
+            manifest_file.write_text(json.dumps(manifest, indent=4))
+
+    def _path(self, index):
+        return self.folder / f"{index:06d}.wv"
+
+    def exists(self, index):
+        return self._path(index).is_file()
+
+    def write(self, index, enc):
+        if is_container(enc):
+            raise ValueError("The codec options produce multi-stream chunks, which cannot be written as .wv files: "
+                             "use the zarr format")
+        # written to a temporary file first, so that interrupted writes are not taken for written chunks
+        tmp_path = self._path(index).with_suffix(".wv.tmp")
+        tmp_path.write_bytes(enc)
+        os.replace(tmp_path, self._path(index))
+
+    def read(self, index):
+        return self._path(index).read_bytes()
+
+
+def convert(source, output, num_channels, dtype="int16", offset=0, chunk_frames=30000, format="zarr",
+            num_workers=None, max_in_flight=None, resume=True, verify=False, progress=True, **codec_kwargs):
+    """
+    Compresses a raw binary recording to a Zarr array or to WavPack files.
+
+    Parameters
+    ----------
+    source : str or Path
+        The raw binary file, with interleaved samples (frames of `num_channels` samples)
+    output : str or Path
+        The Zarr array ("zarr" format) or folder ("wv" format) to write
+    num_channels : int
+        The number of channels of the recording
+    dtype : str, optional
+        The dtype of the samples, by default "int16"
+    offset : int, optional
+        The number of bytes before the first sample (e.g. a file header), by default 0
+    chunk_frames : int, optional
+        The number of frames of each chunk, by default 30000
+    format : str, optional
+        The output format: "zarr" or "wv", by default "zarr"
+    num_workers : int or None, optional
+        The number of worker threads. If None, the number of CPUs is used, by default None
+    max_in_flight : int or None, optional
+        The maximum number of chunks read but not yet written, which bounds the memory use to about
+        `max_in_flight` raw chunks. If None, 2 * num_workers is used, by default None
+    resume : bool, optional
+        If True and the output exists (with the same parameters), the chunks already written are skipped.
+        If False, the output is overwritten, by default True
+    verify : bool, optional
+        If True, all the chunks are read back, decoded and compared to the source after the conversion:
+        lossless chunks must be equal to the source, float chunks quantized with `max_error` must be within
+        the bound, and other lossy (hybrid) chunks must decode with the shape and dtype of the source,
+        by default False
+    progress : bool or callable, optional
+        If True, progress is printed to stderr. A callable is called after each chunk with the number of
+        chunks done, the total number of chunks, the raw and compressed bytes written and the elapsed
+        seconds, by default True
+    **codec_kwargs
+        The arguments of the `WavPack` codec (level, bps, block_samples, ...)
+
+    Returns
+    -------
+    dict
+        The number of chunks, the chunks written and skipped, the raw and compressed bytes written,
+        the compression ratio, the seconds and (if `verify`) the number of verified chunks
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, use one of {list(FORMATS)}")
+    dtype = np.dtype(dtype)
+    data = np.memmap(source, dtype=dtype, mode="r", offset=offset)
+    if data.size % num_channels:
+        raise ValueError(f"The size of {source} ({data.size} samples) is not a multiple of {num_channels} channels")
+    data = data.reshape(-1, num_channels)
+    num_frames = data.shape[0]
+    num_chunks = -(-num_frames // chunk_frames)
+    num_workers = num_workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * num_workers
+    assert max_in_flight >= 1, "max_in_flight must be >= 1"
+    if progress is True:
+        progress = _print_progress
+
+    codec = WavPack(**codec_kwargs)
+    writer_cls = _ZarrWriter if format == "zarr" else _WvWriter
+    writer = writer_cls(str(output), data.shape, chunk_frames, dtype, codec, resume)
+
+    def read_chunk(index):
+        chunk = np.array(data[index * chunk_frames:(index + 1) * chunk_frames])
+        if writer.padded and chunk.shape[0] < chunk_frames:
+            # the zarr edge chunks have the full chunk shape
+            chunk = np.concatenate([chunk, np.zeros((chunk_frames - chunk.shape[0], num_channels), dtype=dtype)])
+        return chunk
+
+    def encode_chunk(index):
+        chunk = read_chunk(index)
+        return chunk.nbytes, codec.encode(chunk)
+
+    # the hybrid (bps) error has no bound, and quantized float chunks are only bounded with max_error
+    quantized = codec.quantize is not None and dtype.kind == "f"
+    lossless = (codec.bps == 0 or (codec.correction and not codec.lossy_only)) and not quantized
+
+    def verify_chunk(index):
+        dec = np.asarray(codec.decode(writer.read(index))).reshape(-1, num_channels)
+        chunk = read_chunk(index)
+        if lossless:
+            return np.array_equal(dec, chunk)
+        if dec.shape != chunk.shape or dec.dtype != chunk.dtype:
+            return False
+        if quantized and codec.max_error is not None:
+            error = np.abs(dec.astype("float64") - chunk)
+            return bool(np.all(error <= codec.max_error + np.spacing(np.abs(chunk))))
+        return True
+
+    todo = [index for index in range(num_chunks) if not (resume and writer.exists(index))]
+    summary = dict(num_chunks=num_chunks, written=0, skipped=num_chunks - len(todo), bytes_in=0, bytes_out=0)
+    t_start = time.perf_counter()
+
+    def write_next(in_flight):
+        # waits for the oldest chunk in flight and writes it
+        index, future = in_flight.popleft()
+        nbytes, enc = future.result()
+        writer.write(index, enc)
+        summary["written"] += 1
+        summary["bytes_in"] += nbytes
+        summary["bytes_out"] += len(enc)
+        if progress:
+            progress(summary["skipped"] + summary["written"], num_chunks, summary["bytes_in"], summary["bytes_out"],
+                     time.perf_counter() - t_start)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # chunks are read and encoded ahead of the writes by at most max_in_flight chunks, and written in order
+        in_flight = collections.deque()
+        for index in todo:
+            if len(in_flight) >= max_in_flight:
+                write_next(in_flight)
+            in_flight.append((index, executor.submit(encode_chunk, index)))
+        while in_flight:
+            write_next(in_flight)
+
+        if verify:
+            matches = executor.map(verify_chunk, range(num_chunks))
+            mismatches = [index for index, match in enumerate(matches) if not match]
+            if mismatches:
+                raise RuntimeError(f"{len(mismatches)} chunks differ from the source, e.g. chunk {mismatches[0]}")
+            summary["verified"] = num_chunks
+
+    summary["seconds"] = time.perf_counter() - t_start
+    summary["ratio"] = summary["bytes_in"] / summary["bytes_out"] if summary["bytes_out"] else None
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("source", help="The raw binary recording")
+    parser.add_argument("output", help="The Zarr array or .wv folder to write")
+    parser.add_argument("--num-channels", type=int, required=True)
+    parser.add_argument("--dtype", default="int16")
+    parser.add_argument("--offset", type=int, default=0, help="The number of header bytes of the source")
+    parser.add_argument("--chunk-frames", type=int, default=30000)
+    parser.add_argument("--format", choices=FORMATS, default="zarr")
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--no-resume", action="store_true", help="Overwrite the output instead of resuming")
+    parser.add_argument("--verify", action="store_true", help="Read back and compare all the chunks")
+    parser.add_argument("--quiet", action="store_true", help="Do not print progress")
+    parser.add_argument("--level", type=int, default=1)
+    parser.add_argument("--bps", type=float, default=None, help="The hybrid (lossy) bits per sample")
+    parser.add_argument("--block-samples", type=int, default=None)
+    parser.add_argument("--extra", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    summary = convert(args.source, args.output, args.num_channels, dtype=args.dtype, offset=args.offset,
+                      chunk_frames=args.chunk_frames, format=args.format, num_workers=args.num_workers,
+                      max_in_flight=args.max_in_flight, resume=not args.no_resume, verify=args.verify,
+                      progress=not args.quiet, level=args.level, bps=args.bps,
+                      block_samples=args.block_samples, extra=args.extra)
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -97,28 +97,319 @@ static WavpackStreamReader64 raw_reader = {
     raw_push_back_byte, raw_get_length, raw_can_seek, NULL, raw_close_stream
 };
 
-// This is the single function for completely decoding a WavPack file from memory to memory. This version is
-// for 16-bit audio in any number of channels, and will error out if the source file is not 16-bit. The
-// number of channels is written to the specified pointer, but it is assumed that the caller already knows
-// this. The number of composite samples (i.e., frames) is returned.
+// These are the callbacks for the seekable version of the memory-based "file", which is required by
+// WavpackSeekSample64() to locate the block containing a given sample without decoding the ones before.
 
-#define BUFFER_SAMPLES 256
+static int raw_seekable_set_pos_abs (void *id, int64_t pos)
+{
+    WavpackReaderContext *rcxt = (WavpackReaderContext *) id;
+
+    if (pos < 0 || pos > rcxt->eptr - rcxt->sptr)
+        return -1;
+
+    rcxt->dptr = rcxt->sptr + pos;
+    rcxt->ungetc_flag = 0;
+    return 0;
+}
+
+static int raw_seekable_set_pos_rel (void *id, int64_t delta, int mode)
+{
+    WavpackReaderContext *rcxt = (WavpackReaderContext *) id;
+    int64_t pos;
+
+    switch (mode) {
+        case SEEK_SET:
+            pos = delta;
+            break;
+
+        case SEEK_CUR:
+            pos = (rcxt->dptr - rcxt->sptr) + delta;
+            break;
+
+        case SEEK_END:
+            pos = (rcxt->eptr - rcxt->sptr) + delta;
+            break;
+
+        default:
+            return -1;
+    }
+
+    return raw_seekable_set_pos_abs (id, pos);
+}
+
+static int64_t raw_seekable_get_length (void *id)
+{
+    WavpackReaderContext *rcxt = (WavpackReaderContext *) id;
+    return rcxt->eptr - rcxt->sptr;
+}
+
+static int raw_seekable_can_seek (void *id)
+{
+    return 1;
+}
+
+static WavpackStreamReader64 raw_seekable_reader = {
+    raw_read_bytes, raw_write_bytes, raw_get_pos, raw_seekable_set_pos_abs, raw_seekable_set_pos_rel,
+    raw_push_back_byte, raw_seekable_get_length, raw_seekable_can_seek, NULL, raw_close_stream
+};
+
+// Unsigned streams (flagged with QMODE_UNSIGNED_WORDS) were offset by half their range to the signed range
+// before encoding, which is undone here (for 32 bits, by flipping the sign bit).
+
+#define UINT8_OFFSET 0x80
+#define UINT16_OFFSET 0x8000
+#define UINT32_SIGN_BIT 0x80000000U
+
+// 32-bit samples are unpacked straight into the destination. Narrower samples are unpacked in batches of
+// up to SCRATCH_SAMPLES samples (i.e., frames * channels) into a scratch buffer, which can be provided by the
+// caller to be reused across calls, and narrowed with plain indexed loops that the compiler can vectorize.
+
+#define SCRATCH_SAMPLES (1 << 18)
+#define MAX_BATCH_SAMPLES (1 << 30)
+
+#if defined(_MSC_VER)
+#define WV_RESTRICT __restrict
+#else
+#define WV_RESTRICT restrict
+#endif
+
+// Optional timings of the conversion of the samples to/from 32 bits and of the WavPack library calls, which
+// are accumulated when a WavpackTimings is passed. With NULL timings, the clock is never read.
+
+#ifndef WAVPACK_TIMINGS_DEFINED
+#define WAVPACK_TIMINGS_DEFINED
+
+#include <time.h>
 
-size_t WavpackDecodeFile (void *source, size_t source_bytes, int *num_chans, int *bytes_per_sample,
-                          void *destin_char, size_t destin_bytes)
+typedef struct {
+    double convert_seconds, codec_seconds;
+} WavpackTimings;
+
+static double timings_clock (void)
+{
+    struct timespec ts;
+
+    timespec_get (&ts, TIME_UTC);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+#endif
+
+static void narrow_samples (void *WV_RESTRICT dst, const int32_t *WV_RESTRICT src, size_t count, int bps,
+                            int unsigned_data)
 {
-    size_t total_samples = 0, max_samples;
+    size_t i;
+
+    if (bps == 1) {
+        int8_t *WV_RESTRICT dptr = dst;
+
+        if (unsigned_data)
+            for (i = 0; i < count; i++)
+                dptr [i] = (int8_t) (uint8_t) (src [i] + UINT8_OFFSET);
+        else
+            for (i = 0; i < count; i++)
+                dptr [i] = (int8_t) src [i];
+    }
+    else if (bps == 2) {
+        int16_t *WV_RESTRICT dptr = dst;
+
+        if (unsigned_data)
+            for (i = 0; i < count; i++)
+                dptr [i] = (int16_t) (uint16_t) (src [i] + UINT16_OFFSET);
+        else
+            for (i = 0; i < count; i++)
+                dptr [i] = (int16_t) src [i];
+    }
+}
+
+static void flip_sign_bits (uint32_t *samples, size_t count)
+{
+    size_t i;
+
+    for (i = 0; i < count; i++)
+        samples [i] ^= UINT32_SIGN_BIT;
+}
+
+// Unpack up to max_samples composite samples (i.e., frames) from the current position of an opened context
+// into the destination, narrowing to 8 or 16 bits and restoring unsigned samples when required. The optional
+// scratch buffer of scratch_samples 32-bit samples is used for narrowing (if NULL, a buffer is allocated when
+// needed). The time spent unpacking and converting is added to the optional timings. The number of frames
+// unpacked is returned, or (size_t) -1 if the scratch buffer could not be allocated.
+
+static size_t unpack_frames (WavpackContext *wpc, int nch, int bps, void *destin_char, size_t max_samples,
+                             int32_t *scratch, size_t scratch_samples, WavpackTimings *timings)
+{
+    size_t total_samples = 0, batch_samples = MAX_BATCH_SAMPLES / nch;
     int32_t *temp_buffer = NULL;
+    int unsigned_data = (WavpackGetQualifyMode (wpc) & QMODE_UNSIGNED_WORDS) != 0;
+    char *dest_ptr = destin_char;
+
+    if (bps != 4) {
+        if (scratch && scratch_samples >= (size_t) nch) {
+            temp_buffer = scratch;
+        }
+        else {
+            scratch_samples = max_samples * nch < SCRATCH_SAMPLES ? max_samples * nch : SCRATCH_SAMPLES;
+
+            if (scratch_samples < (size_t) nch)
+                scratch_samples = nch;
+
+            temp_buffer = malloc (scratch_samples * sizeof (int32_t));
+
+            if (!temp_buffer)
+                return (size_t) -1;
+        }
+
+        batch_samples = scratch_samples / nch;
+    }
+
+    while (total_samples < max_samples) {
+        size_t samples_to_decode = max_samples - total_samples < batch_samples ?
+            max_samples - total_samples :
+            batch_samples;
+        double t_start = timings ? timings_clock () : 0.0, t_unpacked;
+        size_t samples_decoded = WavpackUnpackSamples (wpc, temp_buffer ? temp_buffer : (int32_t *) dest_ptr,
+                                                       (uint32_t) samples_to_decode);
+        size_t samples_to_copy = samples_decoded * nch;
+
+        if (!samples_decoded)
+            break;
+
+        t_unpacked = timings ? timings_clock () : 0.0;
+
+        if (bps != 4)
+            narrow_samples (dest_ptr, temp_buffer, samples_to_copy, bps, unsigned_data);
+        else if (unsigned_data)
+            flip_sign_bits ((uint32_t *) dest_ptr, samples_to_copy);
+
+        if (timings) {
+            timings->codec_seconds += t_unpacked - t_start;
+            timings->convert_seconds += timings_clock () - t_unpacked;
+        }
+
+        dest_ptr += samples_to_copy * bps;
+        total_samples += samples_decoded;
+    }
+
+    if (temp_buffer != scratch)
+        free (temp_buffer);
+
+    return total_samples;
+}
+
+// This function reads the number of composite samples (i.e., frames), the number of channels, the bytes
+// per sample, the mode flags (MODE_FLOAT, MODE_HYBRID, ...) and the qualify mode flags (QMODE_UNSIGNED_WORDS,
+// ...) of a WavPack file in memory from its first block, without decoding any audio. The number of samples
+// is -1 if it was not stored in the stream. Returns 1 on success and 0 on error.
+
+int WavpackGetStreamInfo (void *source, size_t source_bytes, int64_t *num_samples, int *num_chans,
+                          int *bytes_per_sample, int *mode, int *qmode)
+{
     WavpackReaderContext raw_wv;
     WavpackContext *wpc;
     char error [80];
-    int nch, bps;
 
     memset (&raw_wv, 0, sizeof (WavpackReaderContext));
     raw_wv.dptr = raw_wv.sptr = (unsigned char *) source;
     raw_wv.eptr = raw_wv.dptr + source_bytes;
     wpc = WavpackOpenFileInputEx64 (&raw_reader, &raw_wv, NULL, error, OPEN_STREAMING, 0);
 
+    if (!wpc) {
+        fprintf (stderr, "error opening file: %s\n", error);
+        return 0;
+    }
+
+    if (num_samples)
+        *num_samples = WavpackGetNumSamples64 (wpc);
+
+    if (num_chans)
+        *num_chans = WavpackGetNumChannels (wpc);
+
+    if (bytes_per_sample)
+        *bytes_per_sample = WavpackGetBytesPerSample (wpc);
+
+    if (mode)
+        *mode = WavpackGetMode (wpc);
+
+    if (qmode)
+        *qmode = WavpackGetQualifyMode (wpc);
+
+    WavpackCloseFile (wpc);
+    return 1;
+}
+
+// This function counts the composite samples (i.e., frames) of a WavPack file in memory by walking its block
+// headers, for streams that do not store their total number of samples in the first block (e.g. when they
+// are written incrementally). Returns -1 if an invalid block header is found.
+
+int64_t WavpackCountSamples (void *source, size_t source_bytes)
+{
+    unsigned char *sptr = (unsigned char *) source, *eptr = sptr + source_bytes;
+    int64_t total_samples = 0;
+    WavpackHeader wphdr;
+
+    while (eptr - sptr >= (int64_t) sizeof (WavpackHeader)) {
+        if (memcmp (sptr, "wvpk", 4))
+            return -1;
+
+        memcpy (&wphdr, sptr, sizeof (WavpackHeader));
+        WavpackLittleEndianToNative (&wphdr, WavpackHeaderFormat);
+
+        if (wphdr.ckSize + 8 > (uint64_t) (eptr - sptr))
+            return -1;
+
+        if (wphdr.flags & INITIAL_BLOCK)
+            total_samples += wphdr.block_samples;
+
+        sptr += wphdr.ckSize + 8;
+    }
+
+    return total_samples;
+}
+
+// Initialize the reader contexts of a WavPack file in memory and of its optional correction ("wvc") stream,
+// and return the open flags to use: OPEN_WVC is added when there is a correction stream, so that the hybrid
+// (lossy) file is decoded losslessly.
+
+static int init_readers (WavpackReaderContext *raw_wv, void *source, size_t source_bytes,
+                         WavpackReaderContext *raw_wvc, void *wvc_source, size_t wvc_source_bytes, int open_flags)
+{
+    memset (raw_wv, 0, sizeof (WavpackReaderContext));
+    raw_wv->dptr = raw_wv->sptr = (unsigned char *) source;
+    raw_wv->eptr = raw_wv->dptr + source_bytes;
+
+    memset (raw_wvc, 0, sizeof (WavpackReaderContext));
+
+    if (!wvc_source)
+        return open_flags;
+
+    raw_wvc->dptr = raw_wvc->sptr = (unsigned char *) wvc_source;
+    raw_wvc->eptr = raw_wvc->dptr + wvc_source_bytes;
+    return open_flags | OPEN_WVC;
+}
+
+// This is the single function for completely decoding a WavPack file from memory to memory, for audio of any
+// supported data type in any number of channels. The number of channels is written to the specified pointer,
+// but it is assumed that the caller already knows this. A hybrid file is decoded losslessly when its
+// correction stream is given (wvc_source, or NULL to decode the lossy file alone). The optional scratch buffer (see unpack_frames()) is
+// reused for narrowing samples. The open_flags (e.g. OPEN_NO_CHECKSUM to skip the verification of the block
+// checksums) are added to the flags used to open the stream, and the time spent in the library and converting
+// is added to the optional timings. The number of composite samples (i.e., frames) is returned.
+
+size_t WavpackDecodeFile (void *source, size_t source_bytes, void *wvc_source, size_t wvc_source_bytes,
+                          int *num_chans, int *bytes_per_sample, void *destin_char, size_t destin_bytes,
+                          int32_t *scratch, size_t scratch_samples, int open_flags, WavpackTimings *timings)
+{
+    size_t total_samples;
+    WavpackReaderContext raw_wv, raw_wvc;
+    WavpackContext *wpc;
+    char error [80];
+    int nch, bps;
+
+    open_flags = init_readers (&raw_wv, source, source_bytes, &raw_wvc, wvc_source, wvc_source_bytes, open_flags);
+    wpc = WavpackOpenFileInputEx64 (&raw_reader, &raw_wv, wvc_source ? &raw_wvc : NULL, error,
+                                    OPEN_STREAMING | open_flags, 0);
+
     if (!wpc) {
         fprintf (stderr, "error opening file: %s\n", error);
         return -1;
@@ -127,10 +418,6 @@ size_t WavpackDecodeFile (void *source, size_t source_bytes, int *num_chans, int
     nch = WavpackGetNumChannels (wpc);
     bps = WavpackGetBytesPerSample (wpc);
 
-    int8_t *dest_int8 = destin_char;
-    int16_t *dest_int16 = destin_char;
-    int32_t *dest_int32 = destin_char;
-
     if (num_chans)
         *num_chans = nch;
 
@@ -139,47 +426,158 @@ size_t WavpackDecodeFile (void *source, size_t source_bytes, int *num_chans, int
 
     // fprintf (stderr, "WavPack decoding: bytes per sample %d - num chans %d\n", bps, nch);
 
-    max_samples = destin_bytes / bps / nch;
+    total_samples = unpack_frames (wpc, nch, bps, destin_char, destin_bytes / bps / nch, scratch, scratch_samples,
+                                   timings);
 
-    if (bps != 4)
-        temp_buffer = malloc (BUFFER_SAMPLES * nch * sizeof (int32_t));
+    WavpackCloseFile (wpc);
+    return total_samples;
+}
 
-    while (1) {
-        int samples_to_decode = total_samples + BUFFER_SAMPLES > max_samples ?
-            max_samples - total_samples :
-            BUFFER_SAMPLES;
-        int samples_decoded = WavpackUnpackSamples (wpc, temp_buffer ? temp_buffer : dest_int32, samples_to_decode);
-        int samples_to_copy = samples_decoded * nch;
+// This function decodes the frames [start_sample, start_sample + num_samples) of a WavPack file in memory.
+// The stream is opened with the seekable reader, so only the blocks covering the requested range are
+// decoded. The range is clipped to the end of the stream and the number of frames decoded is returned. The
+// optional correction stream, scratch buffer (see unpack_frames()), open_flags and timings are as in
+// WavpackDecodeFile() (the seek is timed as library time).
 
-        if (!samples_decoded)
-            break;
+size_t WavpackDecodeRange (void *source, size_t source_bytes, void *wvc_source, size_t wvc_source_bytes,
+                           size_t start_sample, size_t num_samples, int *num_chans, int *bytes_per_sample,
+                           void *destin_char, size_t destin_bytes, int32_t *scratch, size_t scratch_samples,
+                           int open_flags, WavpackTimings *timings)
+{
+    size_t total_samples, max_samples;
+    int64_t stream_samples;
+    double seek_start;
+    WavpackReaderContext raw_wv, raw_wvc;
+    WavpackContext *wpc;
+    char error [80];
+    int nch, bps;
+
+    open_flags = init_readers (&raw_wv, source, source_bytes, &raw_wvc, wvc_source, wvc_source_bytes, open_flags);
+    wpc = WavpackOpenFileInputEx64 (&raw_seekable_reader, &raw_wv, wvc_source ? &raw_wvc : NULL, error,
+                                    open_flags, 0);
+
+    if (!wpc) {
+        fprintf (stderr, "error opening file: %s\n", error);
+        return -1;
+    }
 
-        if ((bps == 1) || (bps == 2)) 
-        {
-            int32_t *sptr = temp_buffer;
+    nch = WavpackGetNumChannels (wpc);
+    bps = WavpackGetBytesPerSample (wpc);
+    stream_samples = WavpackGetNumSamples64 (wpc);
 
-            switch (bps) {
-                case 1:
-                    while (samples_to_copy--)
-                        *dest_int8++ = *sptr++;
+    if (num_chans)
+        *num_chans = nch;
 
-                    break;
+    if (bytes_per_sample)
+        *bytes_per_sample = bps;
 
-                case 2:
-                    while (samples_to_copy--)
-                        *dest_int16++ = *sptr++;
+    if (stream_samples >= 0 && start_sample >= (size_t) stream_samples) {
+        WavpackCloseFile (wpc);
+        return 0;
+    }
 
-                    break;
-            }
-        }
-        else
-            dest_int32 += samples_to_copy;
+    seek_start = timings ? timings_clock () : 0.0;
 
-        if ((total_samples += samples_decoded) == max_samples)
-            break;
+    if (start_sample && !WavpackSeekSample64 (wpc, start_sample)) {
+        fprintf (stderr, "WavPack seek to sample %lld failed\n", (long long) start_sample);
+        WavpackCloseFile (wpc);
+        return -1;
     }
 
-    free (temp_buffer);
+    if (timings)
+        timings->codec_seconds += timings_clock () - seek_start;
+
+    max_samples = destin_bytes / bps / nch;
+
+    if (num_samples < max_samples)
+        max_samples = num_samples;
+
+    total_samples = unpack_frames (wpc, nch, bps, destin_char, max_samples, scratch, scratch_samples, timings);
+
     WavpackCloseFile (wpc);
     return total_samples;
 }
+
+// The stream decoder keeps a context open on a WavPack file in memory to decode it incrementally, a number of
+// composite samples (i.e., frames) at a time, with memory use bounded by the requested frames. The source
+// must remain valid until the decoder is closed.
+
+typedef struct {
+    WavpackContext *wpc;
+    WavpackReaderContext reader, wvc_reader;
+    int num_chans, bytes_per_sample;
+    int32_t *temp_buffer;
+    size_t scratch_samples;
+} WavpackStreamDecoder;
+
+void WavpackStreamDecoderClose (WavpackStreamDecoder *decoder);
+
+// Open a stream decoder, writing the number of channels and bytes per sample to the specified pointers.
+// The optional correction stream is as in WavpackDecodeFile(), and the open_flags (e.g. OPEN_NO_CHECKSUM)
+// are added to OPEN_STREAMING. Returns NULL on error.
+
+WavpackStreamDecoder *WavpackStreamDecoderOpen (void *source, size_t source_bytes, void *wvc_source,
+                                                size_t wvc_source_bytes, int *num_chans, int *bytes_per_sample,
+                                                int open_flags)
+{
+    WavpackStreamDecoder *decoder = calloc (1, sizeof (WavpackStreamDecoder));
+    char error [80];
+
+    if (!decoder)
+        return NULL;
+
+    open_flags = init_readers (&decoder->reader, source, source_bytes, &decoder->wvc_reader, wvc_source,
+                               wvc_source_bytes, open_flags);
+    decoder->wpc = WavpackOpenFileInputEx64 (&raw_reader, &decoder->reader, wvc_source ? &decoder->wvc_reader : NULL,
+                                             error, OPEN_STREAMING | open_flags, 0);
+
+    if (!decoder->wpc) {
+        fprintf (stderr, "error opening file: %s\n", error);
+        WavpackStreamDecoderClose (decoder);
+        return NULL;
+    }
+
+    decoder->num_chans = WavpackGetNumChannels (decoder->wpc);
+    decoder->bytes_per_sample = WavpackGetBytesPerSample (decoder->wpc);
+
+    if (decoder->bytes_per_sample != 4) {
+        decoder->scratch_samples = decoder->num_chans < SCRATCH_SAMPLES ? SCRATCH_SAMPLES : decoder->num_chans;
+        decoder->temp_buffer = malloc (decoder->scratch_samples * sizeof (int32_t));
+
+        if (!decoder->temp_buffer) {
+            WavpackStreamDecoderClose (decoder);
+            return NULL;
+        }
+    }
+
+    if (num_chans)
+        *num_chans = decoder->num_chans;
+
+    if (bytes_per_sample)
+        *bytes_per_sample = decoder->bytes_per_sample;
+
+    return decoder;
+}
+
+// Decode the next (up to) num_samples composite samples (i.e., frames) into the destination. Returns the
+// number of frames decoded, which is less than num_samples only at the end of the stream.
+
+size_t WavpackStreamDecoderRead (WavpackStreamDecoder *decoder, void *destin, size_t num_samples)
+{
+    return unpack_frames (decoder->wpc, decoder->num_chans, decoder->bytes_per_sample, destin, num_samples,
+                          decoder->temp_buffer, decoder->scratch_samples, NULL);
+}
+
+// Close the context and free the decoder.
+
+void WavpackStreamDecoderClose (WavpackStreamDecoder *decoder)
+{
+    if (!decoder)
+        return;
+
+    if (decoder->wpc)
+        WavpackCloseFile (decoder->wpc);
+
+    free (decoder->temp_buffer);
+    free (decoder);
+}
@@ -8,21 +8,66 @@
 
 #include "wavpack/wavpack.h"
 
-// This is the callback required by the wavpack-stream library to write compressed audio frames.
+// This is the callback required by the wavpack-stream library to write compressed audio frames. Growable
+// contexts (used by the stream encoder) reallocate their data as needed, others fail when full.
 
 typedef struct {
     size_t bytes_available, bytes_used;
-    char *data, overflow;
+    char *data, overflow, growable;
 } WavpackWriterContext;
 
 typedef enum {
-    int8, int16, int32, float32
+    int8, int16, int32, float32, uint8, uint16, uint32
 } dtype_enum;
 
+// Unsigned samples are offset by half their range to the signed range before encoding (and back after
+// decoding), which for 32 bits amounts to flipping the sign bit. The stream is flagged with
+// QMODE_UNSIGNED_WORDS (and signed 8-bit streams with QMODE_SIGNED_BYTES) so that decoders can tell the
+// original type.
+
+#define UINT8_OFFSET 0x80
+#define UINT16_OFFSET 0x8000
+#define UINT32_SIGN_BIT 0x80000000U
+
+static int get_bytes_per_sample (int dtype)
+{
+    switch (dtype) {
+        case int8: case uint8:
+            return 1;
+
+        case int16: case uint16:
+            return 2;
+
+        case int32: case uint32: case float32:
+            return 4;
+
+        default:
+            return 0;
+    }
+}
+
 static int write_block (void *id, void *data, int32_t length)
 {
     WavpackWriterContext *cxt = id;
 
+    if (cxt->growable && cxt->bytes_used + length > cxt->bytes_available) {
+        size_t new_size = cxt->bytes_available ? cxt->bytes_available : 65536;
+        char *new_data;
+
+        while (new_size < cxt->bytes_used + length)
+            new_size *= 2;
+
+        new_data = realloc (cxt->data, new_size);
+
+        if (!new_data) {
+            cxt->overflow = 1;
+            return 0;
+        }
+
+        cxt->data = new_data;
+        cxt->bytes_available = new_size;
+    }
+
     if (!cxt->data || cxt->overflow)
         return 0;
 
@@ -37,172 +82,613 @@ static int write_block (void *id, void *data, int32_t length)
     return 1;
 }
 
-// This is the single function for completely encoding a WavPack file from memory to memory. This version is
-// for 16-bit audio in any number of channels. The level parameter is the speed mode, from 1 - 4. The bps
-// parameter is the number of bits to allocate for each sample (minimum: about 2.25) which should be set
-// to 0.0 for lossless encoding. The destination must be large enough for the entire file (be conservative).
-// The return value is the number of bytes generated, or -1 if there was not enough space to encode to
-// (or some other error).
+// Encoding options, beyond the data type and shape. The defaults (all zeros, except level = 1 and
+// joint_stereo = -1) are the fast lossless mode, with the block size of get_block_samples().
 
-#define BUFFER_SAMPLES 256
+typedef struct {
+    int level;              // compression level: 1 (fast), 2 (default), 3 (high) or 4 (very high)
+    float bps;              // hybrid bits per sample, or 0.0 for lossless
+    size_t block_samples;   // samples per block, or 0 for the default
+    int extra;              // extra processing level (CONFIG_EXTRA_MODE): 0 (off) to 6
+    int joint_stereo;       // joint stereo for channel pairs: 1 (on), 0 (off), or -1 (chosen by the library)
+} WavpackEncodeOptions;
 
-size_t WavpackEncodeFile (void *source_char, size_t num_samples, size_t num_chans, int level, float bps, void *destin, 
-                          size_t destin_bytes, int dtype)
-{   
-    // cast void pointer
-    dtype_enum dtype_chosen = (dtype_enum) dtype;
+// Number of samples per block, as used by WavpackEncodeFile(): the requested number of samples if not 0,
+// otherwise the whole chunk in a single block, halved until blocks are no longer than 120000 samples. The
+// library rejects blocks shorter than 16 samples, so shorter chunks use a (partially filled) 16-sample block.
 
-    int8_t *source_int8;
-    int16_t *source_int16;
-    int32_t *source_int32;
-    int bytes_per_sample;
-    int fp = 0;
+#define MIN_BLOCK_SAMPLES 16
+
+static size_t get_block_samples (size_t num_samples, size_t requested_samples)
+{
+    size_t block_samples = requested_samples ? requested_samples : num_samples;
+
+    while (!requested_samples && block_samples > 120000)
+        block_samples = (block_samples + 1) >> 1;
+
+    if (block_samples < MIN_BLOCK_SAMPLES)
+        block_samples = MIN_BLOCK_SAMPLES;
+
+    return block_samples;
+}
+
+// Worst-case metadata overhead for each block of each channel: block header (32 bytes), decorrelation terms,
+// weights and samples, entropy variables, channel info, int32/float info and the block checksum.
+
+#define BLOCK_OVERHEAD_BYTES 256
+
+// This function returns an upper bound of the number of bytes generated by WavpackEncodeFile() for the given
+// number of composite samples (i.e., frames), channels, data type and samples per block (0 for the default
+// of WavpackEncodeFile()). A destination of this size can
+// never overflow, even for incompressible data. In the worst case, every sample is stored with its full width
+// plus one byte of entropy coder overhead (floats can additionally need their full mantissa in the extended
+// "wvx" bitstream), and every block of every channel carries its own header and metadata.
+
+size_t WavpackEncodeBound (size_t num_samples, size_t num_chans, int dtype, size_t block_samples)
+{
+    int bytes_per_sample = get_bytes_per_sample (dtype);
+    int fp = dtype == float32;
+
+    block_samples = get_block_samples (num_samples, block_samples);
+    size_t num_blocks = block_samples ? (num_samples + block_samples - 1) / block_samples : 1;
+    size_t bytes_per_value = bytes_per_sample + 1 + (fp ? bytes_per_sample : 0);
+
+    return num_samples * num_chans * bytes_per_value + num_blocks * num_chans * BLOCK_OVERHEAD_BYTES + 1024;
+}
+
+// Samples that are not signed 32-bit are widened to the 32-bit buffers of the library in batches that span a
+// whole block when they fit in SCRATCH_SAMPLES samples (i.e., frames * channels), and a fraction of a block
+// otherwise. The conversion loops are plain indexed loops over non-aliasing pointers, so that the compiler
+// can vectorize them. The scratch buffer can be provided by the caller to be reused across calls.
+
+#define SCRATCH_SAMPLES (1 << 18)
+
+#if defined(_MSC_VER)
+#define WV_RESTRICT __restrict
+#else
+#define WV_RESTRICT restrict
+#endif
+
+// Optional timings of the conversion of the samples to/from 32 bits and of the WavPack library calls, which
+// are accumulated when a WavpackTimings is passed. With NULL timings, the clock is never read.
+
+#ifndef WAVPACK_TIMINGS_DEFINED
+#define WAVPACK_TIMINGS_DEFINED
+
+#include <time.h>
+
+typedef struct {
+    double convert_seconds, codec_seconds;
+} WavpackTimings;
+
+static double timings_clock (void)
+{
+    struct timespec ts;
+
+    timespec_get (&ts, TIME_UTC);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+#endif
+
+static void widen_samples (int32_t *WV_RESTRICT dst, const void *WV_RESTRICT src, size_t count, dtype_enum dtype)
+{
+    size_t i;
+
+    switch (dtype) {
+        case int8: {
+            const int8_t *WV_RESTRICT sptr = src;
+
+            for (i = 0; i < count; i++)
+                dst [i] = sptr [i];
 
-    switch (dtype_chosen) {
-        case int8:
-        {
-            source_int8 = source_char;
-            bytes_per_sample = 1;
             break;
         }
-        case int16:
-        {
-            source_int16 = source_char;
-            bytes_per_sample = 2;
+
+        case int16: {
+            const int16_t *WV_RESTRICT sptr = src;
+
+            for (i = 0; i < count; i++)
+                dst [i] = sptr [i];
+
+            break;
+        }
+
+        case uint8: {
+            const uint8_t *WV_RESTRICT sptr = src;
+
+            for (i = 0; i < count; i++)
+                dst [i] = (int32_t) sptr [i] - UINT8_OFFSET;
+
             break;
         }
-        case int32:
-        {
-            source_int32 = source_char;
-            bytes_per_sample = 4;
+
+        case uint16: {
+            const uint16_t *WV_RESTRICT sptr = src;
+
+            for (i = 0; i < count; i++)
+                dst [i] = (int32_t) sptr [i] - UINT16_OFFSET;
+
             break;
         }
-        case float32:
-        {
-            source_int32 = source_char;
-            bytes_per_sample = 4;
-            fp = 1;
+
+        case uint32: {
+            const uint32_t *WV_RESTRICT sptr = src;
+
+            for (i = 0; i < count; i++)
+                dst [i] = (int32_t) (sptr [i] ^ UINT32_SIGN_BIT);
+
             break;
         }
-        default:
-            fprintf (stderr, "WavPack unsupported data type %d\n", dtype_chosen);
-            return -1;
+
+        default:        // signed 32-bit samples are never converted
+            break;
     }
+}
 
-    size_t num_samples_remaining = num_samples;
-    int32_t *temp_buffer = NULL;
-    WavpackWriterContext raw_wv;
-    WavpackConfig config;
-    WavpackContext *wpc;
+// Strided (non-contiguous) sources, e.g. a channel subset of a larger array, are gathered into the 32-bit
+// buffer in the same pass. The strides are in bytes, between consecutive frames and consecutive channels.
+
+#define WIDEN_STRIDED(type, expr)                                           \
+    for (f = 0; f < num_frames; f++) {                                      \
+        const char *fptr = src + (ptrdiff_t) f * frame_stride;              \
+                                                                            \
+        for (c = 0; c < num_chans; c++) {                                   \
+            type value = *(const type *) (fptr + (ptrdiff_t) c * chan_stride); \
+            *dst++ = (expr);                                                \
+        }                                                                   \
+    }
 
-    memset (&raw_wv, 0, sizeof (WavpackWriterContext));
-    raw_wv.bytes_available = destin_bytes;
-    raw_wv.data = destin;
+static void widen_strided (int32_t *WV_RESTRICT dst, const char *WV_RESTRICT src, size_t num_frames, size_t num_chans,
+                           ptrdiff_t frame_stride, ptrdiff_t chan_stride, dtype_enum dtype)
+{
+    size_t f, c;
 
-    wpc = WavpackOpenFileOutput (write_block, &raw_wv, NULL);
+    switch (dtype) {
+        case int8:
+            WIDEN_STRIDED (int8_t, value);
+            break;
 
-    if (!wpc) {
-        fprintf (stderr, "could not create WavPack context\n");
-        return -1;
+        case int16:
+            WIDEN_STRIDED (int16_t, value);
+            break;
+
+        case int32: case float32:
+            WIDEN_STRIDED (int32_t, value);
+            break;
+
+        case uint8:
+            WIDEN_STRIDED (uint8_t, (int32_t) value - UINT8_OFFSET);
+            break;
+
+        case uint16:
+            WIDEN_STRIDED (uint16_t, (int32_t) value - UINT16_OFFSET);
+            break;
+
+        case uint32:
+            WIDEN_STRIDED (uint32_t, (int32_t) (value ^ UINT32_SIGN_BIT));
+            break;
+    }
+}
+
+// Returns 1 if the samples must be converted before being passed to the library, which takes contiguous
+// signed 32-bit samples (float samples are passed as their 32-bit patterns).
+
+static int needs_conversion (dtype_enum dtype, size_t num_chans, ptrdiff_t frame_stride, ptrdiff_t chan_stride)
+{
+    ptrdiff_t bytes_per_sample = get_bytes_per_sample (dtype);
+
+    return bytes_per_sample != 4 || dtype == uint32 ||
+        chan_stride != bytes_per_sample || frame_stride != (ptrdiff_t) num_chans * bytes_per_sample;
+}
+
+// Configure an opened context for encoding num_chans channels of the given data type, with the given options,
+// samples per block and total number of samples (-1 if unknown, e.g. when streaming). With create_wvc, the
+// hybrid mode also writes a correction ("wvc") stream. Returns 1 on success and 0 on error.
+
+static int configure_encoder (WavpackContext *wpc, size_t num_chans, const WavpackEncodeOptions *options,
+                              dtype_enum dtype, size_t block_samples, int64_t total_samples, int create_wvc)
+{
+    int bytes_per_sample = get_bytes_per_sample (dtype);
+    int fp = dtype == float32;
+    int qmode = 0;
+    WavpackConfig config;
+
+    if (!bytes_per_sample) {
+        fprintf (stderr, "WavPack unsupported data type %d\n", dtype);
+        return 0;
     }
 
+    if (dtype == int8)
+        qmode = QMODE_SIGNED_BYTES;
+    else if (dtype == uint8 || dtype == uint16 || dtype == uint32)
+        qmode = QMODE_UNSIGNED_WORDS;
+
     memset (&config, 0, sizeof (WavpackConfig));
     config.num_channels = num_chans;
     config.bytes_per_sample = bytes_per_sample;
     config.bits_per_sample = (int) bytes_per_sample * 8;
     config.sample_rate = 32000;     // doesn't need to be correct, although it might be nice
     config.float_norm_exp = fp ? 127 : 0;
+    config.qmode = qmode;
 
-    config.block_samples = num_samples;
-
-    while (config.block_samples > 120000)
-        config.block_samples = (config.block_samples + 1) >> 1;
+    config.block_samples = block_samples;
 
     config.flags = CONFIG_PAIR_UNDEF_CHANS;
 
-    if (level == 1)
+    if (options->level == 1)
         config.flags |= CONFIG_FAST_FLAG;
-    else if (level == 3)
+    else if (options->level == 3)
         config.flags |= CONFIG_HIGH_FLAG;
-    else if (level == 4)
+    else if (options->level == 4)
         config.flags |= CONFIG_HIGH_FLAG | CONFIG_VERY_HIGH_FLAG;
-    else if (level != 2) {
-        fprintf (stderr, "WavPack configuration error (level = %d, range = 1-4)\n", level);
-        WavpackCloseFile (wpc);
-        return -1;
+    else if (options->level != 2) {
+        fprintf (stderr, "WavPack configuration error (level = %d, range = 1-4)\n", options->level);
+        return 0;
     }
 
-    if (bps > 0.0) {
+    if (options->bps > 0.0) {
         config.flags = CONFIG_HYBRID_FLAG;
-        config.bitrate = bps;
+        config.bitrate = options->bps;
+
+        if (create_wvc)
+            config.flags |= CONFIG_CREATE_WVC;
     }
+    else if (create_wvc) {
+        fprintf (stderr, "WavPack configuration error (correction stream without hybrid mode)\n");
+        return 0;
+    }
+
+    if (options->extra < 0 || options->extra > 6) {
+        fprintf (stderr, "WavPack configuration error (extra = %d, range = 0-6)\n", options->extra);
+        return 0;
+    }
+
+    if (options->extra) {
+        config.flags |= CONFIG_EXTRA_MODE;
+        config.xmode = options->extra;
+    }
+
+    if (options->joint_stereo >= 0) {
+        config.flags |= CONFIG_JOINT_OVERRIDE;
 
-    if (!WavpackSetConfiguration (wpc, &config, num_samples)) {
+        if (options->joint_stereo)
+            config.flags |= CONFIG_JOINT_STEREO;
+    }
+
+    if (!WavpackSetConfiguration64 (wpc, &config, total_samples, NULL)) {
         fprintf (stderr, "WavPack configuration error\n");
-        WavpackCloseFile (wpc);
-        return -1;
+        return 0;
     }
 
     if (!WavpackPackInit (wpc)) {
         fprintf (stderr, "WavPack initialization failed\n");
-        WavpackCloseFile (wpc);
-        return -1;
+        return 0;
     }
 
-    if (bytes_per_sample != 4)
-        temp_buffer = malloc (BUFFER_SAMPLES * num_chans * sizeof (int32_t));
+    return 1;
+}
 
-    while (num_samples_remaining) {
-        int samples_to_encode = num_samples_remaining < BUFFER_SAMPLES ?
-            num_samples_remaining :
-            BUFFER_SAMPLES;
-        int samples_to_copy = samples_to_encode * num_chans;
+// Allocate a buffer to widen batches of batch_samples frames, capped to SCRATCH_SAMPLES samples. The number
+// of samples of the buffer is written to scratch_samples.
+
+static int32_t *alloc_scratch (size_t batch_samples, size_t num_chans, size_t *scratch_samples)
+{
+    size_t samples = batch_samples * num_chans < SCRATCH_SAMPLES ? batch_samples * num_chans : SCRATCH_SAMPLES;
 
-        // copy buffer in case not 32-bit
-        if (bytes_per_sample != 4)
-        {
-            int32_t *dptr = temp_buffer;
-            
-            switch (dtype_chosen) {
-                case int8:
-                    while (samples_to_copy--)
-                        *dptr++ = *source_int8++;
+    if (samples < num_chans)
+        samples = num_chans;
 
-                    break;
+    *scratch_samples = samples;
+    return malloc (samples * sizeof (int32_t));
+}
 
-                case int16:
-                    while (samples_to_copy--)
-                        *dptr++ = *source_int16++;
+// Pack num_samples composite samples (i.e., frames) into an opened and configured context, passing them to
+// the library in batches of up to batch_samples frames. The source can be strided (see widen_strided()).
+// Samples that are not contiguous signed 32-bit are converted in the temp buffer first, which must hold
+// batch_samples frames. The time spent converting and packing is added to the optional timings. Returns 1
+// on success and 0 on error.
 
-                    break;
+static int pack_frames (WavpackContext *wpc, void *source_char, size_t num_samples, size_t num_chans,
+                        ptrdiff_t frame_stride, ptrdiff_t chan_stride, dtype_enum dtype, int32_t *temp_buffer,
+                        size_t batch_samples, WavpackTimings *timings)
+{
+    char *source_ptr = source_char;
+    int bytes_per_sample = get_bytes_per_sample (dtype);
+    int convert = needs_conversion (dtype, num_chans, frame_stride, chan_stride);
+    int contiguous = chan_stride == bytes_per_sample && frame_stride == (ptrdiff_t) num_chans * bytes_per_sample;
 
-                default:        // we shouldn't get here, but suppress compiler warning
-                    break;
-            }
-        }
+    while (num_samples) {
+        size_t samples_to_encode = num_samples < batch_samples ? num_samples : batch_samples;
+        double t_start = timings ? timings_clock () : 0.0, t_converted;
 
-        if (!WavpackPackSamples (wpc, temp_buffer ? temp_buffer : source_int32, samples_to_encode)) {
+        // widen (and gather) the batch in case samples are not contiguous signed 32-bit
+        if (convert && contiguous)
+            widen_samples (temp_buffer, source_ptr, samples_to_encode * num_chans, dtype);
+        else if (convert)
+            widen_strided (temp_buffer, source_ptr, samples_to_encode, num_chans, frame_stride, chan_stride, dtype);
+
+        t_converted = timings ? timings_clock () : 0.0;
+
+        if (!WavpackPackSamples (wpc, convert ? temp_buffer : (int32_t *) source_ptr, (uint32_t) samples_to_encode)) {
             fprintf (stderr, "WavPack encoding failed\n");
-            free (temp_buffer);
+            return 0;
+        }
+
+        if (timings) {
+            timings->convert_seconds += t_converted - t_start;
+            timings->codec_seconds += timings_clock () - t_converted;
+        }
+
+        num_samples -= samples_to_encode;
+        source_ptr += (ptrdiff_t) samples_to_encode * frame_stride;
+    }
+
+    return 1;
+}
+
+// This is the single function for completely encoding a WavPack file from memory to memory, for audio of
+// any supported data type in any number of channels. The options (see WavpackEncodeOptions) select the speed
+// mode (level, from 1 - 4), the number of bits to allocate for each sample in hybrid mode (bps, minimum:
+// about 2.25, or 0.0 for lossless encoding), the samples per block and the extra processing and joint stereo
+// modes. The destination must be large enough for the entire file: a destination of
+// WavpackEncodeBound() bytes is always large enough. In hybrid mode, the correction stream that restores the
+// lossless data is written to the optional wvc_destin (of wvc_destin_bytes bytes, with the same bound), and
+// its size to wvc_bytes_used. The source can be strided, with frame_stride and
+// chan_stride bytes between consecutive frames and channels. The optional scratch buffer of scratch_samples
+// 32-bit samples is used to convert the samples (if NULL, a buffer is allocated when needed). The time spent
+// converting the samples and in the library is added to the optional timings (see WavpackTimings). The return
+// value is the number of bytes generated, or (size_t) -1 if there was not enough space to encode to (or some
+// other error).
+
+size_t WavpackEncodeFile (void *source_char, size_t num_samples, size_t num_chans, ptrdiff_t frame_stride,
+                          ptrdiff_t chan_stride, const WavpackEncodeOptions *options, void *destin, size_t destin_bytes,
+                          void *wvc_destin, size_t wvc_destin_bytes, size_t *wvc_bytes_used, int dtype,
+                          int32_t *scratch, size_t scratch_samples, WavpackTimings *timings)
+{   
+    dtype_enum dtype_chosen = (dtype_enum) dtype;
+    int convert = needs_conversion (dtype_chosen, num_chans, frame_stride, chan_stride);
+    size_t block_samples = get_block_samples (num_samples, options->block_samples);
+    size_t batch_samples = block_samples;
+    int32_t *temp_buffer = NULL;
+    WavpackWriterContext raw_wv, raw_wvc;
+    WavpackContext *wpc;
+    double flush_start;
+    int pack_ok;
+
+    memset (&raw_wv, 0, sizeof (WavpackWriterContext));
+    raw_wv.bytes_available = destin_bytes;
+    raw_wv.data = destin;
+
+    memset (&raw_wvc, 0, sizeof (WavpackWriterContext));
+    raw_wvc.bytes_available = wvc_destin_bytes;
+    raw_wvc.data = wvc_destin;
+
+    wpc = WavpackOpenFileOutput (write_block, &raw_wv, wvc_destin ? &raw_wvc : NULL);
+
+    if (!wpc) {
+        fprintf (stderr, "could not create WavPack context\n");
+        return -1;
+    }
+
+    if (!configure_encoder (wpc, num_chans, options, dtype_chosen, block_samples, num_samples, wvc_destin != NULL)) {
+        WavpackCloseFile (wpc);
+        return -1;
+    }
+
+    if (convert) {
+        if (scratch && scratch_samples >= num_chans)
+            temp_buffer = scratch;
+        else if (!(temp_buffer = alloc_scratch (block_samples, num_chans, &scratch_samples))) {
+            fprintf (stderr, "WavPack could not allocate the conversion buffer\n");
             WavpackCloseFile (wpc);
             return -1;
         }
 
-        num_samples_remaining -= samples_to_encode;
-
-        if (bytes_per_sample == 4)
-            source_int32 += samples_to_copy;
+        if (batch_samples > scratch_samples / num_chans)
+            batch_samples = scratch_samples / num_chans;
     }
 
-    free (temp_buffer);
+    pack_ok = pack_frames (wpc, source_char, num_samples, num_chans, frame_stride, chan_stride, dtype_chosen, temp_buffer,
+                           batch_samples, timings);
+
+    if (temp_buffer != scratch)
+        free (temp_buffer);
+
+    if (!pack_ok) {
+        WavpackCloseFile (wpc);
+        return -1;
+    }
         
+    flush_start = timings ? timings_clock () : 0.0;
+
     if (!WavpackFlushSamples (wpc)) {
         fprintf (stderr, "WavPack flush failed\n");
         WavpackCloseFile (wpc);
         return -1;
     }
 
+    if (timings)
+        timings->codec_seconds += timings_clock () - flush_start;
+
     WavpackCloseFile (wpc);
 
-    return raw_wv.overflow ? -1 : raw_wv.bytes_used;
+    if (wvc_bytes_used)
+        *wvc_bytes_used = raw_wvc.bytes_used;
+
+    return raw_wv.overflow || raw_wvc.overflow ? (size_t) -1 : raw_wv.bytes_used;
+}
+
+// Streams encoded from consecutive ranges of the frames of a chunk (e.g. by the threads of a parallel encoding)
+// can be concatenated into a single valid stream, because WavPack blocks are independent. This function rebases
+// the blocks of the stream of the range starting at frame first_sample of a chunk of total_samples frames: the
+// block index and total number of samples of each block header are rewritten and the block checksums (which
+// cover the header) are recomputed. Returns 1 on success and 0 if an invalid block is found.
+
+int WavpackRebaseBlocks (void *data, size_t bytes, int64_t first_sample, int64_t total_samples)
+{
+    unsigned char *sptr = (unsigned char *) data, *eptr = sptr + bytes;
+    WavpackHeader wphdr;
+
+    while (eptr - sptr >= (ptrdiff_t) sizeof (WavpackHeader)) {
+        unsigned char *block = sptr, *dp, *block_end;
+
+        if (memcmp (sptr, "wvpk", 4))
+            return 0;
+
+        memcpy (&wphdr, sptr, sizeof (WavpackHeader));
+        WavpackLittleEndianToNative (&wphdr, WavpackHeaderFormat);
+
+        if (wphdr.ckSize + 8 > (uint64_t) (eptr - sptr) || wphdr.ckSize + 8 < sizeof (WavpackHeader))
+            return 0;
+
+        block_end = block + wphdr.ckSize + 8;
+        SET_BLOCK_INDEX (wphdr, GET_BLOCK_INDEX (wphdr) + first_sample);
+        SET_TOTAL_SAMPLES (wphdr, total_samples);
+        WavpackNativeToLittleEndian (&wphdr, WavpackHeaderFormat);
+        memcpy (block, &wphdr, sizeof (WavpackHeader));
+        WavpackLittleEndianToNative (&wphdr, WavpackHeaderFormat);
+
+        // the checksum sub-block covers the 16-bit words of the block that precede it
+        for (dp = block + sizeof (WavpackHeader); (wphdr.flags & HAS_CHECKSUM) && block_end - dp >= 2;) {
+            unsigned char meta_id = dp [0], *meta_start = dp;
+            uint32_t meta_bc = (uint32_t) dp [1] << 1;
+
+            dp += 2;
+
+            if (meta_id & ID_LARGE) {
+                if (block_end - dp < 2)
+                    return 0;
+
+                meta_bc += ((uint32_t) dp [0] << 9) + ((uint32_t) dp [1] << 17);
+                dp += 2;
+            }
+
+            if ((uint32_t) (block_end - dp) < meta_bc)
+                return 0;
+
+            if ((meta_id & ID_UNIQUE) == ID_BLOCK_CHECKSUM && (meta_bc == 2 || meta_bc == 4)) {
+                uint32_t csum = (uint32_t) -1;
+                unsigned char *csptr;
+
+                for (csptr = block; csptr < meta_start; csptr += 2)
+                    csum = (csum * 3) + csptr [0] + ((uint32_t) csptr [1] << 8);
+
+                if (meta_bc == 2)
+                    csum ^= csum >> 16;
+
+                dp [0] = csum & 0xff;
+                dp [1] = (csum >> 8) & 0xff;
+
+                if (meta_bc == 4) {
+                    dp [2] = (csum >> 16) & 0xff;
+                    dp [3] = (csum >> 24) & 0xff;
+                }
+            }
+
+            dp += meta_bc;
+        }
+
+        sptr = block_end;
+    }
+
+    return sptr == eptr;
+}
+
+// The stream encoder keeps a context open to encode frames incrementally, as they are written. The total
+// number of samples is unknown when the stream is started, so it is not stored in the block headers and
+// decoders count the samples of the blocks instead. Finished blocks accumulate in a growable output buffer
+// that the caller drains after each write, so memory use is bounded by about one block.
+
+typedef struct {
+    WavpackContext *wpc;
+    WavpackWriterContext output;
+    dtype_enum dtype;
+    size_t num_chans, batch_samples;
+    int32_t *temp_buffer;
+} WavpackStreamEncoder;
+
+void WavpackStreamEncoderClose (WavpackStreamEncoder *encoder);
+
+// Open a stream encoder (see WavpackEncodeFile() for the parameters). If options->block_samples is 0, the
+// blocks have the default length of the library. Returns NULL on error.
+
+WavpackStreamEncoder *WavpackStreamEncoderOpen (size_t num_chans, const WavpackEncodeOptions *options, int dtype)
+{
+    WavpackStreamEncoder *encoder = calloc (1, sizeof (WavpackStreamEncoder));
+    size_t block_samples = options->block_samples;
+    size_t scratch_samples;
+
+    if (!encoder)
+        return NULL;
+
+    encoder->dtype = (dtype_enum) dtype;
+    encoder->num_chans = num_chans;
+    encoder->output.growable = 1;
+
+    if (block_samples && block_samples < MIN_BLOCK_SAMPLES)
+        block_samples = MIN_BLOCK_SAMPLES;
+
+    encoder->wpc = WavpackOpenFileOutput (write_block, &encoder->output, NULL);
+
+    if (!encoder->wpc || !configure_encoder (encoder->wpc, num_chans, options, encoder->dtype, block_samples, -1, 0)) {
+        WavpackStreamEncoderClose (encoder);
+        return NULL;
+    }
+
+    // the frames of each write can be strided, so a conversion buffer is always needed
+    if (!(encoder->temp_buffer = alloc_scratch (block_samples ? block_samples : SCRATCH_SAMPLES, num_chans,
+                                                &scratch_samples))) {
+        WavpackStreamEncoderClose (encoder);
+        return NULL;
+    }
+
+    encoder->batch_samples = scratch_samples / num_chans;
+    return encoder;
+}
+
+// Encode num_samples composite samples (i.e., frames), with frame_stride and chan_stride bytes between
+// consecutive frames and channels. Blocks are written to the output buffer as they are finished (see
+// WavpackStreamEncoderOutput()). Returns 1 on success and 0 on error.
+
+int WavpackStreamEncoderWrite (WavpackStreamEncoder *encoder, void *source, size_t num_samples,
+                               ptrdiff_t frame_stride, ptrdiff_t chan_stride)
+{
+    return pack_frames (encoder->wpc, source, num_samples, encoder->num_chans, frame_stride, chan_stride,
+                        encoder->dtype, encoder->temp_buffer, encoder->batch_samples, NULL) && !encoder->output.overflow;
+}
+
+// Encode the samples of the last, partial, block. Returns 1 on success and 0 on error.
+
+int WavpackStreamEncoderFlush (WavpackStreamEncoder *encoder)
+{
+    return WavpackFlushSamples (encoder->wpc) && !encoder->output.overflow;
+}
+
+// Return the finished blocks written since the output was last cleared, and their size in bytes.
+
+char *WavpackStreamEncoderOutput (WavpackStreamEncoder *encoder, size_t *bytes)
+{
+    *bytes = encoder->output.bytes_used;
+    return encoder->output.data;
+}
+
+void WavpackStreamEncoderClearOutput (WavpackStreamEncoder *encoder)
+{
+    encoder->output.bytes_used = 0;
+}
+
+// Close the context and free the encoder (samples not flushed are lost).
+
+void WavpackStreamEncoderClose (WavpackStreamEncoder *encoder)
+{
+    if (!encoder)
+        return;
+
+    if (encoder->wpc)
+        WavpackCloseFile (encoder->wpc);
+
+    free (encoder->temp_buffer);
+    free (encoder->output.data);
+    free (encoder);
 }
@@ -0,0 +1,113 @@
+"""
+Invertible inter-channel prefilters, applied to integer chunks before WavPack encoding.
+
+WavPack only decorrelates the channels of stereo pairs, so the common-mode component shared by the channels
+of extracellular recordings is encoded once per channel. A prefilter removes it before encoding:
+
+    "median"    the integer median across channels of each frame (the common median reference) is subtracted
+                from every channel, and stored as an extra single-channel stream
+    "delta"     each channel is replaced by its difference with the previous channel (of its channel group,
+                so that groups remain independent)
+
+The residuals are computed with wrap-around (modular) arithmetic in the signed integer dtype of the same width,
+so the prefilters are exactly invertible for any data (unsigned data is first offset to the signed range).
+Prefiltered chunks are stored in a container, whose header records the prefilter.
+"""
+import numpy as np
+
+
+PREFILTERS = ("median", "delta")
+
+
+def residual_dtype(dtype):
+    """Returns the dtype of the residual streams of a prefiltered chunk of `dtype`"""
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu":
+        raise ValueError(f"Prefilters only support integer dtypes, got {dtype}")
+    return np.dtype(f"int{dtype.itemsize * 8}")
+
+
+def _to_signed(data):
+    # signed copy of the data (unsigned data is offset by half its range, i.e. its sign bit is flipped)
+    dtype = residual_dtype(data.dtype)
+    if data.dtype.kind == "u":
+        return (data ^ data.dtype.type(1 << (dtype.itemsize * 8 - 1))).view(dtype)
+    return data.copy()
+
+
+def _from_signed(data, dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind == "u":
+        data = data.view(dtype)
+        data ^= dtype.type(1 << (dtype.itemsize * 8 - 1))
+    return data
+
+
+def apply_prefilter(data, prefilter, channel_groups):
+    """
+    Computes the residuals of a 2D integer chunk.
+
+    Parameters
+    ----------
+    data : np.array
+        The chunk, with shape (num_frames, num_channels)
+    prefilter : str
+        The prefilter ("median" or "delta")
+    channel_groups : list of [start, stop]
+        The channel groups encoded as independent streams
+
+    Returns
+    -------
+    residuals : list of np.array
+        The C-contiguous residuals of each channel group, in the signed dtype of the same width
+    reference : np.array or None
+        The common reference, with shape (num_frames, 1), for the "median" prefilter
+    """
+    if prefilter not in PREFILTERS:
+        raise ValueError(f"Unknown prefilter {prefilter!r}, use one of {list(PREFILTERS)}")
+    signed = _to_signed(data)
+    reference = None
+    if prefilter == "median":
+        # the lower median is one of the samples, so it is an integer of the same dtype
+        kth = (signed.shape[1] - 1) // 2
+        reference = np.partition(signed, kth, axis=1)[:, kth:kth + 1].copy()
+        signed -= reference
+        return [np.ascontiguousarray(signed[:, start:stop]) for start, stop in channel_groups], reference
+
+    residuals = []
+    for start, stop in channel_groups:
+        group = signed[:, start:stop]
+        residual = np.empty_like(group, order="C")
+        residual[:, 0] = group[:, 0]
+        np.subtract(group[:, 1:], group[:, :-1], out=residual[:, 1:])
+        residuals.append(residual)
+    return residuals, reference
+
+
+def invert_prefilter(residuals, prefilter, dtype, reference=None):
+    """
+    Restores the channels of a group from their residuals, in place.
+
+    Parameters
+    ----------
+    residuals : np.array
+        The decoded residuals of (all the channels of) a channel group, in the signed residual dtype
+    prefilter : str
+        The prefilter ("median" or "delta")
+    dtype : np.dtype
+        The dtype of the chunk
+    reference : np.array or None
+        The decoded common reference (frames aligned with the residuals), for the "median" prefilter
+
+    Returns
+    -------
+    np.array
+        The restored channels, as a view of `residuals` with the chunk dtype
+    """
+    if prefilter == "median":
+        np.add(residuals, reference, out=residuals)
+    elif prefilter == "delta":
+        np.cumsum(residuals, axis=1, dtype=residuals.dtype, out=residuals)
+    else:
+        raise ValueError(f"Unknown prefilter {prefilter!r}")
+    return _from_signed(residuals, dtype)
@@ -0,0 +1,102 @@
+"""
+Lossy quantization of float32 chunks to scaled integers, so that WavPack encodes them with its integer path.
+
+Each channel is mapped to integers with its own scale and offset:
+
+    quantized = round((data - offset) / scale)      (encoded as int16 or int32 streams)
+    decoded = quantized * scale + offset            (computed in float64, then rounded to float32)
+
+The scale is either derived from a maximum absolute error (scale = 2 * max_error, so that rounding errs by at
+most max_error) or chosen so that the range of each channel spans the quantized dtype. The dtype, scales and
+offsets are stored in the chunk header, so that decoding does not depend on the codec parameters.
+"""
+import numpy as np
+
+
+QUANTIZE_DTYPES = ("int16", "int32")
+
+
+def apply_quantization(data, dtype, max_error=None):
+    """
+    Quantizes a 2D float chunk, channel by channel.
+
+    Parameters
+    ----------
+    data : np.array
+        The chunk, with shape (num_frames, num_channels)
+    dtype : str
+        The quantized dtype ("int16" or "int32"). With `max_error`, int16 channels whose range does not fit
+        are quantized to int32
+    max_error : float or None, optional
+        The maximum absolute error of the quantized samples (before the float32 rounding of the decoded
+        samples). If None, the range of each channel spans the quantized dtype, by default None
+
+    Returns
+    -------
+    quantized : np.array
+        The C-contiguous quantized chunk
+    params : dict
+        The quantized "dtype" and the "scale" and "offset" of each channel, to be stored with the chunk
+    """
+    if dtype not in QUANTIZE_DTYPES:
+        raise ValueError(f"Unknown quantized dtype {dtype!r}, use one of {list(QUANTIZE_DTYPES)}")
+    values = data.astype("float64")
+    if not np.all(np.isfinite(values)):
+        raise ValueError("Chunks with non-finite values (NaN or inf) cannot be quantized")
+    if values.shape[0] == 0:
+        offset = np.zeros(values.shape[1])
+        half_range = np.zeros(values.shape[1])
+    else:
+        low, high = values.min(axis=0), values.max(axis=0)
+        offset = (low + high) / 2
+        half_range = (high - low) / 2
+
+    # the largest quantized value is kept 1 below the dtype maximum to leave room for rounding
+    if max_error is None:
+        limit = np.iinfo(dtype).max - 1
+        scale = np.where(half_range > 0, half_range / limit, 1.0)
+    else:
+        if max_error <= 0:
+            raise ValueError("max_error must be positive")
+        scale = np.full(values.shape[1], 2.0 * max_error)
+        max_quantized = float(np.max(half_range / scale, initial=0))
+        if dtype == "int16" and max_quantized > np.iinfo("int16").max - 1:
+            dtype = "int32"
+        if max_quantized > np.iinfo(dtype).max - 1:
+            raise ValueError(f"The range of the chunk cannot be quantized to {dtype} with max_error={max_error}")
+
+    values -= offset
+    values /= scale
+    quantized = np.rint(values).astype(dtype)
+    return quantized, dict(dtype=dtype, scale=scale.tolist(), offset=offset.tolist())
+
+
+def invert_quantization(quantized, params, dtype, channels=slice(None), out=None):
+    """
+    Restores float samples from quantized samples.
+
+    Parameters
+    ----------
+    quantized : np.array
+        The quantized samples, with shape (num_frames, num_selected_channels)
+    params : dict
+        The quantization parameters returned by `apply_quantization`
+    dtype : np.dtype
+        The dtype of the chunk
+    channels : slice or array of indices, optional
+        The channels of `quantized` (indices of the quantized chunk), by default all the channels
+    out : np.array or None, optional
+        Array to write the samples into, by default None
+
+    Returns
+    -------
+    np.array
+        The dequantized samples
+    """
+    scale = np.asarray(params["scale"], dtype="float64")[channels]
+    offset = np.asarray(params["offset"], dtype="float64")[channels]
+    values = quantized * scale + offset
+    if out is None:
+        return values.astype(dtype)
+    out[...] = values
+    return out
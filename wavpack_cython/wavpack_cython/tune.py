@@ -0,0 +1,165 @@
+"""
+Auto-tuning of the WavPack codec parameters on sample chunks of the data to compress.
+
+`tune` samples chunks of an array (e.g. a memmap of a recording from a new probe), encodes and decodes them with
+every combination of a grid of codec parameters, and returns the config of the Pareto-optimal combination that is
+best for the objective, within the constraints (minimum speeds, maximum error):
+
+    config = tune(recording, objective="size", min_decode_mbps=200)
+    codec = numcodecs.get_codec(config)
+"""
+import itertools
+import time
+
+import numpy as np
+
+from .wavpack import WavPack
+
+
+OBJECTIVES = {
+    "size": "ratio",
+    "encode_speed": "encode_mbps",
+    "decode_speed": "decode_mbps",
+}
+
+
+def _sample_chunks(data, num_chunks, chunk_frames, seed):
+    # non-overlapping chunks at random positions, sliced before conversion so that only the sampled chunks of
+    # memmaps and lazy arrays (e.g. zarr) are read
+    num_frames = data.shape[0]
+    chunk_frames = min(chunk_frames, num_frames)
+    num_slots = num_frames // chunk_frames
+    rng = np.random.default_rng(seed)
+    slots = np.sort(rng.choice(num_slots, size=min(num_chunks, num_slots), replace=False))
+    return [np.asarray(data[slot * chunk_frames:(slot + 1) * chunk_frames]) for slot in slots]
+
+
+def _best_time(func, repeats):
+    times = []
+    result = None
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t_start)
+    return min(times), result
+
+
+def _evaluate(chunks, params, num_threads, repeats):
+    codec = WavPack(**params)
+    nbytes = sum(chunk.nbytes for chunk in chunks)
+    t_encode, encoded = _best_time(lambda: codec.encode_many(chunks, num_threads), repeats)
+    t_decode, decoded = _best_time(lambda: codec.decode_many(encoded, num_threads=num_threads), repeats)
+    max_abs_error = 0.0
+    for chunk, dec in zip(chunks, decoded):
+        if chunk.size:
+            dec = np.asarray(dec).reshape(chunk.shape)
+            max_abs_error = max(max_abs_error, float(np.max(np.abs(dec.astype("float64") - chunk))))
+    return dict(
+        params=params,
+        ratio=nbytes / sum(len(enc) for enc in encoded),
+        encode_mbps=nbytes / t_encode / 1e6,
+        decode_mbps=nbytes / t_decode / 1e6,
+        max_abs_error=max_abs_error,
+    )
+
+
+def _dominates(a, b):
+    # a is at least as good as b on all the metrics, and better on one
+    not_worse = (a["ratio"] >= b["ratio"] and a["encode_mbps"] >= b["encode_mbps"] and
+                 a["decode_mbps"] >= b["decode_mbps"] and a["max_abs_error"] <= b["max_abs_error"])
+    better = (a["ratio"] > b["ratio"] or a["encode_mbps"] > b["encode_mbps"] or
+              a["decode_mbps"] > b["decode_mbps"] or a["max_abs_error"] < b["max_abs_error"])
+    return not_worse and better
+
+
+def tune(data, objective="size", min_encode_mbps=None, min_decode_mbps=None, max_error=None,
+         levels=(1, 2, 3, 4), bps=(None,), block_samples=(None, 4096, 16384), extra=(0,), codec_kwargs=None,
+         num_chunks=4, chunk_frames=30000, num_threads=None, repeats=2, seed=0, return_results=False):
+    """
+    Finds the WavPack codec parameters that are best for an objective on sample chunks of the data.
+
+    Each combination of the parameter grids is evaluated on the same sample chunks, which are encoded and
+    decoded in parallel with `encode_many`/`decode_many`. Among the combinations that satisfy the constraints,
+    the Pareto-optimal ones (not beaten on compression ratio, encode speed, decode speed and error by any other
+    combination) are kept, and the best one for the objective is returned.
+
+    Parameters
+    ----------
+    data : np.array or array-like
+        The data to sample chunks from (e.g. a memmap or a zarr array, of which only the sampled chunks are
+        read), with frames along the first dimension
+    objective : str, optional
+        The metric to optimize: "size" (highest compression ratio), "encode_speed" or "decode_speed",
+        by default "size"
+    min_encode_mbps : float or None, optional
+        The minimum encode throughput (MB/s of raw data, with `num_threads` threads), by default None
+    min_decode_mbps : float or None, optional
+        The minimum decode throughput (MB/s of raw data, with `num_threads` threads), by default None
+    max_error : float or None, optional
+        The maximum absolute error of lossy (hybrid) combinations, by default None
+    levels : sequence of int, optional
+        The levels to try, by default (1, 2, 3, 4)
+    bps : sequence of float or None, optional
+        The hybrid bits per sample to try (None for lossless). Only lossless combinations are tried by default:
+        lossy ones always compress more, so pass the `bps` values to try (e.g. (None, 3, 4, 6)) together with
+        `max_error` to tune lossy compression, by default (None,)
+    block_samples : sequence of int or None, optional
+        The block sizes to try (None for the default), by default (None, 4096, 16384)
+    extra : sequence of int, optional
+        The extra processing levels to try, by default (0,)
+    codec_kwargs : dict or None, optional
+        Other arguments of the codec, used for all the combinations (e.g. channel_group_size), by default None
+    num_chunks : int, optional
+        The number of chunks to sample, by default 4
+    chunk_frames : int, optional
+        The number of frames of each sampled chunk, by default 30000
+    num_threads : int or None, optional
+        The number of threads to encode/decode the chunks with. If None, the number of CPUs is used,
+        by default None
+    repeats : int, optional
+        The number of times each combination is timed (the best time is used), by default 2
+    seed : int, optional
+        The seed of the random positions of the sampled chunks, by default 0
+    return_results : bool, optional
+        If True, the metrics of all the combinations are also returned, by default False
+
+    Returns
+    -------
+    config : dict
+        The codec config (see `WavPack.get_config`) of the best combination, to be used with
+        `numcodecs.get_codec`
+    results : list of dict
+        If `return_results` is True, the params, ratio, encode_mbps, decode_mbps and max_abs_error of each
+        combination, with "feasible" and "pareto" flags
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective {objective!r}, use one of {list(OBJECTIVES)}")
+    if not hasattr(data, "shape"):
+        data = np.asarray(data)
+    if len(data.shape) == 0 or data.shape[0] == 0:
+        raise ValueError("Cannot tune on empty data")
+    chunks = _sample_chunks(data, num_chunks, chunk_frames, seed)
+
+    results = []
+    for level, hybrid_bps, block_size, extra_level in itertools.product(levels, bps, block_samples, extra):
+        params = dict(codec_kwargs or {}, level=level, bps=hybrid_bps, block_samples=block_size, extra=extra_level)
+        results.append(_evaluate(chunks, params, num_threads, repeats))
+
+    for result in results:
+        result["feasible"] = ((min_encode_mbps is None or result["encode_mbps"] >= min_encode_mbps) and
+                              (min_decode_mbps is None or result["decode_mbps"] >= min_decode_mbps) and
+                              (max_error is None or result["max_abs_error"] <= max_error))
+    feasible = [result for result in results if result["feasible"]]
+    for result in results:
+        result["pareto"] = result["feasible"] and not any(_dominates(other, result) for other in feasible)
+
+    pareto = [result for result in results if result["pareto"]]
+    if not pareto:
+        raise ValueError("No parameter combination satisfies the constraints: best encode/decode speeds "
+                         f"{max(r['encode_mbps'] for r in results):.1f}/{max(r['decode_mbps'] for r in results):.1f} "
+                         f"MB/s, smallest error {min(r['max_abs_error'] for r in results)}")
+    best = max(pareto, key=lambda result: result[OBJECTIVES[objective]])
+    config = WavPack(**best["params"]).get_config()
+    if return_results:
+        return config, results
+    return config
@@ -5,16 +5,32 @@
 # cython: language_level=3
 
 
-from cpython.buffer cimport PyBUF_ANY_CONTIGUOUS, PyBUF_WRITEABLE
+from cpython.buffer cimport PyBUF_ANY_CONTIGUOUS, PyBUF_STRIDES, PyBUF_WRITEABLE, PyBuffer_IsContiguous
 from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from cpython.object cimport PyObject
+from cpython.ref cimport Py_XDECREF
+from libc.stddef cimport ptrdiff_t
+from libc.stdint cimport int32_t, int64_t
+from libc.stdlib cimport calloc, malloc, free
+from libc.string cimport memcpy
+from cython.parallel cimport prange, threadid
 
 
 from .compat_ext cimport Buffer
 from .compat_ext import Buffer
-from numcodecs.compat import ensure_contiguous_ndarray
+from wavpack_common.container import CONTAINER_MAGIC, header_size, is_container, pack_container, unpack_container
+from .prefilter import PREFILTERS, apply_prefilter, invert_prefilter, residual_dtype
+from .quantize import QUANTIZE_DTYPES, apply_quantization, invert_quantization
+from wavpack_common.stats import CodecStats
+from numcodecs.compat import ensure_contiguous_ndarray, ndarray_copy
 from numcodecs.abc import Codec
 
 from pathlib import Path
+import collections
+import os
+import struct
+import threading
+import time
 import numpy as np
 
 
@@ -23,74 +39,345 @@ parent = Path(__file__).parent
 cdef extern from "wavpack/wavpack_local.h":
     const char* WavpackGetLibraryVersionString()
 
+cdef extern from "Python.h":
+    # owned reference, to be resized in place with _PyBytes_Resize
+    PyObject *_bytes_new "PyBytes_FromStringAndSize" (const char *v, Py_ssize_t size) except NULL
+    int _PyBytes_Resize(PyObject **bytes, Py_ssize_t newsize) except -1
+
 cdef extern from "encoder.c":
-    size_t WavpackEncodeFile (void *source, size_t num_samples, size_t num_chans, int level, float bps, void *destin, 
-                              size_t destin_bytes, int dtype)
+    int SCRATCH_SAMPLES
+
+    ctypedef struct WavpackEncodeOptions:
+        int level
+        float bps
+        size_t block_samples
+        int extra
+        int joint_stereo
+
+    ctypedef struct WavpackTimings:
+        double convert_seconds
+        double codec_seconds
+
+    size_t WavpackEncodeBound (size_t num_samples, size_t num_chans, int dtype, size_t block_samples) nogil
+    size_t get_block_samples (size_t num_samples, size_t requested_samples) nogil
+    int WavpackRebaseBlocks (void *data, size_t bytes, int64_t first_sample, int64_t total_samples) nogil
+    size_t WavpackEncodeFile (void *source, size_t num_samples, size_t num_chans, ptrdiff_t frame_stride,
+                              ptrdiff_t chan_stride, const WavpackEncodeOptions *options, void *destin,
+                              size_t destin_bytes, void *wvc_destin, size_t wvc_destin_bytes,
+                              size_t *wvc_bytes_used, int dtype, int32_t *scratch, size_t scratch_samples,
+                              WavpackTimings *timings) nogil
+
+    ctypedef struct WavpackStreamEncoder:
+        pass
+
+    WavpackStreamEncoder *WavpackStreamEncoderOpen (size_t num_chans, const WavpackEncodeOptions *options,
+                                                    int dtype) nogil
+    int WavpackStreamEncoderWrite (WavpackStreamEncoder *encoder, void *source, size_t num_samples,
+                                   ptrdiff_t frame_stride, ptrdiff_t chan_stride) nogil
+    int WavpackStreamEncoderFlush (WavpackStreamEncoder *encoder) nogil
+    char *WavpackStreamEncoderOutput (WavpackStreamEncoder *encoder, size_t *bytes) nogil
+    void WavpackStreamEncoderClearOutput (WavpackStreamEncoder *encoder) nogil
+    void WavpackStreamEncoderClose (WavpackStreamEncoder *encoder) nogil
 
 cdef extern from "decoder.c":
-    size_t WavpackDecodeFile (void *source, size_t source_bytes, int *num_chans, int *bytes_per_sample, void *destin, 
-                              size_t destin_bytes)
+    size_t WavpackDecodeFile (void *source, size_t source_bytes, void *wvc_source, size_t wvc_source_bytes,
+                              int *num_chans, int *bytes_per_sample, void *destin, size_t destin_bytes,
+                              int32_t *scratch, size_t scratch_samples, int open_flags,
+                              WavpackTimings *timings) nogil
+    size_t WavpackDecodeRange (void *source, size_t source_bytes, void *wvc_source, size_t wvc_source_bytes,
+                               size_t start_sample, size_t num_samples, int *num_chans, int *bytes_per_sample,
+                               void *destin, size_t destin_bytes, int32_t *scratch, size_t scratch_samples,
+                               int open_flags, WavpackTimings *timings) nogil
+    int WavpackGetStreamInfo (void *source, size_t source_bytes, int64_t *num_samples, int *num_chans,
+                              int *bytes_per_sample, int *mode, int *qmode) nogil
+    int64_t WavpackCountSamples (void *source, size_t source_bytes) nogil
+
+    ctypedef struct WavpackStreamDecoder:
+        pass
+
+    WavpackStreamDecoder *WavpackStreamDecoderOpen (void *source, size_t source_bytes, void *wvc_source,
+                                                    size_t wvc_source_bytes, int *num_chans,
+                                                    int *bytes_per_sample, int open_flags) nogil
+    size_t WavpackStreamDecoderRead (WavpackStreamDecoder *decoder, void *destin, size_t num_samples) nogil
+    void WavpackStreamDecoderClose (WavpackStreamDecoder *decoder) nogil
+
+cdef extern from "wavpack/wavpack.h":
+    int MODE_FLOAT
+    int QMODE_UNSIGNED_WORDS
+    int OPEN_NO_CHECKSUM
 
 
 VERSION_STRING = WavpackGetLibraryVersionString()
 VERSION_STRING = str(VERSION_STRING, 'ascii')
 __version__ = VERSION_STRING
 
+_thread_state = threading.local()
+
+# ckSize and flags of a WavPack block header, and the flag of the last block of a group of channel streams
+_block_header = struct.Struct("<4xI16xI")
+_FINAL_BLOCK = 0x1000
+# ckID, ckSize, block_index_u8, block_index, block_samples and flags of a WavPack block header, and the flag of
+# the first block of a frame
+_block_position = struct.Struct("<4sI2xB5xIII")
+_INITIAL_BLOCK = 0x800
+
+
+def _get_scratch():
+    # per-thread buffer used to widen/narrow samples to/from 32 bits, reused across calls
+    scratch = getattr(_thread_state, "scratch", None)
+    if scratch is None:
+        scratch = _thread_state.scratch = np.empty(SCRATCH_SAMPLES, dtype="int32")
+    return scratch
+
 
 dtype_enum = {
     "int8": 0,
     "int16": 1,
     "int32": 2,
-    "float32": 3
+    "float32": 3,
+    "uint8": 4,
+    "uint16": 5,
+    "uint32": 6
 }
+_dtype_itemsize = {dtype_id: np.dtype(dtype).itemsize for dtype, dtype_id in dtype_enum.items()}
+
+
+cdef WavpackEncodeOptions _encode_options(int level, float bps, Py_ssize_t block_samples, int extra,
+                                          int joint_stereo) except *:
+    cdef WavpackEncodeOptions options
+    if block_samples < 0:
+        raise ValueError(f"Invalid block_samples {block_samples}")
+    options.level = level
+    options.bps = bps
+    options.block_samples = block_samples
+    options.extra = extra
+    options.joint_stereo = joint_stereo
+    return options
+
+
+cdef inline int _open_flags(bint verify_checksum):
+    return 0 if verify_checksum else OPEN_NO_CHECKSUM
+
+
+cdef Buffer _correction_buffer(correction, char **ptr, size_t *size):
+    # gets the buffer of an optional correction stream (NULL pointer if None), to be released by the caller
+    cdef Buffer buffer = None
+    ptr[0] = NULL
+    size[0] = 0
+    if correction is not None:
+        buffer = Buffer(correction, PyBUF_ANY_CONTIGUOUS)
+        ptr[0] = buffer.ptr
+        size[0] = buffer.nbytes
+    return buffer
+
+
+cdef _add_timings(dict timings, const WavpackTimings *chunk_timings, Py_ssize_t num_chunks=1):
+    # adds the seconds spent converting samples and in the library to the "convert" and "codec" phases
+    cdef Py_ssize_t i
+    for i in range(num_chunks):
+        timings["convert"] = timings.get("convert", 0.0) + chunk_timings[i].convert_seconds
+        timings["codec"] = timings.get("codec", 0.0) + chunk_timings[i].codec_seconds
+
+
+def get_stream_info(source):
+    """Read the layout of a WavPack stream from its first block, without decoding it.
+
+    Parameters
+    ----------
+    source : bytes-like
+        Compressed data. Can be any object supporting the buffer protocol.
+
+    Returns
+    -------
+    num_samples : int
+        Number of frames in the stream.
+    num_chans : int
+        Number of channels.
+    dtype : np.dtype
+        Data type of the decoded samples.
+
+    """
+    cdef:
+        Buffer source_buffer
+        int64_t num_samples
+        int num_chans, bytes_per_sample, mode, qmode, info_ok
+        bytes first_header = b""
+
+    source_buffer = Buffer(source, PyBUF_ANY_CONTIGUOUS)
+    try:
+        with nogil:
+            info_ok = WavpackGetStreamInfo(source_buffer.ptr, source_buffer.nbytes, &num_samples, &num_chans,
+                                           &bytes_per_sample, &mode, &qmode)
+        if source_buffer.nbytes >= 16:
+            first_header = PyBytes_FromStringAndSize(source_buffer.ptr, 16)
+    finally:
+        source_buffer.release()
+
+    if info_ok and first_header[:4] == b"wvpk":
+        # the library reports the frames present in the buffer: the length written by the encoder in the
+        # first block also covers the blocks missing from truncated streams
+        total_samples_u8, total_samples = struct.unpack_from("<BI", first_header, 11)
+        if total_samples != 0xFFFFFFFF:
+            num_samples = total_samples + (total_samples_u8 << 32) - total_samples_u8
+
+    if not info_ok:
+        raise RuntimeError('WavPack decompression error: could not read stream header')
+
+    if num_samples < 0:
+        # the length was not stored in the first block: sum the samples of all blocks
+        source_buffer = Buffer(source, PyBUF_ANY_CONTIGUOUS)
+        try:
+            num_samples = WavpackCountSamples(source_buffer.ptr, source_buffer.nbytes)
+        finally:
+            source_buffer.release()
+        if num_samples < 0:
+            raise RuntimeError('WavPack decompression error: invalid block header')
+
+    if mode & MODE_FLOAT:
+        dtype = np.dtype("float32")
+    elif qmode & QMODE_UNSIGNED_WORDS:
+        dtype = np.dtype(f"uint{8 * bytes_per_sample}")
+    else:
+        dtype = np.dtype(f"int{8 * bytes_per_sample}")
+    return num_samples, num_chans, dtype
+
+
+cdef Buffer _strided_source(source, Py_ssize_t num_samples, Py_ssize_t num_chans, int dtype,
+                           ptrdiff_t *frame_stride, ptrdiff_t *chan_stride):
+    # gets the buffer of a source with num_samples frames of num_chans channels, without copying it, and
+    # the strides (in bytes) between consecutive frames and channels: 2D sources can be non-contiguous
+    cdef:
+        Buffer source_buffer = Buffer(source, PyBUF_STRIDES)
+        Py_ssize_t itemsize = _dtype_itemsize[dtype]
+
+    if (source_buffer.buffer.ndim == 2 and source_buffer.buffer.shape[0] == num_samples and
+            source_buffer.buffer.shape[1] == num_chans):
+        frame_stride[0] = source_buffer.buffer.strides[0]
+        chan_stride[0] = source_buffer.buffer.strides[1] if num_chans > 1 else itemsize
+    elif PyBuffer_IsContiguous(&source_buffer.buffer, b'A'):
+        frame_stride[0] = num_chans * itemsize
+        chan_stride[0] = itemsize
+    else:
+        source_buffer.release()
+        raise ValueError("The source must be contiguous or 2D (num_samples, num_chans)")
+    if source_buffer.buffer.len < num_samples * num_chans * itemsize:
+        source_buffer.release()
+        raise ValueError("The source is smaller than num_samples * num_chans samples")
+    return source_buffer
+
+
+def compress_bound(Py_ssize_t num_samples, Py_ssize_t num_chans, int dtype, Py_ssize_t block_samples=0):
+    """Worst-case compressed size, in bytes, of a chunk.
+
+    Parameters
+    ----------
+    num_samples : int
+        Number of frames (samples per channel).
+    num_chans : int
+        Number of channels.
+    dtype : int
+        Data type identifier (see `dtype_enum`).
+    block_samples : int
+        Number of frames per WavPack block (0 for the default).
+
+    Returns
+    -------
+    int
+        Upper bound of the size of the output of `compress`.
+
+    """
+    return WavpackEncodeBound(num_samples, num_chans, dtype, block_samples)
 
 
-def compress(source, int level, int num_samples, int num_chans, float bps, int dtype):
+def compress(source, int level, Py_ssize_t num_samples, Py_ssize_t num_chans, float bps, int dtype,
+             Py_ssize_t block_samples=0, int extra=0, int joint_stereo=-1, bint correction=False,
+             dict timings=None):
     """Compress data.
 
     Parameters
     ----------
     source : bytes-like
         Data to be compressed. Can be any object supporting the buffer
-        protocol.
-    acceleration : int
-        Acceleration level. The larger the acceleration value, the faster the algorithm, but also
-        the lesser the compression.
+        protocol. 2D sources of shape (num_samples, num_chans) can be 
+        non-contiguous (e.g. a subset of the channels of a larger array):
+        they are read in place, without copy.
+    level : int
+        Compression level (1: fast, 2: default, 3: high, 4: very high).
+    num_samples : int
+        Number of frames (samples per channel).
+    num_chans : int
+        Number of channels.
+    bps : float
+        Bits per sample for the lossy hybrid mode (0 for lossless).
+    dtype : int
+        Data type identifier (see `dtype_enum`).
+    block_samples : int
+        Number of frames per WavPack block (0 for the default: the whole chunk, halved until blocks are
+        no longer than 120000 frames).
+    extra : int
+        Extra processing level (0: off, 1 - 6: increasingly slower encoding for better compression).
+    joint_stereo : int
+        Joint stereo for the pairs of channels (1: on, 0: off, -1: chosen by the library).
+    correction : bool
+        If True (hybrid mode only), the correction stream that restores the lossless data is also
+        returned.
+    timings : dict or None
+        If given, the seconds spent converting the samples and in the WavPack library are added to its
+        "convert" and "codec" keys.
 
     Returns
     -------
     dest : bytes
         Compressed data.
+    wvc_dest : bytes
+        Correction stream, only returned if `correction` is True.
 
     Notes
     -----
-    The compressed output includes a 4-byte header storing the original size of the decompressed
-    data as a little-endian 32-bit integer.
+    The destination is allocated with the worst-case compressed size (`WavpackEncodeBound`), so that
+    compression never fails for lack of space, and shrunk in place to the compressed size.
 
     """
 
     cdef:
         char *source_ptr
         char *dest_ptr
-        char *dest_start
+        char *wvc_dest_ptr = NULL
         Buffer source_buffer
-        int source_size, dest_size, compressed_size
-        bytes dest
-
+        size_t dest_size, compressed_size, wvc_size = 0
+        ptrdiff_t frame_stride, chan_stride
+        PyObject *dest_obj = NULL
+        PyObject *wvc_dest_obj = NULL
+        int32_t[::1] scratch = _get_scratch()
+        WavpackEncodeOptions options = _encode_options(level, bps, block_samples, extra, joint_stereo)
+        WavpackTimings chunk_timings = WavpackTimings(0, 0)
+        WavpackTimings *timings_ptr = &chunk_timings if timings is not None else NULL
 
     # setup source buffer
-    source_buffer = Buffer(source, PyBUF_ANY_CONTIGUOUS)
+    source_buffer = _strided_source(source, num_samples, num_chans, dtype, &frame_stride, &chan_stride)
     source_ptr = source_buffer.ptr
-    source_size = source_buffer.nbytes
 
     try:
 
         # setup destination
-        dest = PyBytes_FromStringAndSize(NULL, source_size)
-        dest_ptr = PyBytes_AS_STRING(dest)
-        dest_size = source_size
+        dest_size = WavpackEncodeBound(num_samples, num_chans, dtype, block_samples)
+        dest_obj = _bytes_new(NULL, dest_size)
+        dest_ptr = PyBytes_AS_STRING(<object>dest_obj)
+        if correction:
+            # the correction stream has the same bound
+            wvc_dest_obj = _bytes_new(NULL, dest_size)
+            wvc_dest_ptr = PyBytes_AS_STRING(<object>wvc_dest_obj)
+
+        # the GIL is released so that multiple chunks can be compressed concurrently from threads
+        with nogil:
+            compressed_size = WavpackEncodeFile(source_ptr, num_samples, num_chans, frame_stride, chan_stride, 
+                                                &options, dest_ptr, dest_size, wvc_dest_ptr, dest_size, &wvc_size,
+                                                dtype, &scratch[0], scratch.shape[0], timings_ptr)
 
-        compressed_size = WavpackEncodeFile(source_ptr, num_samples, num_chans, level, bps, dest_ptr, dest_size, dtype)
+    except:
+        Py_XDECREF(dest_obj)
+        Py_XDECREF(wvc_dest_obj)
+        raise
 
     finally:
 
@@ -98,16 +385,28 @@ def compress(source, int level, int num_samples, int num_chans, float bps, int d
         source_buffer.release()
 
     # check compression was successful
-    if compressed_size == -1:
-        raise RuntimeError(f'WavPAck compression error: {compressed_size}')
+    if compressed_size == <size_t>-1:
+        Py_XDECREF(dest_obj)
+        Py_XDECREF(wvc_dest_obj)
+        raise RuntimeError(f'WavPack compression error: {<Py_ssize_t>compressed_size}')
+
+    if timings is not None:
+        _add_timings(timings, timings_ptr)
 
-    # resize after compression
-    dest = dest[:compressed_size]
+    # resize after compression, in place
+    _PyBytes_Resize(&dest_obj, compressed_size)
+    dest = <bytes>dest_obj
+    Py_XDECREF(dest_obj)
+    if correction:
+        _PyBytes_Resize(&wvc_dest_obj, wvc_size)
+        wvc_dest = <bytes>wvc_dest_obj
+        Py_XDECREF(wvc_dest_obj)
+        return dest, wvc_dest
 
     return dest
 
 
-def decompress(source, dest=None):
+def decompress(source, dest=None, bint verify_checksum=True, dict timings=None, correction=None):
     """Decompress data.
 
     Parameters
@@ -116,46 +415,161 @@ def decompress(source, dest=None):
         Compressed data. Can be any object supporting the buffer protocol.
     dest : array-like, optional
         Object to decompress into.
+    verify_checksum : bool
+        If False, the block checksums are not verified (faster, for trusted storage).
+    timings : dict or None
+        If given, the seconds spent converting the samples and in the WavPack library are added to its
+        "convert" and "codec" keys.
+    correction : bytes-like or None
+        Correction stream of a hybrid (lossy) stream (see `compress`), to decompress it losslessly.
 
     Returns
     -------
-    dest : bytes
-        Object containing decompressed data.
+    dest : np.array or array-like
+        Decompressed data. If dest is None, a new array with shape (num_samples, num_chans) and the
+        dtype of the stream, allocated with the exact size read from the stream header.
 
     """
     cdef:
         char *source_ptr
-        char *source_start
         char *dest_ptr
+        char *wvc_ptr = NULL
         Buffer source_buffer
         Buffer dest_buffer = None
-        int source_size, dest_size, decompressed_samples
+        Buffer wvc_buffer = None
+        size_t source_size, dest_size, wvc_size = 0, decompressed_samples
         int num_chans
-        int *num_chans_ptr = &num_chans
         int bytes_per_sample
-        int *bytes_per_sample_ptr = &bytes_per_sample
+        int open_flags = _open_flags(verify_checksum)
+        int32_t[::1] scratch = _get_scratch()
+        WavpackTimings chunk_timings = WavpackTimings(0, 0)
+        WavpackTimings *timings_ptr = &chunk_timings if timings is not None else NULL
 
-    # setup source buffer
+    num_samples, num_chans_stream, dtype = stream_info = get_stream_info(source)
+    if dest is None:
+        dest = _empty_decoded(stream_info, num_samples)
+
+    # setup source buffers
     source_buffer = Buffer(source, PyBUF_ANY_CONTIGUOUS)
     source_ptr = source_buffer.ptr
     source_size = source_buffer.nbytes
 
     try:
 
+        wvc_buffer = _correction_buffer(correction, &wvc_ptr, &wvc_size)
+
         # setup destination
-        if dest is None:
-            # allocate memory
-            dest_size = int(source_size * 10)
-            dest = PyBytes_FromStringAndSize(NULL, dest_size)
-            dest_ptr = PyBytes_AS_STRING(dest)
-        else:
-            arr = ensure_contiguous_ndarray(dest)
-            dest_buffer = Buffer(arr, PyBUF_ANY_CONTIGUOUS | PyBUF_WRITEABLE)
-            dest_ptr = dest_buffer.ptr
-            dest_size = dest_buffer.nbytes
+        arr = ensure_contiguous_ndarray(dest)
+        dest_buffer = Buffer(arr, PyBUF_ANY_CONTIGUOUS | PyBUF_WRITEABLE)
+        dest_ptr = dest_buffer.ptr
+        dest_size = dest_buffer.nbytes
+        if dest_size < num_samples * num_chans_stream * dtype.itemsize:
+            raise ValueError("The destination is smaller than the decompressed data")
+
+        # the GIL is released so that multiple chunks can be decompressed concurrently from threads
+        with nogil:
+            decompressed_samples = WavpackDecodeFile(source_ptr, source_size, wvc_ptr, wvc_size, &num_chans,
+                                                     &bytes_per_sample, dest_ptr, dest_size, &scratch[0],
+                                                     scratch.shape[0], open_flags, timings_ptr)
+
+    finally:
+
+        # release buffers
+        source_buffer.release()
+        if dest_buffer is not None:
+            dest_buffer.release()
+        if wvc_buffer is not None:
+            wvc_buffer.release()
+
+    # check decompression was successful: a stream truncated at a block boundary decodes fewer frames
+    if decompressed_samples != <size_t>num_samples:
+        raise RuntimeError(f'WavPack decompression error: {<Py_ssize_t>decompressed_samples} frames decoded '
+                           f'out of {num_samples}')
+
+    if timings is not None:
+        _add_timings(timings, timings_ptr)
+    return dest
+
+
+def decompress_range(source, start, stop, dest=None, bint verify_checksum=True, dict timings=None,
+                     correction=None):
+    """Decompress a range of frames of a chunk.
+
+    Only the WavPack blocks covering the requested frames are decoded.
+
+    Parameters
+    ----------
+    source : bytes-like
+        Compressed data. Can be any object supporting the buffer protocol.
+    start : int
+        First frame (i.e. sample index along the first dimension of the encoded data) to decode.
+    stop : int
+        Frame after the last frame to decode. It is clipped to the number of frames in the chunk.
+    dest : array-like, optional
+        Object to decompress into.
+    verify_checksum : bool
+        If False, the block checksums are not verified (faster, for trusted storage).
+    timings : dict or None
+        If given, the seconds spent converting the samples and in the WavPack library are added to its
+        "convert" and "codec" keys.
+    correction : bytes-like or None
+        Correction stream of a hybrid (lossy) stream, to decompress it losslessly.
+
+    Returns
+    -------
+    dest : np.array or array-like
+        Decompressed data. If dest is None, a new array with shape (num_decoded_samples, num_chans).
+
+    """
+    cdef:
+        char *source_ptr
+        char *dest_ptr
+        char *wvc_ptr = NULL
+        Buffer source_buffer
+        Buffer dest_buffer = None
+        Buffer wvc_buffer = None
+        size_t source_size, dest_size, wvc_size = 0, start_sample, num_samples
+        size_t decompressed_samples
+        int num_chans, bytes_per_sample
+        int open_flags = _open_flags(verify_checksum)
+        int32_t[::1] scratch = _get_scratch()
+        WavpackTimings chunk_timings = WavpackTimings(0, 0)
+        WavpackTimings *timings_ptr = &chunk_timings if timings is not None else NULL
+
+    if start < 0 or stop < start:
+        raise ValueError(f"Invalid frame range [{start}, {stop})")
+
+    total_samples, num_chans_stream, dtype = stream_info = get_stream_info(source)
+    start_sample = min(start, total_samples)
+    num_samples = min(stop, total_samples) - start_sample
+    if dest is None:
+        dest = _empty_decoded(stream_info, num_samples)
+
+    # setup source buffers
+    source_buffer = Buffer(source, PyBUF_ANY_CONTIGUOUS)
+    source_ptr = source_buffer.ptr
+    source_size = source_buffer.nbytes
 
-        decompressed_samples = WavpackDecodeFile(source_ptr, source_size, num_chans_ptr, bytes_per_sample_ptr, 
-                                                 dest_ptr, dest_size)
+    try:
+
+        wvc_buffer = _correction_buffer(correction, &wvc_ptr, &wvc_size)
+
+        # setup destination
+        arr = ensure_contiguous_ndarray(dest)
+        dest_buffer = Buffer(arr, PyBUF_ANY_CONTIGUOUS | PyBUF_WRITEABLE)
+        dest_ptr = dest_buffer.ptr
+        dest_size = dest_buffer.nbytes
+        if dest_size < num_samples * num_chans_stream * dtype.itemsize:
+            raise ValueError("The destination is smaller than the decompressed data")
+
+        if num_samples == 0:
+            decompressed_samples = 0
+        else:
+            with nogil:
+                decompressed_samples = WavpackDecodeRange(source_ptr, source_size, wvc_ptr, wvc_size, start_sample,
+                                                          num_samples, &num_chans, &bytes_per_sample, dest_ptr,
+                                                          dest_size, &scratch[0], scratch.shape[0], open_flags,
+                                                          timings_ptr)
 
     finally:
 
@@ -163,38 +577,817 @@ def decompress(source, dest=None):
         source_buffer.release()
         if dest_buffer is not None:
             dest_buffer.release()
+        if wvc_buffer is not None:
+            wvc_buffer.release()
 
     # check decompression was successful
-    if decompressed_samples <= 0:
-        raise RuntimeError(f'WavPack decompression error: {decompressed_samples}')
+    if decompressed_samples != num_samples:
+        raise RuntimeError(f'WavPack decompression error: could not decode frames [{start}, {stop})')
 
-    return dest[:decompressed_samples * num_chans * bytes_per_sample]
+    if timings is not None:
+        _add_timings(timings, timings_ptr)
+    return dest
+
+
+def compress_many(sources, int level, float bps, int num_threads=0, Py_ssize_t block_samples=0, int extra=0,
+                  int joint_stereo=-1, bint correction=False, dict timings=None):
+    """Compress many chunks in parallel.
+
+    The chunks are compressed by a pool of native (OpenMP) threads, without returning to Python
+    between chunks. Without OpenMP support at build time, chunks are compressed sequentially.
+
+    Parameters
+    ----------
+    sources : list of np.array
+        2D arrays (num_samples, num_chans) to be compressed, possibly non-contiguous.
+    level : int
+        Compression level (1: fast, 2: default, 3: high, 4: very high).
+    bps : float
+        Bits per sample for the lossy hybrid mode (0 for lossless).
+    num_threads : int
+        Number of threads. If <= 0, the number of CPUs is used.
+    block_samples, extra, joint_stereo : int
+        Number of frames per block, extra processing level and joint stereo mode (see `compress`).
+    correction : bool
+        If True (hybrid mode only), the correction stream of each chunk is also returned.
+    timings : dict or None
+        If given, the seconds spent converting the samples and in the WavPack library by all the threads
+        are added to its "convert" and "codec" keys.
+
+    Returns
+    -------
+    dests : list of bytes
+        Compressed data of each chunk, or (compressed data, correction stream) tuples if `correction`
+        is True.
+
+    """
+    cdef:
+        Py_ssize_t i, num_chunks = len(sources)
+        Buffer source_buffer
+        char **source_ptrs = NULL
+        char **dest_ptrs = NULL
+        size_t *num_samples = NULL
+        size_t *num_chans = NULL
+        ptrdiff_t *frame_strides = NULL
+        ptrdiff_t *chan_strides = NULL
+        size_t *dest_sizes = NULL
+        size_t *compressed_sizes = NULL
+        size_t *wvc_sizes = NULL
+        int *dtypes = NULL
+        PyObject **dest_objs = NULL
+        PyObject **wvc_dest_objs = NULL
+        char **wvc_dest_ptrs = NULL
+        int32_t *scratch = NULL
+        list source_buffers = []
+        WavpackEncodeOptions options = _encode_options(level, bps, block_samples, extra, joint_stereo)
+        WavpackTimings *chunk_timings = NULL
+
+    if num_chunks == 0:
+        return []
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+    num_threads = min(num_threads, num_chunks)
+
+    try:
+        source_ptrs = <char **> calloc(num_chunks, sizeof(char *))
+        dest_ptrs = <char **> calloc(num_chunks, sizeof(char *))
+        num_samples = <size_t *> calloc(num_chunks, sizeof(size_t))
+        num_chans = <size_t *> calloc(num_chunks, sizeof(size_t))
+        frame_strides = <ptrdiff_t *> calloc(num_chunks, sizeof(ptrdiff_t))
+        chan_strides = <ptrdiff_t *> calloc(num_chunks, sizeof(ptrdiff_t))
+        dest_sizes = <size_t *> calloc(num_chunks, sizeof(size_t))
+        compressed_sizes = <size_t *> calloc(num_chunks, sizeof(size_t))
+        wvc_sizes = <size_t *> calloc(num_chunks, sizeof(size_t))
+        dtypes = <int *> calloc(num_chunks, sizeof(int))
+        dest_objs = <PyObject **> calloc(num_chunks, sizeof(PyObject *))
+        wvc_dest_objs = <PyObject **> calloc(num_chunks, sizeof(PyObject *))
+        wvc_dest_ptrs = <char **> calloc(num_chunks, sizeof(char *))
+        # one conversion buffer per thread, reused for all the chunks compressed by the thread
+        scratch = <int32_t *> malloc(num_threads * SCRATCH_SAMPLES * sizeof(int32_t))
+        if (source_ptrs == NULL or dest_ptrs == NULL or num_samples == NULL or num_chans == NULL or 
+                frame_strides == NULL or chan_strides == NULL or dest_sizes == NULL or compressed_sizes == NULL or
+                wvc_sizes == NULL or dtypes == NULL or dest_objs == NULL or wvc_dest_objs == NULL or
+                wvc_dest_ptrs == NULL or scratch == NULL):
+            raise MemoryError()
+        if timings is not None:
+            chunk_timings = <WavpackTimings *> calloc(num_chunks, sizeof(WavpackTimings))
+            if chunk_timings == NULL:
+                raise MemoryError()
+
+        # setup source and destination buffers
+        for i in range(num_chunks):
+            source = sources[i]
+            num_samples[i], num_chans[i] = source.shape
+            dtypes[i] = dtype_enum[str(source.dtype)]
+            source_buffer = _strided_source(source, num_samples[i], num_chans[i], dtypes[i], &frame_strides[i],
+                                            &chan_strides[i])
+            source_buffers.append(source_buffer)
+            source_ptrs[i] = source_buffer.ptr
+            dest_sizes[i] = WavpackEncodeBound(num_samples[i], num_chans[i], dtypes[i], block_samples)
+            dest_objs[i] = _bytes_new(NULL, dest_sizes[i])
+            dest_ptrs[i] = PyBytes_AS_STRING(<object>dest_objs[i])
+            if correction:
+                wvc_dest_objs[i] = _bytes_new(NULL, dest_sizes[i])
+                wvc_dest_ptrs[i] = PyBytes_AS_STRING(<object>wvc_dest_objs[i])
+
+        for i in prange(num_chunks, nogil=True, num_threads=num_threads, schedule="dynamic"):
+            compressed_sizes[i] = WavpackEncodeFile(source_ptrs[i], num_samples[i], num_chans[i], frame_strides[i],
+                                                    chan_strides[i], &options, dest_ptrs[i], dest_sizes[i],
+                                                    wvc_dest_ptrs[i], dest_sizes[i], &wvc_sizes[i], dtypes[i],
+                                                    scratch + threadid() * SCRATCH_SAMPLES, SCRATCH_SAMPLES,
+                                                    chunk_timings + i if chunk_timings != NULL else NULL)
+
+        # check compression was successful and resize after compression, in place
+        dests = []
+        for i in range(num_chunks):
+            if compressed_sizes[i] == <size_t>-1:
+                raise RuntimeError(f'WavPack compression error: {<Py_ssize_t>compressed_sizes[i]} (chunk {i})')
+            _PyBytes_Resize(&dest_objs[i], compressed_sizes[i])
+            if correction:
+                _PyBytes_Resize(&wvc_dest_objs[i], wvc_sizes[i])
+                dests.append((<bytes>dest_objs[i], <bytes>wvc_dest_objs[i]))
+            else:
+                dests.append(<bytes>dest_objs[i])
+        if timings is not None:
+            _add_timings(timings, chunk_timings, num_chunks)
+
+    finally:
+
+        # release buffers
+        for source_buffer in source_buffers:
+            source_buffer.release()
+        if dest_objs != NULL:
+            for i in range(num_chunks):
+                Py_XDECREF(dest_objs[i])
+        if wvc_dest_objs != NULL:
+            for i in range(num_chunks):
+                Py_XDECREF(wvc_dest_objs[i])
+        free(source_ptrs)
+        free(dest_ptrs)
+        free(num_samples)
+        free(num_chans)
+        free(frame_strides)
+        free(chan_strides)
+        free(dest_sizes)
+        free(compressed_sizes)
+        free(wvc_sizes)
+        free(dtypes)
+        free(dest_objs)
+        free(wvc_dest_objs)
+        free(wvc_dest_ptrs)
+        free(scratch)
+        free(chunk_timings)
+
+    return dests
+
+
+def decompress_many(sources, dests=None, int num_threads=0, bint verify_checksum=True, dict timings=None,
+                    corrections=None):
+    """Decompress many chunks in parallel.
+
+    The chunks are decompressed by a pool of native (OpenMP) threads, without returning to Python
+    between chunks. Without OpenMP support at build time, chunks are decompressed sequentially.
+
+    Parameters
+    ----------
+    sources : list of bytes-like
+        Compressed data of each chunk. Can be any object supporting the buffer protocol.
+    dests : list of array-like or None, optional
+        Objects to decompress into. If None (or if an element is None), arrays with shape
+        (num_samples, num_chans) and the dtype of the stream are allocated.
+    num_threads : int
+        Number of threads. If <= 0, the number of CPUs is used.
+    verify_checksum : bool
+        If False, the block checksums are not verified (faster, for trusted storage).
+    timings : dict or None
+        If given, the seconds spent converting the samples and in the WavPack library by all the threads
+        are added to its "convert" and "codec" keys.
+    corrections : list of bytes-like or None, optional
+        Correction streams of hybrid chunks, to decompress them losslessly (None elements for the chunks
+        without correction).
+
+    Returns
+    -------
+    dests : list of np.array or array-like
+        Decompressed data of each chunk.
+
+    """
+    cdef:
+        Py_ssize_t i, num_chunks = len(sources)
+        Buffer buffer
+        char **source_ptrs = NULL
+        char **dest_ptrs = NULL
+        char **wvc_ptrs = NULL
+        size_t *source_sizes = NULL
+        size_t *dest_sizes = NULL
+        size_t *wvc_sizes = NULL
+        size_t *decompressed_samples = NULL
+        int *num_chans = NULL
+        int *bytes_per_sample = NULL
+        int32_t *scratch = NULL
+        int open_flags = _open_flags(verify_checksum)
+        WavpackTimings *chunk_timings = NULL
+        list buffers = []
+        list expected_samples = []
+
+    if dests is None:
+        dests = [None] * num_chunks
+    else:
+        dests = list(dests)
+        assert len(dests) == num_chunks, "The number of destinations must match the number of sources"
+    if corrections is None:
+        corrections = [None] * num_chunks
+    else:
+        assert len(corrections) == num_chunks, "The number of corrections must match the number of sources"
+    if num_chunks == 0:
+        return []
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+    num_threads = min(num_threads, num_chunks)
+
+    try:
+        source_ptrs = <char **> calloc(num_chunks, sizeof(char *))
+        dest_ptrs = <char **> calloc(num_chunks, sizeof(char *))
+        source_sizes = <size_t *> calloc(num_chunks, sizeof(size_t))
+        dest_sizes = <size_t *> calloc(num_chunks, sizeof(size_t))
+        wvc_ptrs = <char **> calloc(num_chunks, sizeof(char *))
+        wvc_sizes = <size_t *> calloc(num_chunks, sizeof(size_t))
+        decompressed_samples = <size_t *> calloc(num_chunks, sizeof(size_t))
+        num_chans = <int *> calloc(num_chunks, sizeof(int))
+        bytes_per_sample = <int *> calloc(num_chunks, sizeof(int))
+        # one conversion buffer per thread, reused for all the chunks decompressed by the thread
+        scratch = <int32_t *> malloc(num_threads * SCRATCH_SAMPLES * sizeof(int32_t))
+        if (source_ptrs == NULL or dest_ptrs == NULL or source_sizes == NULL or dest_sizes == NULL or 
+                wvc_ptrs == NULL or wvc_sizes == NULL or decompressed_samples == NULL or num_chans == NULL or
+                bytes_per_sample == NULL or scratch == NULL):
+            raise MemoryError()
+        if timings is not None:
+            chunk_timings = <WavpackTimings *> calloc(num_chunks, sizeof(WavpackTimings))
+            if chunk_timings == NULL:
+                raise MemoryError()
+
+        # setup source and destination buffers
+        for i in range(num_chunks):
+            stream_info = get_stream_info(sources[i])
+            expected_samples.append(stream_info[0])
+            num_bytes = stream_info[0] * stream_info[1] * stream_info[2].itemsize
+            if dests[i] is None:
+                dests[i] = _empty_decoded(stream_info, stream_info[0])
+
+            buffer = Buffer(sources[i], PyBUF_ANY_CONTIGUOUS)
+            buffers.append(buffer)
+            source_ptrs[i] = buffer.ptr
+            source_sizes[i] = buffer.nbytes
+
+            buffer = Buffer(ensure_contiguous_ndarray(dests[i]), PyBUF_ANY_CONTIGUOUS | PyBUF_WRITEABLE)
+            buffers.append(buffer)
+            dest_ptrs[i] = buffer.ptr
+            dest_sizes[i] = buffer.nbytes
+            if dest_sizes[i] < num_bytes:
+                raise ValueError(f"The destination is smaller than the decompressed data (chunk {i})")
+
+            if corrections[i] is not None:
+                buffer = Buffer(corrections[i], PyBUF_ANY_CONTIGUOUS)
+                buffers.append(buffer)
+                wvc_ptrs[i] = buffer.ptr
+                wvc_sizes[i] = buffer.nbytes
+
+        for i in prange(num_chunks, nogil=True, num_threads=num_threads, schedule="dynamic"):
+            decompressed_samples[i] = WavpackDecodeFile(source_ptrs[i], source_sizes[i], wvc_ptrs[i], wvc_sizes[i],
+                                                        &num_chans[i], &bytes_per_sample[i], dest_ptrs[i],
+                                                        dest_sizes[i], scratch + threadid() * SCRATCH_SAMPLES,
+                                                        SCRATCH_SAMPLES, open_flags,
+                                                        chunk_timings + i if chunk_timings != NULL else NULL)
+
+        # check decompression was successful
+        for i in range(num_chunks):
+            if decompressed_samples[i] != <size_t>expected_samples[i]:
+                raise RuntimeError(f'WavPack decompression error: {<Py_ssize_t>decompressed_samples[i]} frames '
+                                   f'decoded out of {expected_samples[i]} (chunk {i})')
+        if timings is not None:
+            _add_timings(timings, chunk_timings, num_chunks)
+
+    finally:
+
+        # release buffers
+        for buffer in buffers:
+            buffer.release()
+        free(source_ptrs)
+        free(dest_ptrs)
+        free(source_sizes)
+        free(dest_sizes)
+        free(wvc_ptrs)
+        free(wvc_sizes)
+        free(decompressed_samples)
+        free(num_chans)
+        free(bytes_per_sample)
+        free(scratch)
+        free(chunk_timings)
+
+    return dests
+
+
+cdef bytes _join_ranges(char **range_ptrs, size_t *range_sizes, Py_ssize_t num_ranges):
+    # concatenates the streams of the ranges of a parallel compression
+    cdef:
+        Py_ssize_t i
+        size_t total_size = 0
+        bytes dest
+        char *dest_ptr
+
+    for i in range(num_ranges):
+        total_size += range_sizes[i]
+    dest = PyBytes_FromStringAndSize(NULL, total_size)
+    dest_ptr = PyBytes_AS_STRING(dest)
+    for i in range(num_ranges):
+        memcpy(dest_ptr, range_ptrs[i], range_sizes[i])
+        dest_ptr += range_sizes[i]
+    return dest
+
+
+def compress_parallel(source, int level, Py_ssize_t num_samples, Py_ssize_t num_chans, float bps, int dtype,
+                      int num_threads=0, Py_ssize_t block_samples=0, int extra=0, int joint_stereo=-1,
+                      bint correction=False, dict timings=None):
+    """Compress a chunk with several threads.
+
+    The frames are split in ranges of whole blocks, which are compressed by a pool of native (OpenMP) 
+    threads. WavPack blocks are independent, so the streams of the ranges are joined (with their block
+    headers rebased) into a single stream, which is decoded like the output of `compress`. 
+
+    Parameters
+    ----------
+    source, level, num_samples, num_chans, bps, dtype :
+        As in `compress`.
+    num_threads : int
+        Number of threads (and maximum number of ranges). If <= 0, the number of CPUs is used.
+    block_samples, extra, joint_stereo, correction, timings :
+        As in `compress`. The timings of all the threads are added.
+
+    Returns
+    -------
+    dest : bytes
+        Compressed data.
+    wvc_dest : bytes
+        Correction stream, only returned if `correction` is True.
+
+    """
+    cdef:
+        Py_ssize_t i, num_ranges, range_frames, start, frames
+        size_t chunk_block_samples = get_block_samples(num_samples, block_samples)
+        size_t num_blocks = (num_samples + chunk_block_samples - 1) // chunk_block_samples
+        char *source_ptr
+        Buffer source_buffer
+        ptrdiff_t frame_stride, chan_stride
+        char **dest_ptrs = NULL
+        char **wvc_dest_ptrs = NULL
+        size_t *dest_sizes = NULL
+        size_t *compressed_sizes = NULL
+        size_t *wvc_sizes = NULL
+        int *rebased = NULL
+        int32_t *scratch = NULL
+        WavpackEncodeOptions options = _encode_options(level, bps, chunk_block_samples, extra, joint_stereo)
+        WavpackTimings *range_timings = NULL
+
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+    num_ranges = min(num_threads, num_blocks)
+    if num_ranges <= 1:
+        return compress(source, level, num_samples, num_chans, bps, dtype, block_samples, extra, joint_stereo,
+                        correction, timings)
+    # whole blocks per range, so that the joined stream has the blocks of a single-threaded compression
+    range_frames = (num_blocks + num_ranges - 1) // num_ranges * chunk_block_samples
+    num_ranges = (num_samples + range_frames - 1) // range_frames
+
+    source_buffer = _strided_source(source, num_samples, num_chans, dtype, &frame_stride, &chan_stride)
+    source_ptr = source_buffer.ptr
+
+    try:
+        dest_ptrs = <char **> calloc(num_ranges, sizeof(char *))
+        wvc_dest_ptrs = <char **> calloc(num_ranges, sizeof(char *))
+        dest_sizes = <size_t *> calloc(num_ranges, sizeof(size_t))
+        compressed_sizes = <size_t *> calloc(num_ranges, sizeof(size_t))
+        wvc_sizes = <size_t *> calloc(num_ranges, sizeof(size_t))
+        rebased = <int *> calloc(num_ranges, sizeof(int))
+        scratch = <int32_t *> malloc(num_ranges * SCRATCH_SAMPLES * sizeof(int32_t))
+        if (dest_ptrs == NULL or wvc_dest_ptrs == NULL or dest_sizes == NULL or compressed_sizes == NULL or
+                wvc_sizes == NULL or rebased == NULL or scratch == NULL):
+            raise MemoryError()
+        if timings is not None:
+            range_timings = <WavpackTimings *> calloc(num_ranges, sizeof(WavpackTimings))
+            if range_timings == NULL:
+                raise MemoryError()
+        for i in range(num_ranges):
+            dest_sizes[i] = WavpackEncodeBound(min(range_frames, num_samples - i * range_frames), num_chans, dtype,
+                                               chunk_block_samples)
+            dest_ptrs[i] = <char *> malloc(dest_sizes[i])
+            if correction:
+                wvc_dest_ptrs[i] = <char *> malloc(dest_sizes[i])
+            if dest_ptrs[i] == NULL or (correction and wvc_dest_ptrs[i] == NULL):
+                raise MemoryError()
+
+        for i in prange(num_ranges, nogil=True, num_threads=num_ranges, schedule="static"):
+            start = i * range_frames
+            frames = min(range_frames, num_samples - start)
+            compressed_sizes[i] = WavpackEncodeFile(source_ptr + start * frame_stride, frames, num_chans,
+                                                    frame_stride, chan_stride, &options, dest_ptrs[i], dest_sizes[i],
+                                                    wvc_dest_ptrs[i], dest_sizes[i], &wvc_sizes[i], dtype,
+                                                    scratch + threadid() * SCRATCH_SAMPLES, SCRATCH_SAMPLES,
+                                                    range_timings + i if range_timings != NULL else NULL)
+            if compressed_sizes[i] != <size_t>-1:
+                rebased[i] = (WavpackRebaseBlocks(dest_ptrs[i], compressed_sizes[i], start, num_samples) and
+                              (wvc_dest_ptrs[i] == NULL or
+                               WavpackRebaseBlocks(wvc_dest_ptrs[i], wvc_sizes[i], start, num_samples)))
+
+        for i in range(num_ranges):
+            if compressed_sizes[i] == <size_t>-1 or not rebased[i]:
+                raise RuntimeError(f'WavPack compression error (frames {i * range_frames} to '
+                                   f'{min((i + 1) * range_frames, num_samples)})')
+        if timings is not None:
+            _add_timings(timings, range_timings, num_ranges)
+
+        dest = _join_ranges(dest_ptrs, compressed_sizes, num_ranges)
+        if correction:
+            dest = dest, _join_ranges(wvc_dest_ptrs, wvc_sizes, num_ranges)
+
+    finally:
+        source_buffer.release()
+        if dest_ptrs != NULL:
+            for i in range(num_ranges):
+                free(dest_ptrs[i])
+                free(wvc_dest_ptrs[i])
+        free(dest_ptrs)
+        free(wvc_dest_ptrs)
+        free(dest_sizes)
+        free(compressed_sizes)
+        free(wvc_sizes)
+        free(rebased)
+        free(scratch)
+        free(range_timings)
+
+    return dest
+
+
+def _block_starts(source):
+    # the first frame of each block of a stream, read from all the block headers (the blocks of a frame with more
+    # than two channels start at the same frame), or None if the blocks cannot be parsed
+    view = memoryview(ensure_contiguous_ndarray(source)).cast("B")
+    starts = []
+    offset = 0
+    while offset + _block_position.size <= len(view):
+        ck_id, ck_size, block_index_u8, block_index, block_samples, flags = _block_position.unpack_from(view, offset)
+        if ck_id != b"wvpk":
+            return None
+        if flags & _INITIAL_BLOCK and block_samples:
+            starts.append(block_index + (block_index_u8 << 32))
+        offset += ck_size + 8
+    if offset != len(view) or not starts or starts[0] != 0 or any(a >= b for a, b in zip(starts, starts[1:])):
+        return None
+    return starts
+
+
+def decompress_parallel(source, dest=None, int num_threads=0, bint verify_checksum=True, dict timings=None,
+                        correction=None):
+    """Decompress a chunk with several threads.
+
+    The frames are split in ranges of whole blocks (read from the header of each block, so that blocks of
+    any sizes are supported), with about the same number of blocks each, which are decompressed by a pool of
+    native (OpenMP) threads (each locating its first block like `decompress_range`) into consecutive frames
+    of the destination. Streams whose blocks cannot be parsed are decompressed serially.
+
+    Parameters
+    ----------
+    source, dest, verify_checksum, timings, correction :
+        As in `decompress`. The timings of all the threads are added.
+    num_threads : int
+        Number of threads (and maximum number of ranges). If <= 0, the number of CPUs is used.
+
+    Returns
+    -------
+    dest : np.array or array-like
+        Decompressed data.
+
+    """
+    cdef:
+        Py_ssize_t i, num_ranges, start, frames, num_samples, frame_bytes
+        Py_ssize_t *range_starts = NULL
+        char *source_ptr
+        char *dest_ptr
+        char *wvc_ptr = NULL
+        Buffer source_buffer
+        Buffer dest_buffer = None
+        Buffer wvc_buffer = None
+        size_t source_size, wvc_size = 0, dest_size
+        size_t *decompressed_samples = NULL
+        int *num_chans = NULL
+        int *bytes_per_sample = NULL
+        int32_t *scratch = NULL
+        int open_flags = _open_flags(verify_checksum)
+        WavpackTimings *range_timings = NULL
+
+    num_samples, num_chans_stream, dtype = stream_info = get_stream_info(source)
+    block_starts = _block_starts(source)
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+    num_ranges = 0 if block_starts is None or block_starts[-1] >= num_samples else min(num_threads, len(block_starts))
+    if num_ranges <= 1:
+        return decompress(source, dest, verify_checksum, timings, correction)
+    frame_bytes = num_chans_stream * dtype.itemsize
+    if dest is None:
+        dest = _empty_decoded(stream_info, num_samples)
+
+    source_buffer = Buffer(source, PyBUF_ANY_CONTIGUOUS)
+    source_ptr = source_buffer.ptr
+    source_size = source_buffer.nbytes
+
+    try:
+        wvc_buffer = _correction_buffer(correction, &wvc_ptr, &wvc_size)
+        dest_buffer = Buffer(ensure_contiguous_ndarray(dest), PyBUF_ANY_CONTIGUOUS | PyBUF_WRITEABLE)
+        dest_ptr = dest_buffer.ptr
+        dest_size = dest_buffer.nbytes
+        if dest_size < num_samples * frame_bytes:
+            raise ValueError("The destination is smaller than the decompressed data")
+
+        # the ranges start at the blocks that split the blocks evenly
+        range_starts = <Py_ssize_t *> malloc((num_ranges + 1) * sizeof(Py_ssize_t))
+        if range_starts == NULL:
+            raise MemoryError()
+        for i in range(num_ranges):
+            range_starts[i] = block_starts[i * len(block_starts) // num_ranges]
+        range_starts[num_ranges] = num_samples
+
+        decompressed_samples = <size_t *> calloc(num_ranges, sizeof(size_t))
+        num_chans = <int *> calloc(num_ranges, sizeof(int))
+        bytes_per_sample = <int *> calloc(num_ranges, sizeof(int))
+        scratch = <int32_t *> malloc(num_ranges * SCRATCH_SAMPLES * sizeof(int32_t))
+        if decompressed_samples == NULL or num_chans == NULL or bytes_per_sample == NULL or scratch == NULL:
+            raise MemoryError()
+        if timings is not None:
+            range_timings = <WavpackTimings *> calloc(num_ranges, sizeof(WavpackTimings))
+            if range_timings == NULL:
+                raise MemoryError()
+
+        for i in prange(num_ranges, nogil=True, num_threads=num_ranges, schedule="static"):
+            start = range_starts[i]
+            frames = range_starts[i + 1] - start
+            decompressed_samples[i] = WavpackDecodeRange(source_ptr, source_size, wvc_ptr, wvc_size, start, frames,
+                                                         &num_chans[i], &bytes_per_sample[i],
+                                                         dest_ptr + start * frame_bytes, frames * frame_bytes,
+                                                         scratch + threadid() * SCRATCH_SAMPLES, SCRATCH_SAMPLES,
+                                                         open_flags, range_timings + i if range_timings != NULL else NULL)
+
+        for i in range(num_ranges):
+            if decompressed_samples[i] != <size_t>(range_starts[i + 1] - range_starts[i]):
+                raise RuntimeError(f'WavPack decompression error (frames {range_starts[i]} to '
+                                   f'{range_starts[i + 1]})')
+        if timings is not None:
+            _add_timings(timings, range_timings, num_ranges)
+
+    finally:
+        source_buffer.release()
+        if dest_buffer is not None:
+            dest_buffer.release()
+        if wvc_buffer is not None:
+            wvc_buffer.release()
+        free(range_starts)
+        free(decompressed_samples)
+        free(num_chans)
+        free(bytes_per_sample)
+        free(scratch)
+        free(range_timings)
+
+    return dest
+
+
+cdef class _StreamDecoder:
+    # incremental decoder of a WavPack stream, which keeps the source buffer until it is freed
+    cdef WavpackStreamDecoder *_decoder
+    cdef Buffer _source_buffer
+    cdef Buffer _wvc_buffer
+    cdef readonly int num_channels
+    cdef readonly object dtype
+    cdef readonly size_t remaining_frames
+
+    def __cinit__(self, source, bint verify_checksum=True, correction=None):
+        cdef:
+            int num_chans, bytes_per_sample
+            int open_flags = _open_flags(verify_checksum)
+            char *wvc_ptr
+            size_t wvc_size
+
+        self._decoder = NULL
+        self.remaining_frames, _, self.dtype = get_stream_info(source)
+        self._source_buffer = Buffer(source, PyBUF_ANY_CONTIGUOUS)
+        self._wvc_buffer = _correction_buffer(correction, &wvc_ptr, &wvc_size)
+        with nogil:
+            self._decoder = WavpackStreamDecoderOpen(self._source_buffer.ptr, self._source_buffer.nbytes, wvc_ptr,
+                                                     wvc_size, &num_chans, &bytes_per_sample, open_flags)
+        if self._decoder == NULL:
+            raise RuntimeError("WavPack decompression error: could not open the stream")
+        self.num_channels = num_chans
+
+    def __dealloc__(self):
+        WavpackStreamDecoderClose(self._decoder)
+        if self._source_buffer is not None:
+            self._source_buffer.release()
+        if self._wvc_buffer is not None:
+            self._wvc_buffer.release()
+
+    def read(self, dest):
+        # decodes the next frames into dest (a C-contiguous array), returns the number of frames decoded
+        cdef:
+            Buffer dest_buffer
+            size_t num_samples = min(dest.shape[0], self.remaining_frames)
+            size_t decompressed_samples
+
+        # the library can write to the destination past the end of the stream
+        if num_samples == 0:
+            return 0
+        dest_buffer = Buffer(dest, PyBUF_ANY_CONTIGUOUS | PyBUF_WRITEABLE)
+        try:
+            with nogil:
+                decompressed_samples = WavpackStreamDecoderRead(self._decoder, dest_buffer.ptr, num_samples)
+        finally:
+            dest_buffer.release()
+        if decompressed_samples == <size_t>-1:
+            raise RuntimeError("WavPack decompression error")
+        self.remaining_frames -= decompressed_samples
+        return decompressed_samples
+
+
+def iter_decode(source, Py_ssize_t frames_per_step, ring_buffer=None, bint verify_checksum=True):
+    """Decode a chunk incrementally, a number of frames at a time.
+
+    Memory use is bounded by `frames_per_step` (or by the ring buffer), independently of the size of 
+    the chunk.
+
+    Parameters
+    ----------
+    source : bytes-like
+        Compressed data. Can be any object supporting the buffer protocol.
+    frames_per_step : int
+        Number of frames decoded (and yielded) at each step. The last step can be shorter.
+    ring_buffer : np.array, optional
+        C-contiguous array of shape (k * frames_per_step, num_chans) and the dtype of the stream. Steps
+        are decoded into consecutive regions of the ring buffer, wrapping around at its end, so that the
+        previous k - 1 steps are still available (e.g. for filters that need past samples).
+    verify_checksum : bool
+        If False, the block checksums are not verified (faster, for trusted storage).
+
+    Yields
+    ------
+    np.array
+        Views of shape (num_step_frames, num_chans). Without a ring buffer, all the views share the same 
+        memory, which is overwritten by the next step: copy them to keep them.
+
+    """
+    decoder = _StreamDecoder(source, verify_checksum)
+    buffer = _step_buffer(frames_per_step, decoder.num_channels, decoder.dtype, ring_buffer)
+    return _iter_decode_steps([decoder], [[0, decoder.num_channels]], buffer, frames_per_step)
+
+
+def _step_buffer(frames_per_step, num_chans, dtype, ring_buffer):
+    if frames_per_step <= 0:
+        raise ValueError("frames_per_step must be positive")
+    if ring_buffer is None:
+        return np.empty((frames_per_step, num_chans), dtype=dtype)
+    if not isinstance(ring_buffer, np.ndarray) or not ring_buffer.flags.c_contiguous:
+        raise ValueError("The ring buffer must be a C-contiguous numpy array")
+    if ring_buffer.dtype != dtype:
+        raise ValueError(f"The ring buffer must have dtype {dtype}, got {ring_buffer.dtype}")
+    if (ring_buffer.ndim != 2 or ring_buffer.shape[1] != num_chans or ring_buffer.shape[0] == 0 or
+            ring_buffer.shape[0] % frames_per_step):
+        raise ValueError(f"The ring buffer must have shape (k * {frames_per_step}, {num_chans}), "
+                         f"got {ring_buffer.shape}")
+    return ring_buffer
+
+
+def _iter_decode_steps(decoders, channel_groups, buffer, frames_per_step, prefilter=None, quantization=None):
+    # decodes the streams of the channel groups in lockstep, into consecutive regions of the buffer
+    # (for the "median" prefilter, the last decoder is the one of the common reference)
+    group_buffers = reference = None
+    stream_dtype = buffer.dtype if quantization is None else np.dtype(quantization["dtype"])
+    if len(decoders) > 1 or prefilter is not None or quantization is not None:
+        group_buffers = [np.empty((frames_per_step, stop - start), dtype=decoder.dtype)
+                         for decoder, (start, stop) in zip(decoders, channel_groups)]
+    if prefilter == "median":
+        reference = np.empty((frames_per_step, 1), dtype=decoders[-1].dtype)
+    position = 0
+    while True:
+        dest = buffer[position:position + frames_per_step]
+        if group_buffers is None:
+            num_frames = decoders[0].read(dest)
+        else:
+            num_frames = frames_per_step if reference is None else decoders[-1].read(reference)
+            for decoder, (start, stop), group_buffer in zip(decoders, channel_groups, group_buffers):
+                num_frames = min(num_frames, decoder.read(group_buffer))
+                group_dec = group_buffer
+                if prefilter is not None:
+                    group_dec = invert_prefilter(group_buffer, prefilter, stream_dtype, reference)
+                if quantization is not None:
+                    invert_quantization(group_dec[:num_frames], quantization, buffer.dtype, slice(start, stop),
+                                        out=dest[:num_frames, start:stop])
+                else:
+                    dest[:num_frames, start:stop] = group_dec[:num_frames]
+        if num_frames == 0:
+            return
+        yield dest[:num_frames]
+        if num_frames < frames_per_step:
+            return
+        position = (position + frames_per_step) % buffer.shape[0]
+
+
+def _stream_dtype(header):
+    # the dtype of the samples encoded in the streams of a container (before inverting the prefilter)
+    quantization = header.get("quantize")
+    return np.dtype(header["dtype"] if quantization is None else quantization["dtype"])
+
+
+def _empty_decoded(stream_info, num_samples):
+    _, num_chans, dtype = stream_info
+    return np.empty((num_samples, num_chans), dtype=dtype)
 
 
-        
 class WavPack(Codec):    
     codec_id = "wavpack"
     max_block_size = 131072
     supported_dtypes = ["int8", "int16", "int32", "uint8", "uint16", "uint32", "float32"]
     max_channels = 4096
-    max_buffer_size = 0x7E000000
+    # no limit on the size of encoded buffers: all sizes are 64-bit safe
+    max_buffer_size = None
 
-    def __init__(self, level=1, bps=None, debug=False):
+    def __init__(self, level=1, bps=None, channel_group_size=None, block_samples=None, extra=0, 
+                 joint_stereo=None, verify_checksum=True, prefilter=None, correction=False, lossy_only=False,
+                 intra_chunk_threads=1, quantize=None, max_error=None, stats=None, debug=False):
         """
         Numcodecs Codec implementation for WavPack (https://www.wavpack.com/) codec.
 
-        2D buffers exceeding the supported number of channels (buffer's second dimension) and 
-        buffers > 2D are flattened before compression.
+        Buffers > 2D are encoded as 2D buffers whose channels are all the dimensions after the first. 
+        2D buffers exceeding the supported number of channels (buffer's second dimension) are split in 
+        blocks of channels encoded as independent WavPack streams (see `channel_group_size`). 
+        Non-contiguous buffers (e.g. a subset of the channels of a larger array) are encoded without copy.
 
 
         Parameters
         ----------
-        compression_mode : str, optional
-            The wavpack compression mode ("default", "f", "h", "hh"), by default "default"
+        level : int, optional
+            The compression level (1: fast, 2: default, 3: high, 4: very high), by default 1
         bps : float or None, optional
             If the hybrid factor is given, the hybrid mode is used and compression is lossy. 
             The hybrid factor is between 2.25 and 24 (it can be a decimal, e.g. 3.5) and it 
             is the average number of bits used to encode each sample, by default None
+        channel_group_size : int or None, optional
+            If given, 2D buffers with more channels are split in groups of channel_group_size 
+            channels, each encoded as an independent WavPack stream. Groups can then be decoded 
+            individually with `decode_channels`, by default None
+        block_samples : int or None, optional
+            The number of frames of each WavPack block (between 16 and max_block_size). Smaller blocks 
+            make `decode_partial` cheaper, at the cost of some compression. If None, chunks are encoded 
+            in blocks of at most 120000 frames, by default None
+        extra : int, optional
+            The extra processing level (0: off, 1 - 6), which searches for better decorrelation filters:
+            encoding is slower and compression better, decoding speed is unaffected, by default 0
+        joint_stereo : bool or None, optional
+            If True (False), joint stereo is forced on (off) for the pairs of channels. If None, it is 
+            chosen by WavPack, by default None
+        verify_checksum : bool, optional
+            If False, the block checksums are not verified when decoding, which is faster for data 
+            read from trusted storage. It is a setting of the reader, not part of the config, by default True
+        prefilter : str or None, optional
+            An exactly invertible inter-channel prefilter applied to integer buffers before encoding, to 
+            remove the common-mode component shared by the channels: "median" (the median across channels 
+            is subtracted from each frame and stored as an extra stream) or "delta" (each channel is replaced
+            by its difference with the previous channel of its group). The prefilter is recorded in the 
+            chunk header and inverted when decoding. In hybrid mode (bps), the lossy errors of the "delta" 
+            residuals add up along the channels, so "delta" requires `correction=True` (and its lossy tier 
+            is only approximate), by default None
+        correction : bool, optional
+            If True (hybrid mode only), chunks are stored in two tiers: the lossy (hybrid) streams, followed
+            by the correction streams that restore the lossless data. Readers that only need the lossy data
+            can fetch the first `lossy_tier_size` bytes of a chunk, by default False
+        lossy_only : bool, optional
+            If True, the correction tier of two-tier chunks is ignored when decoding, and the chunks can be
+            truncated to their lossy tier. It is a setting of the reader, not part of the config, so that 
+            readers of the array decode losslessly unless they ask for the lossy tier, by default False
+        intra_chunk_threads : int, optional
+            The number of native threads used to encode and decode each chunk (0 for the number of CPUs). 
+            The frames of a chunk are split in ranges of whole blocks that are encoded in parallel and 
+            joined into a single stream, which lowers the latency of large chunks. Smaller `block_samples`
+            allow more ranges. The streams are decodable with any setting. It is a setting of the machine that 
+            encodes or decodes, not part of the config, by default 1
+        quantize : str or None, optional
+            If "int16" or "int32", float32 buffers are quantized (lossy) to integers of this dtype before 
+            encoding, with a scale and an offset per channel, so that WavPack uses its integer path: the range 
+            of each channel spans the dtype, or the scale is set by `max_error`. The scales and offsets are 
+            stored in the chunk header. Integer buffers are not quantized, by default None
+        max_error : float or None, optional
+            If given, float32 buffers are quantized ("int16" if `quantize` is None) with a step of 
+            2 * max_error, so that the absolute error is at most max_error (plus the float32 rounding of the 
+            decoded samples). Channels whose range does not fit in int16 are quantized to int32. It cannot be 
+            combined with the hybrid mode (bps), whose errors would add up, by default None
+        stats : CodecStats, bool or None, optional
+            If given (True for a new collector), the duration, bytes in/out and phases ("convert": sample 
+            conversion, "codec": WavPack library) of each call are recorded in the `stats` collector, 
+            by default None
         debug : bool
             If True, prints debug commands
         """
@@ -202,6 +1395,36 @@ class WavPack(Codec):
         assert self.level in (1, 2, 3, 4)
         self.debug = debug
 
+        if channel_group_size is not None:
+            channel_group_size = int(channel_group_size)
+            assert 0 < channel_group_size <= self.max_channels, \
+                f"channel_group_size must be between 1 and {self.max_channels}"
+        self.channel_group_size = channel_group_size
+
+        if block_samples is not None:
+            block_samples = int(block_samples)
+            assert 16 <= block_samples <= self.max_block_size, \
+                f"block_samples must be between 16 and {self.max_block_size}"
+        self.block_samples = block_samples
+        self.extra = int(extra)
+        assert 0 <= self.extra <= 6, "extra must be between 0 and 6"
+        self.joint_stereo = None if joint_stereo is None else bool(joint_stereo)
+        self.verify_checksum = bool(verify_checksum)
+        assert prefilter is None or prefilter in PREFILTERS, f"prefilter must be None or one of {PREFILTERS}"
+        self.prefilter = prefilter
+        self.correction = bool(correction)
+        self.lossy_only = bool(lossy_only)
+        self.intra_chunk_threads = int(intra_chunk_threads)
+        assert self.intra_chunk_threads >= 0, "intra_chunk_threads must be >= 0"
+        if max_error is not None:
+            max_error = float(max_error)
+            assert max_error > 0, "max_error must be positive"
+            quantize = quantize or "int16"
+        assert quantize is None or quantize in QUANTIZE_DTYPES, f"quantize must be None or one of {QUANTIZE_DTYPES}"
+        self.quantize = quantize
+        self.max_error = max_error
+        self.stats = CodecStats() if stats is True else (stats or None)
+
         if bps is not None:
             if bps > 0:
                 self.bps = max(bps, 2.25)
@@ -209,40 +1432,648 @@ class WavPack(Codec):
                 self.bps = 0
         else:
             self.bps = 0
+        assert self.bps > 0 or not self.correction, "correction requires the hybrid mode (bps)"
+        # the lossy errors of the "delta" residuals add up along the channels of a group when decoding
+        assert self.bps == 0 or self.prefilter != "delta" or self.correction, \
+            'the "delta" prefilter requires correction=True in hybrid mode (bps)'
+        # the hybrid errors add up to the quantization error, which would exceed max_error
+        assert self.max_error is None or self.bps == 0, "max_error cannot be combined with the hybrid mode (bps)"
         
     def get_config(self):
-        # override to handle encoding dtypes
+        # the settings of the process that reads or writes (verify_checksum, lossy_only, intra_chunk_threads,
+        # stats) are not part of the config, which is stored in the array metadata
         return dict(
             id=self.codec_id,
             level=self.level,
-            bps=float(self.bps)
+            bps=float(self.bps),
+            channel_group_size=self.channel_group_size,
+            block_samples=self.block_samples,
+            extra=self.extra,
+            joint_stereo=self.joint_stereo,
+            prefilter=self.prefilter,
+            correction=self.correction,
+            quantize=self.quantize,
+            max_error=self.max_error
         )
 
+    def _encode_options(self):
+        # keyword arguments of compress and compress_many
+        return dict(block_samples=self.block_samples or 0, extra=self.extra,
+                    joint_stereo=-1 if self.joint_stereo is None else int(self.joint_stereo),
+                    correction=self.correction)
+
+    def _decompress(self, stream, out=None, timings=None, correction=None):
+        # decompresses a whole stream, with several threads if intra_chunk_threads is not 1
+        if self.intra_chunk_threads == 1:
+            return decompress(stream, out, self.verify_checksum, timings, correction)
+        return decompress_parallel(stream, out, self.intra_chunk_threads, self.verify_checksum, timings, correction)
+
+    def _record(self, operation, t_start, bytes_in, out, timings):
+        # records a call in the stats collector (only called when stats are enabled)
+        bytes_out = len(out) if isinstance(out, bytes) else ensure_contiguous_ndarray(out).nbytes
+        self.stats.record(operation, time.perf_counter() - t_start, bytes_in, bytes_out, timings)
+
     def _prepare_data(self, buf):
         # checks
         assert str(buf.dtype) in self.supported_dtypes, f"Unsupported dtype {buf.dtype}"
+        # views (no copy) of shape (nsamples, nchannels): buffers > 2D are reshaped so that all the
+        # dimensions after the first are channels
         if buf.ndim == 1:
             data = buf[:, None]
         elif buf.ndim == 2:
-            _, nchannels = buf.shape
-            
-            if nchannels > self.max_channels:
-                data = buf.flatten()[:, None]    
-            else:
-                data = buf   
+            data = buf   
         else:
-            data = buf.flatten()[:, None]    
+            data = buf.reshape(buf.shape[0], -1)
         return data
 
-    def encode(self, buf):
+    def _split_streams(self, buf):
+        # returns the arrays to compress as independent streams and the container header
+        # (None for chunks stored as a single plain stream)
         data = self._prepare_data(buf)
-        dtype = str(data.dtype)
         if self.debug:
             print(f"Data shape: {data.shape}")
         nsamples, nchans = data.shape
-        dtype_id = dtype_enum[dtype]
-        return compress(data, self.level, nsamples, nchans, self.bps, dtype_id)
+        dtype = data.dtype
+        quantization = None
+        if self.quantize is not None and dtype.kind == "f":
+            data, quantization = apply_quantization(data, self.quantize, self.max_error)
+        # buffers with more channels than supported by WavPack are split in channel blocks
+        group_size = self.channel_group_size
+        if group_size is None and nchans > self.max_channels:
+            group_size = self.max_channels
+        groups = None
+        if group_size is not None and nchans > group_size:
+            groups = [[start, min(start + group_size, nchans)] for start in range(0, nchans, group_size)]
+        elif self.prefilter is not None or self.correction or quantization is not None:
+            groups = [[0, nchans]]
+        if groups is None:
+            return [data], None
+
+        header = dict(shape=[nsamples, nchans], dtype=str(dtype), channel_groups=groups)
+        if quantization is not None:
+            header["quantize"] = quantization
+        if self.prefilter is not None:
+            # the residuals of the channel groups, followed by the common reference (if any)
+            streams_data, reference = apply_prefilter(data, self.prefilter, groups)
+            if reference is not None:
+                streams_data.append(reference)
+            header["prefilter"] = self.prefilter
+        else:
+            # the (non-contiguous) channel blocks are read in place by the encoder
+            streams_data = [data[:, start:stop] for start, stop in groups]
+        if self.correction:
+            header["correction"] = True
+        return streams_data, header
+
+    @staticmethod
+    def _join_streams(streams, header):
+        if header is None:
+            return streams[0]
+        if header.get("correction"):
+            # (lossy, correction) pairs: the lossy tier is stored first, so that it can be read alone
+            streams = [lossy for lossy, _ in streams] + [correction for _, correction in streams]
+        return pack_container(header, streams)
+
+    def _split_tiers(self, header, streams):
+        # returns the lossy streams of a container and their correction streams (None if not used)
+        if not header.get("correction"):
+            return streams, [None] * len(streams)
+        num_streams = len(streams) // 2
+        if self.lossy_only:
+            return streams[:num_streams], [None] * num_streams
+        corrections = streams[num_streams:]
+        sizes = [size for _, size in header["segments"][num_streams:]]
+        if any(correction.nbytes != size for correction, size in zip(corrections, sizes)):
+            raise ValueError("The correction tier of the chunk is missing or truncated: use lossy_only=True to "
+                             "decode its lossy tier")
+        return streams[:num_streams], corrections
+
+    @staticmethod
+    def lossy_tier_size(buf):
+        """
+        Returns the number of leading bytes of an encoded chunk needed to decode its lossy tier.
+
+        For two-tier chunks (see `correction`), readers can fetch only these bytes (e.g. with a 
+        range request) and decode them with `lossy_only=True`.
+
+        Parameters
+        ----------
+        buf : bytes-like
+            The encoded chunk, or its first bytes (at least the container header, see 
+            `wavpack_common.container.header_size`)
+
+        Returns
+        -------
+        int
+            The size of the lossy tier, or of the whole chunk for chunks without a correction tier 
+            (None if `buf` is a plain stream, which has no header to read its size from)
+        """
+        buf = np.frombuffer(ensure_contiguous_ndarray(buf), dtype="uint8")
+        if buf.size >= len(CONTAINER_MAGIC) and not is_container(buf):
+            return None
+        # raises a ValueError with the number of bytes needed if buf is shorter than the header
+        payload_start = header_size(buf)
+        header, _ = unpack_container(buf[:payload_start])
+        segments = header["segments"]
+        if header.get("correction"):
+            segments = segments[:len(segments) // 2]
+        offset, size = segments[-1]
+        return payload_start + offset + size
+
+    def encode(self, buf):
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
+        streams_data, header = self._split_streams(buf)
+        streams = []
+        for data in streams_data:
+            nsamples, nchans = data.shape
+            dtype_id = dtype_enum[str(data.dtype)]
+            if self.intra_chunk_threads == 1:
+                streams.append(compress(data, self.level, nsamples, nchans, self.bps, dtype_id, timings=timings,
+                                        **self._encode_options()))
+            else:
+                streams.append(compress_parallel(data, self.level, nsamples, nchans, self.bps, dtype_id,
+                                                 self.intra_chunk_threads, timings=timings, **self._encode_options()))
+        enc = self._join_streams(streams, header)
+        if timings is not None:
+            self._record("encode", t_start, buf.nbytes, enc, timings)
+        return enc
+
+    def encode_many(self, bufs, num_threads=None):
+        """
+        Encodes many chunks in parallel with native threads.
+
+        Parameters
+        ----------
+        bufs : list of np.array
+            The chunks to encode
+        num_threads : int or None, optional
+            The number of threads. If None, the number of CPUs is used, by default None
+
+        Returns
+        -------
+        list of bytes
+            The encoded chunks
+        """
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
+        streams_data, headers, num_streams = [], [], []
+        for buf in bufs:
+            chunk_streams_data, header = self._split_streams(buf)
+            streams_data.extend(chunk_streams_data)
+            headers.append(header)
+            num_streams.append(len(chunk_streams_data))
+
+        streams = compress_many(streams_data, self.level, self.bps, num_threads or 0, timings=timings,
+                                **self._encode_options())
+
+        encoded = []
+        stream_index = 0
+        for header, chunk_num_streams in zip(headers, num_streams):
+            encoded.append(self._join_streams(streams[stream_index:stream_index + chunk_num_streams], header))
+            stream_index += chunk_num_streams
+        if timings is not None:
+            self.stats.record("encode_many", time.perf_counter() - t_start, sum(buf.nbytes for buf in bufs),
+                              sum(len(enc) for enc in encoded), timings)
+        return encoded
+
+    def decode_many(self, bufs, outs=None, num_threads=None):
+        """
+        Decodes many chunks in parallel with native threads.
+
+        Parameters
+        ----------
+        bufs : list of bytes-like
+            The encoded chunks
+        outs : list of array-like or None, optional
+            Objects to decode into, by default None
+        num_threads : int or None, optional
+            The number of threads. If None, the number of CPUs is used, by default None
+
+        Returns
+        -------
+        list of np.array or array-like
+            The decoded chunks
+        """
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
+        if outs is None:
+            outs = [None] * len(bufs)
+        sources, corrections, dests, containers = [], [], [], []
+        for buf, out in zip(bufs, outs):
+            buf = ensure_contiguous_ndarray(buf, self.max_buffer_size)
+            if is_container(buf):
+                header, streams = unpack_container(buf)
+                nsamples, _ = header["shape"]
+                group_decs = self._empty_segments(header, nsamples)
+                streams, stream_corrections = self._split_tiers(header, streams)
+                sources.extend(streams)
+                corrections.extend(stream_corrections)
+                dests.extend(group_decs)
+                containers.append((header, group_decs, out))
+            else:
+                sources.append(buf)
+                corrections.append(None)
+                dests.append(out)
+                containers.append(None)
+
+        dests = decompress_many(sources, dests, num_threads or 0, self.verify_checksum, timings, corrections)
+
+        decoded = []
+        dest_index = 0
+        for container in containers:
+            if container is None:
+                decoded.append(dests[dest_index])
+                dest_index += 1
+            else:
+                header, group_decs, out = container
+                decoded.append(self._join_channel_groups(header, group_decs, out))
+                dest_index += len(group_decs)
+        if timings is not None:
+            self.stats.record("decode_many", time.perf_counter() - t_start, sum(source.nbytes for source in sources),
+                              sum(ensure_contiguous_ndarray(dec).nbytes for dec in decoded), timings)
+        return decoded
+
+    @staticmethod
+    def _empty_segments(header, nsamples):
+        # arrays to decode the segments of a container into: the channel groups and the common reference
+        dtype = _stream_dtype(header)
+        prefilter = header.get("prefilter")
+        if prefilter is not None:
+            dtype = residual_dtype(dtype)
+        segments = [np.empty((nsamples, stop - start), dtype=dtype) for start, stop in header["channel_groups"]]
+        if prefilter == "median":
+            segments.append(np.empty((nsamples, 1), dtype=dtype))
+        return segments
+
+    @staticmethod
+    def _join_channel_groups(header, group_decs, out=None):
+        nsamples, nchans = header["shape"]
+        dtype = np.dtype(header["dtype"])
+        prefilter = header.get("prefilter")
+        reference = group_decs[-1] if prefilter == "median" else None
+        if out is None:
+            dec = np.empty((nsamples, nchans), dtype=dtype)
+        else:
+            dec = ensure_contiguous_ndarray(out).view(dtype).reshape(nsamples, nchans)
+        quantization = header.get("quantize")
+        for (start, stop), group_dec in zip(header["channel_groups"], group_decs):
+            if prefilter is not None:
+                group_dec = invert_prefilter(group_dec, prefilter, _stream_dtype(header), reference)
+            if quantization is not None:
+                invert_quantization(group_dec, quantization, dtype, slice(start, stop), out=dec[:, start:stop])
+            else:
+                dec[:, start:stop] = group_dec
+        return dec if out is None else out
+
+    def _decode_container(self, buf, out=None, channels=None, start=None, stop=None, timings=None):
+        header, streams = unpack_container(buf)
+        nsamples, nchans = header["shape"]
+        dtype = np.dtype(header["dtype"])
+        groups = header["channel_groups"]
+
+        if start is not None:
+            start = min(start, nsamples)
+            nsamples = max(0, min(stop, nsamples) - start)
+        if channels is None:
+            channels = np.arange(nchans)
+        else:
+            channels = np.arange(nchans)[channels]
+        channels = np.atleast_1d(channels)
+
+        if out is None:
+            dec = np.empty((nsamples, len(channels)), dtype=dtype)
+        else:
+            dec = ensure_contiguous_ndarray(out).view(dtype).reshape(nsamples, len(channels))
+
+        def decode_segment(stream, correction):
+            if start is None:
+                return self._decompress(stream, timings=timings, correction=correction)
+            return decompress_range(stream, start, start + nsamples, verify_checksum=self.verify_checksum,
+                                    timings=timings, correction=correction)
+
+        streams, corrections = self._split_tiers(header, streams)
+        prefilter = header.get("prefilter")
+        quantization = header.get("quantize")
+        reference = decode_segment(streams[-1], corrections[-1]) if prefilter == "median" else None
+        # only the groups containing requested channels are decoded
+        for (group_start, group_stop), stream, correction in zip(groups, streams, corrections):
+            in_group = (channels >= group_start) & (channels < group_stop)
+            if not np.any(in_group):
+                continue
+            group_dec = decode_segment(stream, correction)
+            if prefilter is not None:
+                group_dec = invert_prefilter(group_dec, prefilter, _stream_dtype(header), reference)
+            group_dec = group_dec[:, channels[in_group] - group_start]
+            if quantization is not None:
+                group_dec = invert_quantization(group_dec, quantization, dtype, channels[in_group])
+            dec[:, in_group] = group_dec
+        return dec if out is None else out
 
     def decode(self, buf, out=None):        
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
+        buf = ensure_contiguous_ndarray(buf, self.max_buffer_size)
+        if is_container(buf):
+            dec = self._decode_container(buf, out, timings=timings)
+        else:
+            dec = self._decompress(buf, out, timings)
+        if timings is not None:
+            self._record("decode", t_start, buf.nbytes, dec, timings)
+        return dec
+
+    def iter_decode(self, buf, frames_per_step, ring_buffer=None):
+        """
+        Decodes an encoded chunk incrementally, with memory use bounded by `frames_per_step`.
+
+        See `iter_decode` for the details. For chunks encoded with channel groups, the groups 
+        are decoded in lockstep.
+
+        Parameters
+        ----------
+        buf : bytes-like
+            The encoded chunk
+        frames_per_step : int
+            The number of frames decoded at each step
+        ring_buffer : np.array, optional
+            Array of shape (k * frames_per_step, num_channels) to decode into, by default None
+
+        Yields
+        ------
+        np.array
+            Reusable views of the decoded frames, with shape (num_step_frames, num_channels)
+        """
+        buf = ensure_contiguous_ndarray(buf, self.max_buffer_size)
+        if not is_container(buf):
+            return iter_decode(buf, frames_per_step, ring_buffer, self.verify_checksum)
+        header, streams = unpack_container(buf)
+        _, nchans = header["shape"]
+        buffer = _step_buffer(frames_per_step, nchans, np.dtype(header["dtype"]), ring_buffer)
+        streams, corrections = self._split_tiers(header, streams)
+        decoders = [_StreamDecoder(stream, self.verify_checksum, correction)
+                    for stream, correction in zip(streams, corrections)]
+        return _iter_decode_steps(decoders, header["channel_groups"], buffer, frames_per_step,
+                                  header.get("prefilter"), header.get("quantize"))
+
+    def decode_channels(self, buf, channels, out=None):
+        """
+        Decodes a subset of the channels of an encoded chunk.
+
+        For chunks encoded with channel groups (see `channel_group_size`), only the groups 
+        containing the requested channels are decoded. Other chunks are fully decoded before
+        selecting the channels.
+
+        Parameters
+        ----------
+        buf : bytes-like
+            The encoded chunk
+        channels : int, list, slice, or array of indices
+            The channels to decode, as indices of the second dimension of the encoded data
+        out : array-like, optional
+            Object to decode into, by default None
+
+        Returns
+        -------
+        np.array
+            The decoded channels, with shape (num_frames, num_selected_channels)
+        """
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
+        buf = ensure_contiguous_ndarray(buf, self.max_buffer_size)
+        if is_container(buf):
+            dec = self._decode_container(buf, out, channels=channels, timings=timings)
+        else:
+            dec = self._decompress(buf, timings=timings)
+            dec = ndarray_copy(dec[:, np.atleast_1d(np.arange(dec.shape[1])[channels])], out)
+        if timings is not None:
+            self._record("decode_channels", t_start, buf.nbytes, dec, timings)
+        return dec
+
+    def decode_partial(self, buf, start, stop, out=None):
+        """
+        Decodes the frames [start, stop) of an encoded chunk.
+
+        Frames are indices along the first dimension of the encoded data (for buffers > 2D, the 
+        decoded frames have all the other dimensions flattened in the second dimension).
+
+        Parameters
+        ----------
+        buf : bytes-like
+            The encoded chunk
+        start : int
+            The first frame to decode
+        stop : int
+            The frame after the last frame to decode (clipped to the chunk length)
+        out : array-like, optional
+            Object to decode into, by default None
+
+        Returns
+        -------
+        np.array or array-like
+            The decoded frames
+        """
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
         buf = ensure_contiguous_ndarray(buf, self.max_buffer_size)
-        return decompress(buf, out)
+        if is_container(buf):
+            if start < 0 or stop < start:
+                raise ValueError(f"Invalid frame range [{start}, {stop})")
+            dec = self._decode_container(buf, out, start=start, stop=stop, timings=timings)
+        else:
+            dec = decompress_range(buf, start, stop, out, self.verify_checksum, timings)
+        if timings is not None:
+            self._record("decode_partial", t_start, buf.nbytes, dec, timings)
+        return dec
+
+
+cdef class WavPackStreamEncoder:
+    """
+    Incremental WavPack encoder, for data that is produced continuously (e.g. during acquisition).
+
+    Frames are encoded as they are written, in calls of any size, and the WavPack blocks are emitted 
+    as soon as they are finished, so that memory use stays flat instead of growing with the chunk. 
+    The concatenation of all the emitted blocks is a WavPack stream that can be decoded by `decompress` 
+    and by the `WavPack` codec. The total number of frames is not known in advance, so it is not stored 
+    in the stream (it is counted from the block headers when decoding).
+
+    Blocks are passed to `callback` if given, and otherwise queued and returned by iterating over the 
+    encoder. The encoder is not thread-safe.
+
+    Parameters
+    ----------
+    num_channels : int
+        The number of channels (second dimension of the written frames)
+    dtype : str or np.dtype
+        The dtype of the written frames
+    level : int, optional
+        Compression level (1: fast, 2: default, 3: high, 4: very high), by default 1
+    bps : float or None, optional
+        Bits per sample for the lossy hybrid mode (None for lossless), by default None
+    block_samples : int or None, optional
+        The number of frames of each WavPack block. If None, the default of the library is used, 
+        by default None
+    extra : int, optional
+        The extra processing level (0: off, 1 - 6), by default 0
+    joint_stereo : bool or None, optional
+        Joint stereo for the pairs of channels (None: chosen by WavPack), by default None
+    callback : callable or None, optional
+        Function called with each finished block (bytes), by default None
+
+    Examples
+    --------
+    >>> with WavPackStreamEncoder(384, "int16", callback=out_file.write) as encoder:
+    ...     for frames in acquisition:
+    ...         encoder.write(frames)
+    """
+    cdef WavpackStreamEncoder *_encoder
+    cdef readonly int num_channels
+    cdef readonly object dtype
+    cdef readonly Py_ssize_t num_frames
+    cdef readonly Py_ssize_t bytes_written
+    cdef object _callback
+    cdef object _blocks
+
+    def __cinit__(self, num_channels, dtype, level=1, bps=None, block_samples=None, extra=0, joint_stereo=None,
+                  callback=None):
+        self._encoder = NULL
+
+    def __init__(self, num_channels, dtype, level=1, bps=None, block_samples=None, extra=0, joint_stereo=None,
+                 callback=None):
+        cdef WavpackEncodeOptions options
+
+        dtype = np.dtype(dtype)
+        if str(dtype) not in dtype_enum:
+            raise ValueError(f"Unsupported dtype {dtype}")
+        if not 0 < num_channels <= WavPack.max_channels:
+            raise ValueError(f"num_channels must be between 1 and {WavPack.max_channels}")
+        if level not in (1, 2, 3, 4):
+            raise ValueError(f"Invalid level {level} (range = 1-4)")
+        if not 0 <= extra <= 6:
+            raise ValueError(f"Invalid extra {extra} (range = 0-6)")
+        bps = max(bps, 2.25) if bps is not None and bps > 0 else 0
+        options = _encode_options(level, bps, block_samples or 0, extra, 
+                                  -1 if joint_stereo is None else int(joint_stereo))
+        self.num_channels = num_channels
+        self.dtype = dtype
+        self.num_frames = 0
+        self.bytes_written = 0
+        self._callback = callback
+        self._blocks = collections.deque()
+        self._encoder = WavpackStreamEncoderOpen(num_channels, &options, dtype_enum[str(dtype)])
+        if self._encoder == NULL:
+            raise RuntimeError("WavPack stream encoder initialization failed")
+
+    def __dealloc__(self):
+        WavpackStreamEncoderClose(self._encoder)
+
+    @property
+    def closed(self):
+        return self._encoder == NULL
+
+    def write(self, frames):
+        """
+        Encodes frames, emitting the blocks that are finished.
+
+        Parameters
+        ----------
+        frames : np.array
+            Frames with shape (num_frames, num_channels), or (num_frames,) for a single channel
+        """
+        cdef:
+            Buffer source_buffer
+            size_t num_frames
+            ptrdiff_t frame_stride, chan_stride
+            int write_ok
+
+        if self._encoder == NULL:
+            raise ValueError("The stream encoder is closed")
+        frames = np.asarray(frames)
+        if frames.ndim == 1 and self.num_channels == 1:
+            frames = frames[:, None]
+        if frames.ndim != 2 or frames.shape[1] != self.num_channels:
+            raise ValueError(f"Frames must have shape (num_frames, {self.num_channels}), got {frames.shape}")
+        if frames.dtype != self.dtype:
+            raise ValueError(f"Frames must have dtype {self.dtype}, got {frames.dtype}")
+        num_frames = frames.shape[0]
+
+        # frames are read in place, even if non-contiguous
+        source_buffer = _strided_source(frames, num_frames, self.num_channels, dtype_enum[str(self.dtype)],
+                                        &frame_stride, &chan_stride)
+        try:
+            with nogil:
+                write_ok = WavpackStreamEncoderWrite(self._encoder, source_buffer.ptr, num_frames, frame_stride,
+                                                     chan_stride)
+        finally:
+            source_buffer.release()
+        if not write_ok:
+            raise RuntimeError("WavPack stream encoding failed")
+        self.num_frames += num_frames
+        self._emit()
+
+    def close(self):
+        """Encodes the last (partial) block, emits it and closes the encoder"""
+        cdef int flush_ok
+
+        if self._encoder == NULL:
+            return
+        with nogil:
+            flush_ok = WavpackStreamEncoderFlush(self._encoder)
+        if flush_ok:
+            self._emit()
+        WavpackStreamEncoderClose(self._encoder)
+        self._encoder = NULL
+        if not flush_ok:
+            raise RuntimeError("WavPack stream flush failed")
+
+    cdef _emit(self):
+        # splits the output in groups of blocks (one per channel stream) ending with a final block,
+        # i.e. the blocks holding all the channels of a range of frames
+        cdef:
+            size_t output_size
+            char *output = WavpackStreamEncoderOutput(self._encoder, &output_size)
+
+        if output_size == 0:
+            return
+        data = PyBytes_FromStringAndSize(output, output_size)
+        WavpackStreamEncoderClearOutput(self._encoder)
+        self.bytes_written += output_size
+
+        blocks = []
+        offset = block_start = 0
+        while offset < output_size:
+            block_size, flags = _block_header.unpack_from(data, offset)
+            offset += block_size + 8
+            if flags & _FINAL_BLOCK:
+                blocks.append(data[block_start:offset])
+                block_start = offset
+        if block_start < output_size:
+            blocks.append(data[block_start:])
+
+        if self._callback is not None:
+            for block in blocks:
+                self._callback(block)
+        else:
+            self._blocks.extend(blocks)
+
+    def __iter__(self):
+        # yields (and removes) the queued blocks
+        while self._blocks:
+            yield self._blocks.popleft()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # the last block is not flushed, so that a failed write loop does not end with a stream that
+            # looks complete
+            WavpackStreamEncoderClose(self._encoder)
+            self._encoder = NULL
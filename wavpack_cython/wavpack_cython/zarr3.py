@@ -0,0 +1,284 @@
+"""
+Zarr v3 array-to-bytes codec, with asynchronous encoding and decoding offloaded to an executor.
+
+The numcodecs `WavPack` codec is synchronous: under the async codec pipeline of zarr-python v3 it runs on the
+event loop (or through a generic sync adapter). `WavPackZarr3` is a native v3 codec that dispatches each batch
+of chunks to a thread or process executor, where it is encoded/decoded with `WavPack.encode_many`/`decode_many`,
+so that fetching chunks overlaps with decoding them:
+
+    import zarr
+    from wavpack_cython.zarr3 import WavPackZarr3
+
+    z = zarr.create_array(store, shape=recording.shape, chunks=(30000, 384), dtype="int16",
+                          serializer=WavPackZarr3(level=2), compressors=None)
+
+Decoded chunks are allocated with the exact shape and dtype of the chunk spec passed by zarr. The codec
+metadata is the `WavPack` config (e.g. {"name": "wavpack", "configuration": {"level": 2, ...}}). The executor
+options are not stored in the metadata: they apply to the process that reads or writes, and are set for all the
+codecs (including the ones of arrays opened from their metadata) with `set_executor`:
+
+    from wavpack_cython import zarr3
+
+    zarr3.set_executor("thread", max_workers=16, batch_size=4)
+    z = zarr.open_array(store)  # chunks are decoded in the shared thread pool
+
+The "thread" and "process" pools are shared by all the codecs of the process, per number of workers, and are
+shut down at exit (or by `shutdown_executors`).
+
+This module requires zarr>=3 and is not imported by `wavpack_cython`.
+"""
+import asyncio
+import atexit
+import functools
+import json
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+try:
+    from zarr.abc.codec import ArrayBytesCodec
+    from zarr.core.common import parse_named_configuration
+    from zarr.registry import register_codec
+except ImportError as e:
+    raise ImportError("wavpack_cython.zarr3 requires zarr>=3") from e
+
+from .wavpack import WavPack
+
+
+CODEC_NAME = "wavpack"
+EXECUTORS = ("thread", "process")
+# options of the WavPack codec that are settings of the reader, not part of the config
+_RUNTIME_OPTIONS = ("verify_checksum", "lossy_only", "intra_chunk_threads")
+
+# process-wide executor options, used by the codecs that do not set them
+_executor_options = dict(executor=None, max_workers=None, batch_size=None, num_threads=None)
+# the "thread" and "process" pools, shared by the codecs of the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _check_executor_options(executor, batch_size):
+    if isinstance(executor, str):
+        assert executor in EXECUTORS, f"executor must be None, an Executor or one of {EXECUTORS}"
+    else:
+        assert executor is None or isinstance(executor, Executor), \
+            f"executor must be None, an Executor or one of {EXECUTORS}"
+    assert batch_size is None or batch_size > 0, "batch_size must be > 0"
+
+
+def set_executor(executor=None, max_workers=None, batch_size=None, num_threads=None):
+    """
+    Sets the process-wide executor options, used by the codecs that do not set their own (e.g. the codecs of
+    the arrays opened from their metadata).
+
+    Parameters
+    ----------
+    executor : str, concurrent.futures.Executor or None, optional
+        "thread", "process", an executor instance, or None for the default executor of the event loop,
+        by default None
+    max_workers : int or None, optional
+        The number of workers of the "thread" and "process" pools, by default None (the pool default)
+    batch_size : int or None, optional
+        The maximum number of chunks of each executor call, by default None (a single call per batch)
+    num_threads : int or None, optional
+        The number of native threads of each call, by default None (the number of CPUs)
+    """
+    _check_executor_options(executor, batch_size)
+    _executor_options.update(executor=executor, max_workers=max_workers, batch_size=batch_size,
+                             num_threads=num_threads)
+
+
+def shutdown_executors(wait=True):
+    """Shuts down the shared "thread" and "process" pools (new ones are created when needed)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=wait)
+
+
+def _shared_pool(kind, max_workers):
+    with _pools_lock:
+        pool = _pools.get((kind, max_workers))
+        if pool is None:
+            pool_cls = ThreadPoolExecutor if kind == "thread" else ProcessPoolExecutor
+            pool = _pools[(kind, max_workers)] = pool_cls(max_workers=max_workers)
+        return pool
+
+
+def _reset_pools_in_child():
+    # the pools (and their threads and processes) belong to the parent process
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+atexit.register(shutdown_executors)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pools_in_child)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_codec(config_json):
+    # one codec per config in each (worker) process
+    return WavPack(**json.loads(config_json))
+
+
+def _codec_from_config(codec):
+    # codecs are sent to process workers as their JSON config
+    return _cached_codec(codec) if isinstance(codec, str) else codec
+
+
+def _encode_chunks(codec, arrays, num_threads):
+    return _codec_from_config(codec).encode_many(arrays, num_threads=num_threads)
+
+
+def _decode_chunks(codec, bufs, shapes, dtypes, num_threads):
+    # decodes into arrays with the exact shape and dtype of the chunk specs
+    outs = [np.empty(shape, dtype=dtype) for shape, dtype in zip(shapes, dtypes)]
+    return _codec_from_config(codec).decode_many(bufs, outs=outs, num_threads=num_threads)
+
+
+def _native_dtype(dtype):
+    # zarr >= 3.1 wraps the numpy dtype
+    return np.dtype(dtype.to_native_dtype() if hasattr(dtype, "to_native_dtype") else dtype)
+
+
+@dataclass(frozen=True)
+class WavPackZarr3(ArrayBytesCodec):
+    """
+    Zarr v3 array-to-bytes codec for WavPack, encoding and decoding batches of chunks in an executor.
+
+    Parameters
+    ----------
+    executor : str, concurrent.futures.Executor or None, optional
+        Where the chunks are encoded and decoded: "thread" (a shared thread pool, the WavPack functions
+        release the GIL), "process" (a shared process pool) or an executor instance. If None, the process-wide
+        setting is used (see `set_executor`), which defaults to the default executor of the event loop,
+        by default None
+    max_workers : int or None, optional
+        The number of workers of the "thread" and "process" pools. If None, the process-wide setting is used,
+        by default None
+    batch_size : int or None, optional
+        The maximum number of chunks of each executor call. Batches of chunks from zarr are split in calls of
+        `batch_size` chunks that run concurrently. If None, the process-wide setting is used (by default, each
+        batch is a single call), by default None
+    num_threads : int or None, optional
+        The number of native threads of each call (see `WavPack.encode_many`). If None, the process-wide
+        setting is used (by default, the number of CPUs), by default None
+    **codec_kwargs
+        The arguments of the `WavPack` codec (level, bps, channel_group_size, ...), stored in the array metadata
+    """
+    is_fixed_size = False
+
+    configuration: dict
+
+    def __init__(self, *, executor=None, max_workers=None, batch_size=None, num_threads=None, **codec_kwargs):
+        _check_executor_options(executor, batch_size)
+        codec = WavPack(**codec_kwargs)
+        configuration = codec.get_config()
+        del configuration["id"]
+        # process workers rebuild the codec from the config and the reader settings
+        worker_config = dict(configuration, **{key: value for key, value in codec_kwargs.items()
+                                               if key in _RUNTIME_OPTIONS})
+        object.__setattr__(self, "configuration", configuration)
+        object.__setattr__(self, "_codec", codec)
+        object.__setattr__(self, "_worker_config", json.dumps(worker_config, sort_keys=True))
+        object.__setattr__(self, "_options", dict(executor=executor, max_workers=max_workers,
+                                                  batch_size=batch_size, num_threads=num_threads))
+
+    @classmethod
+    def from_dict(cls, data):
+        _, configuration = parse_named_configuration(data, CODEC_NAME, require_configuration=False)
+        return cls(**(configuration or {}))
+
+    def to_dict(self):
+        return {"name": CODEC_NAME, "configuration": dict(self.configuration)}
+
+    def __hash__(self):
+        # the configuration dict is not hashable
+        return hash(json.dumps(self.to_dict(), sort_keys=True))
+
+    def validate(self, *, shape, dtype, chunk_grid):
+        dtype = _native_dtype(dtype)
+        if str(dtype) not in WavPack.supported_dtypes:
+            raise ValueError(f"WavPack does not support dtype {dtype}, use one of {WavPack.supported_dtypes}")
+
+    def compute_encoded_size(self, _input_byte_length, _chunk_spec):
+        raise NotImplementedError
+
+    def _option(self, name):
+        # the option of this codec, or the process-wide one
+        value = self._options[name]
+        return _executor_options[name] if value is None else value
+
+    def _get_executor(self):
+        executor = self._option("executor")
+        if isinstance(executor, str):
+            return _shared_pool(executor, self._option("max_workers"))
+        return executor
+
+    def _worker_codec(self, executor):
+        # process workers rebuild the codec from its config, threads share this codec (and its stats)
+        if isinstance(executor, ProcessPoolExecutor):
+            return self._worker_config
+        return self._codec
+
+    async def _run_batches(self, func, items, *args):
+        # runs func on batches of at most batch_size items concurrently in the executor, and returns the
+        # concatenated results in order
+        if not items:
+            return []
+        batch_size = self._option("batch_size") or len(items)
+        num_threads = self._option("num_threads")
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        codec = self._worker_codec(executor)
+        futures = []
+        for start in range(0, len(items), batch_size):
+            batch_args = [arg[start:start + batch_size] for arg in (items,) + args]
+            futures.append(loop.run_in_executor(executor, func, codec, *batch_args, num_threads))
+        results = []
+        for batch_results in await asyncio.gather(*futures):
+            results.extend(batch_results)
+        return results
+
+    async def encode(self, chunks_and_specs):
+        chunks_and_specs = list(chunks_and_specs)
+        indices, arrays = [], []
+        for index, (chunk_array, _) in enumerate(chunks_and_specs):
+            if chunk_array is not None:
+                indices.append(index)
+                arrays.append(chunk_array.as_numpy_array())
+        encoded = await self._run_batches(_encode_chunks, arrays)
+        results = [None] * len(chunks_and_specs)
+        for index, enc in zip(indices, encoded):
+            results[index] = chunks_and_specs[index][1].prototype.buffer.from_bytes(enc)
+        return results
+
+    async def decode(self, chunks_and_specs):
+        chunks_and_specs = list(chunks_and_specs)
+        indices, bufs, shapes, dtypes = [], [], [], []
+        for index, (chunk_bytes, chunk_spec) in enumerate(chunks_and_specs):
+            if chunk_bytes is not None:
+                indices.append(index)
+                bufs.append(chunk_bytes.as_numpy_array())
+                shapes.append(tuple(chunk_spec.shape))
+                dtypes.append(_native_dtype(chunk_spec.dtype))
+        decoded = await self._run_batches(_decode_chunks, bufs, shapes, dtypes)
+        results = [None] * len(chunks_and_specs)
+        for index, dec in zip(indices, decoded):
+            results[index] = chunks_and_specs[index][1].prototype.nd_buffer.from_ndarray_like(dec)
+        return results
+
+    async def _encode_single(self, chunk_array, chunk_spec):
+        return (await self.encode([(chunk_array, chunk_spec)]))[0]
+
+    async def _decode_single(self, chunk_bytes, chunk_spec):
+        return (await self.decode([(chunk_bytes, chunk_spec)]))[0]
+
+
+register_codec(CODEC_NAME, WavPackZarr3)
@@ -1,7 +1,12 @@
 import numcodecs
-from .wavpack import WavPackCodec, has_wavpack, get_wavpack_version, get_max_channels
+from .wavpack import (WavPackCodec, has_wavpack, get_wavpack_version, get_max_channels,
+                      get_wavpack_capabilities)
+from .process_pool import WavPackProcessPool, get_process_pool
+from wavpack_common.stats import CodecStats
+from .auto import WavPackAutoCodec, has_cython_backend
 
-# add to regisrty
+# add to regisrty: the front-end has its own codec id
 numcodecs.register_codec(WavPackCodec)
+numcodecs.register_codec(WavPackAutoCodec)
 
 from .version import version as __version__
@@ -0,0 +1,221 @@
+"""
+Codec front-end dispatching to the fastest WavPack backend available at runtime.
+
+`WavPackAutoCodec` is registered under its own "wavpack_auto" codec id, so that the "wavpack" configs of
+`WavPackCodec` (the "wavpack"/"wvunpack" CLI) and of the `WavPack` codec of the `wavpack_cython` package (the
+library, in process) keep resolving to their codecs. It uses the config schema of `wavpack_cython.WavPack` (level,
+bps, ...), and the in-process backend when `wavpack_cython` is installed, the CLI otherwise. It also reads configs
+written by `WavPackCodec` (compression_mode, hybrid_factor, dtype, ...), so that the chunks of existing datasets
+can be decoded in process wherever the extension is available:
+
+    codec = WavPackAutoCodec.from_config({"id": "wavpack", "compression_mode": "default", "dtype": "int16", ...})
+    codec.backend  # "cython" if wavpack_cython is installed, else "cli"
+
+`wavpack_cython` (and its compiled extension) is only imported when the cython backend is used.
+
+The parameters and the config are the ones of `wavpack_cython.WavPack` (forwarded to it), so that new options of
+the in-process codec need no change here. Chunks written by either backend are decoded by both. With the CLI
+backend, only `level` and `bps` are used: the options that change the chunk format (channel_group_size,
+prefilter, correction, quantize) are not available, the others are kept in the config, and only int16, int32
+and float32 chunks can be encoded (other dtypes are stored differently by the CLI).
+"""
+import numpy as np
+
+from numcodecs.abc import Codec
+from numcodecs.compat import ensure_contiguous_ndarray, ndarray_copy
+
+from wavpack_common.container import is_container, unpack_container
+from wavpack_common.stats import CodecStats
+
+from .wavpack import WavPackCodec, _stream_info, check_cli_header, QMODE_SIGNED_BYTES, QMODE_UNSIGNED_WORDS
+
+
+BACKENDS = ("cython", "cli")
+# CLI compression modes of each level
+CLI_MODES = {1: "f", 2: "default", 3: "h", 4: "hh"}
+# options of the WavPack schema that change the chunk format, only available with the cython backend
+CYTHON_ONLY_OPTIONS = ("channel_group_size", "prefilter", "correction", "quantize")
+# dtypes whose streams are the same for both backends
+CLI_ENCODE_DTYPES = ("int16", "int32", "float32")
+CLI_CONFIG_KEYS = ("compression_mode", "hybrid_factor", "pair_unassigned", "set_block_size", "sample_rate",
+                   "dtype", "use_system_wavpack")
+
+
+def _cython_wavpack():
+    # the WavPack codec of wavpack_cython (None if not installed), imported on first use
+    try:
+        from wavpack_cython import WavPack
+    except ImportError:
+        return None
+    return WavPack
+
+
+def has_cython_backend():
+    """Returns True if the in-process backend (the `wavpack_cython` package) is installed"""
+    return _cython_wavpack() is not None
+
+
+def _to_cli_samples(data):
+    # the raw samples of the CLI: unsigned 8-bit bytes (offset from the signed range by the CLI) and signed words
+    if data.dtype.itemsize == 1:
+        return (data.view("uint8") ^ np.uint8(0x80)).view("int8")
+    if data.dtype.kind == "u":
+        return data.view(f"int{data.dtype.itemsize * 8}")
+    return data
+
+
+def _from_cli_samples(dec, dtype):
+    # inverse of _to_cli_samples, in place
+    if dtype.itemsize == 1:
+        dec = dec.view("uint8")
+        dec ^= np.uint8(0x80)
+    return dec.view(dtype)
+
+
+class WavPackAutoCodec(Codec):
+    codec_id = "wavpack_auto"
+
+    def __init__(self, backend=None, cli_config=None, stats=None, debug=False, **kwargs):
+        """
+        Numcodecs Codec for WavPack, using the in-process library if available and the CLI otherwise.
+
+        Parameters
+        ----------
+        backend : str or None, optional
+            The backend to use: "cython" or "cli". If None, "cython" is used if `wavpack_cython` is installed,
+            "cli" otherwise. The backend is not part of the config, by default None
+        cli_config : dict or None, optional
+            The config of a `WavPackCodec` (see `from_config`): the chunks are then encoded as by the CLI (with
+            both backends), and `get_config` returns this config (with the "wavpack_auto" id), by default None
+        stats : CodecStats, bool or None, optional
+            If given (True for a new collector), the calls of the backend codec are recorded in the `stats`
+            collector, by default None
+        debug : bool
+            If True, prints debug commands
+        **kwargs
+            The parameters of `wavpack_cython.WavPack` (level, bps, ...), see its documentation
+        """
+        if backend is None:
+            backend = "cython" if has_cython_backend() else "cli"
+        assert backend in BACKENDS, f"backend must be None or one of {BACKENDS}"
+        if backend == "cython" and not has_cython_backend():
+            raise ImportError("The cython backend requires the wavpack_cython package")
+        self.backend = backend
+        self.cli_config = None if cli_config is None else {key: cli_config[key] for key in CLI_CONFIG_KEYS
+                                                            if key in cli_config}
+        self.dtype = None if cli_config is None else np.dtype(cli_config.get("dtype", "int16"))
+        self.stats = CodecStats() if stats is True else (stats or None)
+        self.debug = debug
+
+        self._cython_codec = None
+        self._cli_codecs = {}
+        if self.backend == "cython":
+            self._cython_codec = _cython_wavpack()(stats=self.stats, debug=debug, **kwargs)
+            self.config = self._cython_codec.get_config()
+            del self.config["id"]
+        else:
+            # the config is kept as given, for readers with the in-process codec
+            self.config = dict(kwargs)
+            self.config.setdefault("level", 1)
+            assert self.config["level"] in CLI_MODES, "level must be between 1 and 4"
+            for option in CYTHON_ONLY_OPTIONS:
+                if self.config.get(option):
+                    raise ValueError(f"{option} requires the cython backend (the wavpack_cython package)")
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates a codec from the config of a `WavPackAutoCodec`, a `wavpack_cython.WavPack` or a `WavPackCodec`.
+
+        Parameters
+        ----------
+        config : dict
+            The codec config
+
+        Returns
+        -------
+        WavPackAutoCodec
+            The codec, whose `get_config` returns the same config
+        """
+        config = dict(config)
+        config.pop("id", None)
+        if "compression_mode" not in config:
+            return cls(**config)
+        modes = {mode: level for level, mode in CLI_MODES.items()}
+        return cls(level=modes.get(config["compression_mode"], 2), bps=config.get("hybrid_factor"),
+                   cli_config=config)
+
+    def get_config(self):
+        if self.cli_config is not None:
+            return dict(id=self.codec_id, **self.cli_config)
+        return dict(id=self.codec_id, **self.config)
+
+    def _cli_codec(self, dtype):
+        # the CLI codec for a dtype, created once
+        dtype = np.dtype(dtype)
+        codec = self._cli_codecs.get(dtype)
+        if codec is None:
+            if self.cli_config is not None:
+                cli_config = dict(self.cli_config, dtype=str(dtype))
+            else:
+                cli_config = dict(compression_mode=CLI_MODES[self.config["level"]],
+                                  hybrid_factor=self.config.get("bps") or None, dtype=str(dtype))
+            codec = self._cli_codecs[dtype] = WavPackCodec(stats=self.stats, debug=self.debug, **cli_config)
+        return codec
+
+    def encode(self, buf):
+        if self.backend == "cli":
+            if self.cli_config is not None:
+                return self._cli_codec(self.dtype).encode(buf)
+            if str(buf.dtype) not in CLI_ENCODE_DTYPES:
+                raise ValueError(f"The cli backend can only encode {CLI_ENCODE_DTYPES} chunks, got {buf.dtype}: "
+                                 "install wavpack_cython")
+            return self._cli_codec(buf.dtype).encode(buf)
+        if self.cli_config is not None:
+            # the samples are stored as by the CLI, for readers using the CLI
+            return self._cython_codec.encode(_to_cli_samples(buf))
+        return self._cython_codec.encode(buf)
+
+    def decode(self, buf, out=None):
+        if self.backend == "cli":
+            if self.cli_config is not None:
+                return self._cli_codec(self.dtype).decode(buf, out)
+            return ndarray_copy(self._cli_decode(buf), out)
+        if self.cli_config is not None:
+            dec = self._cython_codec.decode(buf)
+            return ndarray_copy(_from_cli_samples(dec, self.dtype), out)
+        return self._cython_codec.decode(buf, out)
+
+    def _cli_decode(self, buf):
+        # decodes chunks written by the cython backend with the CLI
+        buf = ensure_contiguous_ndarray(buf)
+        if not is_container(buf):
+            return self._cli_decode_stream(buf)
+        header, streams = unpack_container(buf)
+        check_cli_header(header)
+        nsamples, nchans = header["shape"]
+        dec = np.empty((nsamples, nchans), dtype=header["dtype"])
+        for (start, stop), stream in zip(header["channel_groups"], streams):
+            dec[:, start:stop] = self._cli_decode_stream(stream).reshape(nsamples, stop - start)
+        return dec
+
+    def _cli_decode_stream(self, stream):
+        info = _stream_info(stream)
+        if info is None:
+            raise RuntimeError("Invalid WavPack stream")
+        nsamples, nchans, bytes_per_sample, is_float, qmode = info
+        if is_float:
+            return self._cli_codec("float32").decode(stream).reshape(nsamples, nchans)
+        # the CLI outputs unsigned bytes and signed words: the dtype is restored from the qualify mode flags
+        if bytes_per_sample == 1:
+            dec = self._cli_codec("uint8").decode(stream)
+            if qmode & QMODE_SIGNED_BYTES:
+                dec ^= np.uint8(0x80)
+                dec = dec.view("int8")
+        else:
+            nbits = bytes_per_sample * 8
+            dec = self._cli_codec(f"int{nbits}").decode(stream)
+            if qmode & QMODE_UNSIGNED_WORDS:
+                dec = dec.view(f"uint{nbits}")
+                dec ^= dec.dtype.type(1 << (nbits - 1))
+        return dec.reshape(nsamples, nchans)
@@ -0,0 +1,210 @@
+import os
+import atexit
+import threading
+import subprocess
+from collections import OrderedDict, deque
+
+
+class WavPackProcessPool:
+    """
+    Thread-safe pool of pre-spawned "wavpack"/"wvunpack" processes.
+
+    The CLI programs process a single stream per invocation, so each pooled process is still used for a
+    single chunk: the pool only moves the fork/exec cost out of the encode/decode call. It keeps up to
+    `size` processes per command line already started and blocked on their stdin, spawned by a
+    background thread. Idle processes are health-checked before being handed out and dead ones are
+    replaced.
+
+    The encoding command lines include the shape of the chunks, so a command line is only pooled from its
+    second use: the processes of command lines used once (e.g. for the edge chunks of an array) are spawned
+    on demand, and do not evict the pooled command lines or leave idle processes behind.
+
+    Parameters
+    ----------
+    max_commands : int, optional
+        Maximum number of distinct command lines (i.e. codec configurations and chunk shapes) kept in the
+        pool. The least recently used command line is evicted when the limit is exceeded, by default 8
+    """
+
+    def __init__(self, max_commands=8):
+        self.max_commands = max_commands
+        self._idle = OrderedDict()
+        # command lines used once, which are pooled if they are used again (the most recent ones are kept)
+        self._seen = OrderedDict()
+        self._max_seen = 8 * max_commands
+        self._sizes = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    @staticmethod
+    def _spawn(cmd):
+        return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    @staticmethod
+    def _terminate(proc):
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        for stream in (proc.stdin, proc.stdout, proc.stderr):
+            if stream is not None:
+                stream.close()
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._replenish, name="wavpack-process-pool", daemon=True)
+            self._thread.start()
+
+    def _replenish(self):
+        while True:
+            with self._condition:
+                key = None
+                while key is None:
+                    if self._closed:
+                        return
+                    for cmd, procs in self._idle.items():
+                        if len(procs) < self._sizes[cmd]:
+                            key = cmd
+                            break
+                    else:
+                        self._condition.wait()
+            proc = self._spawn(list(key))
+            with self._condition:
+                procs = self._idle.get(key)
+                if self._closed or procs is None or len(procs) >= self._sizes[key]:
+                    self._terminate(proc)
+                else:
+                    procs.append(proc)
+
+    def acquire(self, cmd, size):
+        """
+        Returns a started process running `cmd`, ready to receive its input on stdin.
+
+        The first time a command line is used, the process is spawned on demand, and idle processes are kept
+        for the command line from its next use.
+
+        Parameters
+        ----------
+        cmd : list of str
+            The command line
+        size : int
+            The number of idle processes to keep ready for this command line
+
+        Returns
+        -------
+        subprocess.Popen
+            The process, owned by the caller from now on
+        """
+        key = tuple(cmd)
+        proc = None
+        evicted = []
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The WavPack process pool has been closed")
+            procs = self._idle.get(key)
+            if procs is None and key not in self._seen:
+                self._seen[key] = None
+                while len(self._seen) > self._max_seen:
+                    self._seen.popitem(last=False)
+            else:
+                if procs is None:
+                    del self._seen[key]
+                    procs = self._idle[key] = deque()
+                    while len(self._idle) > self.max_commands:
+                        old_key, old_procs = self._idle.popitem(last=False)
+                        self._sizes.pop(old_key)
+                        evicted.extend(old_procs)
+                self._idle.move_to_end(key)
+                self._sizes[key] = max(int(size), 1)
+                # health check: discard processes that died while idle
+                while procs:
+                    candidate = procs.popleft()
+                    if candidate.poll() is None:
+                        proc = candidate
+                        break
+                    evicted.append(candidate)
+                self._ensure_worker()
+                self._condition.notify()
+        for old_proc in evicted:
+            self._terminate(old_proc)
+        if proc is None:
+            proc = self._spawn(cmd)
+        return proc
+
+    def release(self, cmd, proc):
+        """
+        Returns an unused process (acquired, but not written to) to the idle processes of `cmd`.
+
+        The process is terminated if the pool is closed or already has enough idle processes for `cmd`.
+
+        Parameters
+        ----------
+        cmd : list of str
+            The command line of the process
+        proc : subprocess.Popen
+            The process returned by `acquire`
+        """
+        key = tuple(cmd)
+        with self._condition:
+            procs = self._idle.get(key)
+            if not self._closed and procs is not None and len(procs) < self._sizes[key]:
+                procs.append(proc)
+                return
+        self._terminate(proc)
+
+    def num_idle(self, cmd=None):
+        """Returns the number of idle processes, for a command line or in total"""
+        with self._condition:
+            if cmd is not None:
+                return len(self._idle.get(tuple(cmd), ()))
+            return sum(len(procs) for procs in self._idle.values())
+
+    def clear(self):
+        """Terminates all idle processes"""
+        with self._condition:
+            procs = [proc for idle in self._idle.values() for proc in idle]
+            self._idle.clear()
+            self._seen.clear()
+            self._sizes.clear()
+        for proc in procs:
+            self._terminate(proc)
+
+    def close(self):
+        """Terminates all idle processes and stops the pool"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """Returns the process-wide WavPackProcessPool, creating it if needed"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WavPackProcessPool()
+        return _pool
+
+
+def _close_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def _reset_process_pool_in_child():
+    # idle processes and the replenishing thread belong to the parent process
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+atexit.register(_close_process_pool)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_process_pool_in_child)
@@ -1,6 +1,11 @@
+import os
 import subprocess
 import shutil
 import platform
+import struct
+import threading
+import time
+from collections import namedtuple
 
 import numpy as np
 from pathlib import Path
@@ -9,7 +14,12 @@ from copy import copy
 from packaging.version import parse
 
 from numcodecs.abc import Codec
-from numcodecs.compat import ndarray_copy
+from numcodecs.compat import ensure_contiguous_ndarray, ndarray_copy
+
+from wavpack_common.container import is_container, pack_container, unpack_container
+from wavpack_common.stats import CodecStats
+
+from .process_pool import get_process_pool
 
 
 lib_folder = Path(__file__).parent / "lib"
@@ -43,18 +53,224 @@ else: # use pre-built libraries
         wvunpack_lib_cmd = str((lib_folder / "windows" / "wvunpack.exe").resolve().absolute())
         
 
-def get_wavpack_version():
-    wvver = subprocess.run([wavpack_lib_cmd, "--version"], capture_output=True)
-    wv_version = wvver.stdout.decode().split("\n")[0][len("wavpack")+1:]
-    return parse(wv_version)
 
-def get_max_channels():
-    wavpack_version = get_wavpack_version()
-    if wavpack_version >= parse("5.5.0"):
-        return 1024
+def _add_phase(timings, phase, t_start):
+    # adds the time elapsed since t_start to a phase of the call timings (None when stats are disabled)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - t_start
+
+
+# WavPack block header: ckID, ckSize, version, block_index_u8, total_samples_u8, total_samples, block_index,
+# block_samples, flags, crc
+_block_header = struct.Struct("<4sIHBBIIIII")
+_MONO_FLAG = 0x4
+_FLOAT_DATA = 0x80
+_INITIAL_BLOCK = 0x800
+_FINAL_BLOCK = 0x1000
+_ID_UNIQUE = 0x3f
+_ID_ODD_SIZE = 0x40
+_ID_LARGE = 0x80
+_ID_NEW_CONFIG_BLOCK = 0x2a
+QMODE_SIGNED_BYTES = 0x2
+QMODE_UNSIGNED_WORDS = 0x4
+# size of the slices of the input written to the stdin pipes
+_PIPE_WRITE_SIZE = 1 << 20
+# header keys of the containers written by the cython backend that the CLI cannot invert
+CYTHON_ONLY_HEADER_KEYS = ("prefilter", "quantize", "correction")
+
+
+def check_cli_header(header):
+    """
+    Raises a ValueError if a container holds chunks that the CLI cannot decode: prefiltered, quantized or
+    two-tier chunks (whose correction streams follow the lossy streams), written by the cython backend.
+    """
+    unsupported = [key for key in CYTHON_ONLY_HEADER_KEYS if header.get(key)]
+    if unsupported:
+        raise ValueError(f"Chunks with {unsupported[0]} require the cython backend (the wavpack_cython package)")
+
+
+def _block_qmode(buf, offset, end):
+    # the qualify mode flags stored in the "new config" metadata of the block at offset (0 if absent)
+    position = offset + _block_header.size
+    while position + 2 <= end:
+        meta_id, size = buf[position], buf[position + 1] * 2
+        position += 2
+        if meta_id & _ID_LARGE:
+            if position + 2 > end:
+                return 0
+            size += (buf[position] << 9) + (buf[position + 1] << 17)
+            position += 2
+        if meta_id & _ID_UNIQUE == _ID_NEW_CONFIG_BLOCK:
+            data_size = size - 1 if meta_id & _ID_ODD_SIZE else size
+            return buf[position + 1] if data_size >= 2 and position + 2 <= end else 0
+        position += size
+    return 0
+
+
+def _stream_info(buf):
+    """
+    Reads the layout of a WavPack stream by walking its block headers, without decoding it.
+
+    Streams written to a pipe by the CLI do not store their total number of samples, so the samples of the
+    blocks are added up.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        The WavPack stream
+
+    Returns
+    -------
+    tuple or None
+        The number of samples, the number of channels, the number of bytes per sample, whether the samples are
+        float and the qualify mode flags (e.g. QMODE_UNSIGNED_WORDS) of the stream, or None if the stream
+        cannot be parsed
+    """
+    buf = memoryview(buf).cast("B")
+    num_samples = num_chans = 0
+    bytes_per_sample = is_float = qmode = None
+    first_frame = True
+    offset = 0
+    while offset + _block_header.size <= len(buf):
+        ck_id, ck_size, _, _, _, _, _, block_samples, flags, _ = _block_header.unpack_from(buf, offset)
+        if ck_id != b"wvpk":
+            return None
+        if flags & _INITIAL_BLOCK:
+            num_samples += block_samples
+        if first_frame and block_samples:
+            if qmode is None:
+                bytes_per_sample, is_float = (flags & 3) + 1, bool(flags & _FLOAT_DATA)
+                qmode = _block_qmode(buf, offset, min(offset + ck_size + 8, len(buf)))
+            # each block holds a mono or stereo part of the channels of a frame
+            num_chans += 1 if flags & _MONO_FLAG else 2
+            first_frame = not flags & _FINAL_BLOCK
+        offset += ck_size + 8
+    if offset != len(buf) or num_chans == 0:
+        return None
+    return num_samples, num_chans, bytes_per_sample, is_float, qmode
+
+
+def _write_stdin(proc, source):
+    # writes the source to the process stdin in slices (no copy of the whole buffer), then closes it
+    try:
+        for start in range(0, len(source), _PIPE_WRITE_SIZE):
+            proc.stdin.write(source[start:start + _PIPE_WRITE_SIZE])
+        proc.stdin.close()
+    except (BrokenPipeError, OSError):
+        # the process exited early: its return code and stderr report the error
+        pass
+
+
+def _communicate(proc, source, out=None):
+    """
+    Streams `source` to the process stdin and reads its stdout, into `out` if given.
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+        The process, with pipes for stdin, stdout and stderr
+    source : memoryview
+        The bytes to write to stdin
+    out : memoryview or None, optional
+        Writable bytes to read stdout into, by default None
+
+    Returns
+    -------
+    returncode : int
+        The process return code
+    stdout : bytes or int
+        The output, or the number of bytes read into `out` (stdout larger than `out` is an error, reported
+        as -1)
+    stderr : bytes
+        The error output
+    """
+    stderr = []
+    writer = threading.Thread(target=_write_stdin, args=(proc, source), daemon=True)
+    reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+    writer.start()
+    reader.start()
+    if out is None:
+        stdout = proc.stdout.read()
     else:
-        return 256
-    
+        stdout = 0
+        while stdout < len(out):
+            nbytes = proc.stdout.readinto(out[stdout:])
+            if not nbytes:
+                break
+            stdout += nbytes
+        if stdout == len(out) and proc.stdout.read(1):
+            stdout = -1
+        # drain the rest of the output, so that the process can exit
+        while proc.stdout.read(_PIPE_WRITE_SIZE):
+            pass
+    writer.join()
+    reader.join()
+    proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+    return proc.returncode, stdout, stderr[0] if stderr else b""
+
+
+WavPackCapabilities = namedtuple("WavPackCapabilities", ["version", "max_channels", "raw_pcm_ex"])
+
+# process-wide cache of the probed capabilities, keyed by (binary path, binary mtime)
+_capabilities_cache = {}
+_capabilities_lock = threading.Lock()
+
+
+def _probe_wavpack_capabilities(wavpack_cmd):
+    wvver = subprocess.run([wavpack_cmd, "--version"], capture_output=True)
+    wv_version = parse(wvver.stdout.decode().split("\n")[0][len("wavpack")+1:])
+    if wv_version >= parse("5.5.0"):
+        return WavPackCapabilities(version=wv_version, max_channels=1024, raw_pcm_ex=True)
+    else:
+        return WavPackCapabilities(version=wv_version, max_channels=256, raw_pcm_ex=False)
+
+
+def get_wavpack_capabilities(wavpack_cmd=None):
+    """
+    Returns the capabilities (version, max channels, --raw-pcm-ex support) of a "wavpack" binary.
+
+    The binary is only probed (with "wavpack --version") the first time it is queried: results are
+    cached for the lifetime of the process and invalidated if the binary is modified.
+
+    Parameters
+    ----------
+    wavpack_cmd : str or None, optional
+        The "wavpack" command or path. If None, the default command is used, by default None
+
+    Returns
+    -------
+    WavPackCapabilities
+        Named tuple with "version", "max_channels" and "raw_pcm_ex" fields
+    """
+    if wavpack_cmd is None:
+        wavpack_cmd = wavpack_lib_cmd
+    wavpack_path = shutil.which(wavpack_cmd) or wavpack_cmd
+    try:
+        wavpack_path = os.path.realpath(wavpack_path)
+        key = (wavpack_path, os.stat(wavpack_path).st_mtime_ns)
+    except OSError:
+        key = (wavpack_path, None)
+
+    capabilities = _capabilities_cache.get(key)
+    if capabilities is None:
+        with _capabilities_lock:
+            capabilities = _capabilities_cache.get(key)
+            if capabilities is None:
+                capabilities = _probe_wavpack_capabilities(wavpack_cmd)
+                _capabilities_cache[key] = capabilities
+    return capabilities
+
+
+def get_wavpack_version(wavpack_cmd=None):
+    return get_wavpack_capabilities(wavpack_cmd).version
+
+
+def get_max_channels(wavpack_cmd=None):
+    return get_wavpack_capabilities(wavpack_cmd).max_channels
+
+
 
 class WavPackCodec(Codec):    
     codec_id = "wavpack"
@@ -65,15 +281,16 @@ class WavPackCodec(Codec):
                  hybrid_factor=None, pair_unassigned=False, 
                  set_block_size=False, sample_rate=48000, 
                  dtype="int16", use_system_wavpack=False,
-                 debug=False):
+                 process_pool_size=0, stats=None, debug=False):
         """
         Numcodecs Codec implementation for WavPack (https://www.wavpack.com/) codec.
 
         The implementation uses the "wavpack" and "wvunpack" CLI (for encoding and decoding, respectively),
         and uses pipes to transfer input and output streams between processes. 
 
-        2D buffers exceeding the supported number of channels (buffer's second dimension) and 
-        buffers > 2D are flattened before compression.
+        Buffers > 2D are encoded as 2D buffers whose channels are all the dimensions after the first. 
+        2D buffers exceeding the supported number of channels (buffer's second dimension) are split in 
+        blocks of channels, encoded as independent WavPack streams.
 
 
         Parameters
@@ -95,6 +312,15 @@ class WavPackCodec(Codec):
             instantiation, by default "int16"
         use_system_wavpack : bool
             If True, the codec uses the system's "wavpack" and "wvunpack" commands, by default False
+        process_pool_size : int
+            If > 0, "wavpack" and "wvunpack" processes are pre-spawned in a process-wide pool
+            (up to process_pool_size idle processes per command, from its second use) instead of being
+            started for each chunk. Each process still handles a single chunk. It is a setting of this
+            process, not part of the config, by default 0
+        stats : CodecStats, bool or None, optional
+            If given (True for a new collector), the duration, bytes in/out and phases ("convert": copies 
+            of the data, "subprocess": running the CLI) of each call are recorded in the `stats` collector,
+            by default None
         debug : bool
             If True, prints debug commands
 
@@ -112,16 +338,10 @@ class WavPackCodec(Codec):
         self.sample_rate = sample_rate
         self.dtype = np.dtype(dtype)
         self.use_system_wavpack = use_system_wavpack
+        self.process_pool_size = int(process_pool_size)
+        self.stats = CodecStats() if stats is True else (stats or None)
         self.debug = debug
         
-        wavpack_version = get_wavpack_version()
-        if wavpack_version >= parse("5.5.0"):
-            self.max_channels = 1024
-            self.pack_cmd = "--raw-pcm-ex"
-        else:
-            self.max_channels = 256
-            self.pack_cmd = "--raw-pcm"
-
         assert self.dtype.name in self.supported_dtypes
 
         if hybrid_factor is not None:
@@ -136,6 +356,10 @@ class WavPackCodec(Codec):
             wavpack_cmd = wavpack_lib_cmd
             wvunpack_cmd = wvunpack_lib_cmd
 
+        capabilities = get_wavpack_capabilities(wavpack_cmd)
+        self.max_channels = capabilities.max_channels
+        self.pack_cmd = "--raw-pcm-ex" if capabilities.raw_pcm_ex else "--raw-pcm"
+
         base_enc_cmd = [wavpack_cmd, "-y"]
         if self.compression_mode in ["f", "h", "hh"]:
             base_enc_cmd += [f"-{compression_mode}"]
@@ -165,30 +389,63 @@ class WavPackCodec(Codec):
             use_system_wavpack=self.use_system_wavpack
         )
 
+    def _run(self, cmd, input, timings=None, out=None):
+        # streams the input bytes to the command and its output into `out` (see _communicate)
+        t_start = time.perf_counter()
+        input = memoryview(input).cast("B")
+        if self.process_pool_size <= 0:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result = _communicate(proc, input, out)
+            _add_phase(timings, "subprocess", t_start)
+            return result
+
+        pool = get_process_pool()
+        result = _communicate(pool.acquire(cmd, self.process_pool_size), input, out)
+        if result[0] < 0:
+            # the process was killed or crashed: retry once with a fresh process
+            result = _communicate(pool.acquire(cmd, self.process_pool_size), input, out)
+        _add_phase(timings, "subprocess", t_start)
+        return result
+
     def _prepare_data(self, buf):
         # checks
         assert buf.dtype.kind in ["i", "u", "f"]
         assert buf.dtype == self.dtype, f"Wrong dtype initialization! The data to encode should be {self.dtype}"
+        # views (no copy) of shape (nsamples, nchannels): buffers > 2D are reshaped so that all the
+        # dimensions after the first are channels
         if buf.ndim == 1:
             data = buf[:, None]
         elif buf.ndim == 2:
-            _, nchannels = buf.shape
-            
-            if nchannels > self.max_channels:
-                data = buf.flatten()[:, None]    
-            else:
-                data = buf   
+            data = buf   
         else:
-            data = buf.flatten()[:, None]    
+            data = buf.reshape(buf.shape[0], -1)
         return data
 
     def encode(self, buf):
-        cmd = copy(self.base_enc_cmd)
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
         data = self._prepare_data(buf)
-        dtype = data.dtype
         if self.debug:
             print(f"Data shape: {data.shape}")
         nsamples, nchans = data.shape
+        if nchans <= self.max_channels:
+            enc = self._encode_stream(data, timings)
+        else:
+            # buffers with more channels than supported by the CLI are split in channel blocks
+            groups = [[start, min(start + self.max_channels, nchans)] 
+                      for start in range(0, nchans, self.max_channels)]
+            streams = [self._encode_stream(data[:, start:stop], timings) for start, stop in groups]
+            header = dict(shape=[nsamples, nchans], dtype=str(data.dtype), channel_groups=groups)
+            enc = pack_container(header, streams)
+        if timings is not None:
+            self.stats.record("encode", time.perf_counter() - t_start, buf.nbytes, len(enc), timings)
+        return enc
+
+    def _encode_stream(self, data, timings=None):
+        cmd = copy(self.base_enc_cmd)
+        dtype = data.dtype
+        nsamples, nchans = data.shape
         nbits = int(dtype.itemsize * 8)
 
         if self.set_block_size:
@@ -204,16 +461,65 @@ class WavPackCodec(Codec):
         if self.debug:
             print(" ".join(cmd), flush=True)
         
-        # pipe buffer to wavpack stdin and return encoded in stdout
-        wavenc = subprocess.run(cmd, input=data.tobytes(), capture_output=True)
-        enc = wavenc.stdout
+        # pipe buffer to wavpack stdin and return encoded in stdout: contiguous buffers are passed 
+        # without copy, others are copied once
+        t_start = time.perf_counter()
+        source = memoryview(np.ascontiguousarray(data)).cast("B")
+        _add_phase(timings, "convert", t_start)
+        returncode, enc, stderr = self._run(cmd, source, timings)
         
-        if wavenc.returncode != 0 and len(enc) == 0:
-            raise RuntimeError(f"'wavpack' command \"{' '.join(cmd)}\" failed with error: {wavenc.stderr}")
+        if returncode != 0 and len(enc) == 0:
+            raise RuntimeError(f"'wavpack' command \"{' '.join(cmd)}\" failed with error: {stderr}")
         
         return enc
 
     def decode(self, buf, out=None):        
+        timings = t_start = None
+        if self.stats is not None:
+            t_start, timings = time.perf_counter(), {}
+        if is_container(buf):
+            header, streams = unpack_container(buf)
+            check_cli_header(header)
+            nsamples, nchans = header["shape"]
+            dec, in_place = self._output_array(nsamples * nchans, out)
+            dec = dec.reshape(nsamples, nchans)
+            group_dec = None
+            for (start, stop), stream in zip(header["channel_groups"], streams):
+                # the groups are decoded into a buffer reused for all the groups (of the same size)
+                if group_dec is None or group_dec.size != nsamples * (stop - start):
+                    group_dec = np.empty(nsamples * (stop - start), dtype=self.dtype)
+                group_dec = self._decode_stream(stream, timings, group_dec)
+                t_copy = time.perf_counter()
+                dec[:, start:stop] = group_dec.reshape(nsamples, stop - start)
+                _add_phase(timings, "convert", t_copy)
+        else:
+            info = _stream_info(buf)
+            dec, in_place = (None, False) if info is None else self._output_array(info[0] * info[1], out)
+            dec = self._decode_stream(buf, timings, dec)
+
+        # handle output (decoded in place if possible)
+        if not in_place:
+            t_copy = time.perf_counter()
+            out = ndarray_copy(dec, out)
+            _add_phase(timings, "convert", t_copy)
+        
+        if timings is not None:
+            self.stats.record("decode", time.perf_counter() - t_start, memoryview(buf).nbytes, dec.nbytes, timings)
+        return out
+
+    def _output_array(self, size, out):
+        # the flat array to decode into, and whether it is a view of `out` (if `out` is contiguous with the
+        # decoded size) or a new array
+        if out is not None:
+            try:
+                out_view = ensure_contiguous_ndarray(out).view(self.dtype).reshape(-1)
+            except (TypeError, ValueError):
+                out_view = None
+            if out_view is not None and out_view.size == size and out_view.flags.writeable:
+                return out_view, True
+        return np.empty(size, dtype=self.dtype), False
+
+    def _decode_stream(self, buf, timings=None, dec=None):
         cmd = copy(self.base_dec_cmd)
 
         # use pipe
@@ -222,14 +528,20 @@ class WavPackCodec(Codec):
         if self.debug:
             print(" ".join(cmd), flush=True)
 
-        # pipe buffer to wavpack stdin and return decoded in stdout
-        wvdec = subprocess.run(cmd, input=buf, capture_output=True)
-        dec = np.frombuffer(wvdec.stdout, dtype=self.dtype)
-        
-        if wvdec.returncode != 0 and len(dec) == 0:
-            raise RuntimeError(f"'wvunpack' command \"{' '.join(cmd)}\" failed with error: {wvdec.stderr}")
+        # pipe buffer to wavpack stdin and read the decoded output from stdout into `dec` (with the size 
+        # read from the stream blocks), or into a new array if the size is unknown
+        out = None if dec is None else memoryview(dec).cast("B")
+        returncode, stdout, stderr = self._run(cmd, buf, timings, out)
+        if dec is None:
+            dec = np.frombuffer(stdout, dtype=self.dtype)
+            nbytes = dec.nbytes
+        else:
+            nbytes = stdout
         
-        # handle output
-        out = ndarray_copy(dec, out)
+        if returncode != 0 and nbytes == 0:
+            raise RuntimeError(f"'wvunpack' command \"{' '.join(cmd)}\" failed with error: {stderr}")
+        if nbytes != dec.nbytes:
+            raise RuntimeError(f"'wvunpack' command \"{' '.join(cmd)}\" returned {nbytes} bytes instead of "
+                               f"{dec.nbytes}: {stderr}")
         
-        return out
+        return dec